@@ -1,272 +1,106 @@
 import re
-import os
+import json
+import logging
 import random
-import sqlite3
+import uuid
 import pandas as pd
 import streamlit as st
-from openai import OpenAI
+import metrics
 from datetime import datetime
+from db import connection, init_db
+from i18n import LANGUAGES, available_languages, translate
+from sessions import encode_session, new_resume_token, open_session_store, restore_session
+from storage import get_repository
+from triage import classify_patient, generate_openai_response, record_decision, submit_triage, triage_key
+from slots import CLINIC_LOCATIONS, SLOT_HORIZON_DAYS, time_window
 
 #############################
 # Global Constants & Setup
 #############################
 
-CLINIC_LOCATIONS = [
-    "Jefferiss Wing Sexual Health Clinic, W2 1NY",
-    "56 Dean Street, W1D 6AQ",
-    "John Hunter Clinic, SW10 9NH"
-]
-
 CONSULTATION_MODES = ["Face-to-Face"]
-gemini_model = "gemini-2.0-flash"
-gemini_api_key = os.getenv("GEMINI_API_KEY")
-google_client = OpenAI(api_key=gemini_api_key, base_url="https://generativelanguage.googleapis.com/v1beta/openai/")
+
+logger = logging.getLogger(__name__)
 
 ##############################################
 # Database Functions
 ##############################################
-def init_db():
-    conn = sqlite3.connect('appointments.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS appointments (
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 name TEXT,
-                 priority TEXT,
-                 clinic TEXT,
-                 time_preference TEXT,
-                 mode_of_consultation TEXT,
-                 phone_number TEXT,
-                 symptoms_summary TEXT,
-                 severity_classification TEXT,
-                 date_of_birth TEXT,
-                 has_symptoms TEXT,
-                 emergency_contraception TEXT,
-                 needs_translator TEXT,
-                 translator_language TEXT
-                 )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS available_slots (
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 clinic TEXT,
-                 time TEXT,
-                 priority TEXT,
-                 mode_of_consultation TEXT,
-                 is_booked INTEGER DEFAULT 0
-                 )''')
-    conn.commit()
-    conn.close()
-
-def populate_slots():
-    conn = sqlite3.connect('appointments.db')
-    c = conn.cursor()
-    c.execute("DELETE FROM available_slots")
-    slots = []
-    priorities = ["Urgent", "Routine No Symptoms", "Routine Symptoms", "Contraception Referral"]
-    mode = "Face-to-Face"  # Only one consultation mode
-    clinics = CLINIC_LOCATIONS
-    start_time = 8 * 60  # 8 AM in minutes
-    end_time = 19 * 60   # 7 PM in minutes
-    for clinic in clinics:
-        for t in range(start_time, end_time, 15):
-            hour = t // 60
-            minute = t % 60
-            time_str = f"{hour:02}:{minute:02}"
-            for priority in priorities:
-                slots.append((clinic, time_str, priority, mode))
-    c.executemany('''INSERT INTO available_slots (clinic, time, priority, mode_of_consultation)
-                     VALUES (?, ?, ?, ?)''', slots)
-    conn.commit()
-    conn.close()
+@st.cache_resource(ttl=3600)
+def prepare_database():
+    """Creates the schema, tops up the rolling slot calendar and drops expired sessions once per process per hour."""
+    # The local file keeps the caches and sessions even when appointments live elsewhere
+    with connection() as conn:
+        init_db(conn)
+    get_repository().init_schema()
+    get_repository().generate_slot_calendar(CLINIC_LOCATIONS, SLOT_HORIZON_DAYS)
+    if session_store():
+        session_store().purge_expired()
+
+@st.cache_resource
+def session_store():
+    """The store patients' progress is checkpointed to, shared by every session in the process."""
+    return open_session_store(connection)
+
+def build_appointment():
+    """Collects the appointments row for this session from the questionnaire and booking details."""
+    has_symptoms, needs_contraception = triage_flags()
+    date_of_birth = st.session_state.responses.get('date_of_birth')
+    return {
+        "name": st.session_state.responses.get('name'),
+        "priority": st.session_state.priority,
+        "clinic": st.session_state.clinic,
+        "time_preference": st.session_state.time_preference,
+        "mode_of_consultation": st.session_state.mode_of_consultation,
+        "phone_number": st.session_state.phone_number,
+        # All collected answers, as typed JSON
+        "answers": json.dumps(st.session_state.responses, ensure_ascii=False),
+        "date_of_birth": datetime.strptime(date_of_birth, "%d/%m/%Y").date().isoformat() if date_of_birth else None,
+        "has_symptoms": int(has_symptoms),
+        "emergency_contraception": int(needs_contraception),
+        "needs_translator": int(st.session_state.needs_translator == t("yes")),
+        "translator_language": st.session_state.translator_language,
+        "triage_source": st.session_state.get("triage_source"),
+    }
 
-##############################################
-# OpenAI Helper Function
-##############################################
-def generate_openai_response(prompt, messages):
-    """Appends prompt to messages, calls OpenAI, appends and returns the response."""
-    messages.append({"role": "user", "content": prompt})
-    completion = google_client.chat.completions.create(
-        model=gemini_model,
-        messages=messages,
-        max_tokens=150,
-        temperature=0.5,
-    )
-    response = completion.choices[0].message.content.strip()
-    messages.append({"role": "assistant", "content": response})
-    return response
+def book_selected_slot():
+    """Book button callback: saves the appointment and claims the selected slot before the script reruns.
+
+    On conflict the selection moves to the next nearest free slot, which is only
+    possible from a callback since widget state is frozen once the widget renders.
+    """
+    reservation = get_repository().book_appointment(st.session_state.submission_token,
+                                                    build_appointment(), st.session_state.selected_slot_id)
+    st.session_state.booking_result = reservation
+    if not reservation.reserved and reservation.alternative:
+        st.session_state.selected_slot_id = reservation.alternative[0]
 
 ##############################################
 # Language Support
 ##############################################
-TRANSLATIONS = {
-    "English": {
-        # Page titles
-        "page_title": "Sexual Health Screening Assistant",
-        "sidebar_title": "Sexual Health Service",
-        "warning": "This is a demonstration system and not a substitute for professional medical care. In an emergency, call **999** or visit A&E immediately.",
-        
-        # Form steps
-        "registration": "Patient Registration",
-        "full_name": "What is your full name?",
-        "date_of_birth": "What is your date of birth?",
-        "has_symptoms": "Do you have symptoms?",
-        "symptoms_desc": "What are your symptoms?",
-        "symptoms_duration": "How long have you had your symptoms?",
-        "last_period": "When was your last menstrual period?",
-        "medical_history": "What medical conditions are you diagnosed to have? Are you taking any medications? Do you have any allergies?",
-        "smoking": "Do you smoke?",
-        "drugs": "Do you take recreational drugs?",
-        "prefer_not_say": "Prefer not to say",
-        "alcohol": "How much alcohol do you drink a week in units?",
-        "emergency_contraception": "Do you need emergency contraception?",
-        "days_since_period_label": "Days Since Last Period",
-
-        
-        # Summary and booking
-        "summary": "Patient Summary",
-        "triage_classification": "Triage Classification",
-        "determined_priority": "Determined Priority:",
-        "recommended_mode": "Recommended Consultation Mode:",
-        "booking_details": "Additional Booking Details",
-        "booking_details_text": "Please select additional details for your appointment:",
-        "clinic_location": "Choose a clinic location:",
-        "time_preference": "Preferred time of day:",
-        "consultation_mode": "Preferred consultation mode:",
-        "appointment_booking": "Appointment Booking",
-        "choose_slot": "Choose your appointment slot:",
-        "available_slots": "Available appointment slots:",
-        "select_slot": "Select Slot:",
-        "no_slots": "No available slots matching your criteria.",
-        "booking_success": "Appointment booked successfully for slot ID {slot_id}!",
-        
-        # Buttons
-        "next": "Next",
-        "confirm": "Confirm Summary",
-        "submit": "Submit Booking Details",
-        "book": "Book Appointment",
-        
-        # Summary labels
-        "name_label": "Name",
-        "dob_label": "Date of Birth",
-        "has_symptoms_label": "Has Symptoms",
-        "symptoms_label": "Symptoms",
-        "symptoms_duration_label": "Symptoms Duration",
-        "last_period_label": "Last Menstrual Period",
-        "medical_history_label": "Medical History",
-        "smoking_label": "Smoking Status",
-        "drugs_label": "Recreational Drugs",
-        "alcohol_label": "Alcohol (units/week)",
-        "emergency_contraception_label": "Needs Emergency Contraception",
-        
-        # Yes/No options
-        "yes": "Yes",
-        "no": "No",
-        
-        # Phone number
-        "phone_number": "Phone Number",
-        "phone_placeholder": "Enter your phone number",
-
-
-        # Translator options
-        "needs_translator": "Do you need a translator for your appointment?",
-        "translator_language": "Which language do you need translation for?",
-        
-    },
-        "Français": {
-        # Page titles
-        "page_title": "Assistant de Dépistage de Santé Sexuelle",
-        "sidebar_title": "Service de Santé Sexuelle",
-        "warning": "Ceci est un système de démonstration et ne remplace pas les soins médicaux professionnels. En cas d'urgence, appelez le **999** ou rendez-vous immédiatement aux urgences.",
-        
-        # Form steps
-        "registration": "Inscription du Patient",
-        "full_name": "Quel est votre nom complet?",
-        "date_of_birth": "Quelle est votre date de naissance?",
-        "has_symptoms": "Avez-vous des symptômes?",
-        "symptoms_desc": "Quels sont vos symptômes?",
-        "symptoms_duration": "Depuis combien de temps avez-vous ces symptômes?",
-        "last_period": "Combien de jours depuis le premier jour de vos dernières règles?",
-        "medical_history": "De quelles conditions médicales êtes-vous diagnostiqué? Prenez-vous des médicaments? Avez-vous des allergies?",
-        "smoking": "Fumez-vous?",
-        "drugs": "Prenez-vous des drogues récréatives?",
-        "prefer_not_say": "Préfère ne pas dire",
-        "alcohol": "Combien d'unités d'alcool consommez-vous par semaine?",
-        "emergency_contraception": "Avez-vous besoin d'une contraception d'urgence?",
-        "days_since_period_label": "Jours Depuis les Dernières Règles",
-        # Summary and booking
-        "summary": "Résumé du Patient",
-        "triage_classification": "Classification de Triage",
-        "determined_priority": "Priorité Déterminée:",
-        "recommended_mode": "Mode de Consultation Recommandé:",
-        "booking_details": "Détails Supplémentaires de Réservation",
-        "booking_details_text": "Veuillez sélectionner des détails supplémentaires pour votre rendez-vous:",
-        "clinic_location": "Choisissez un lieu de clinique:",
-        "time_preference": "Moment préféré de la journée:",
-        "consultation_mode": "Mode de consultation préféré:",
-        "appointment_booking": "Réservation de Rendez-vous",
-        "choose_slot": "Choisissez votre créneau de rendez-vous:",
-        "available_slots": "Créneaux de rendez-vous disponibles:",
-        "select_slot": "Sélectionnez votre créneau:",
-        "no_slots": "Aucun créneau disponible correspondant à vos critères.",
-        "booking_success": "Rendez-vous réservé avec succès pour le créneau ID {slot_id}!",
-        
-        # Buttons
-        "next": "Suivant",
-        "confirm": "Confirmer le Résumé",
-        "submit": "Soumettre les Détails de Réservation",
-        "book": "Réserver le Rendez-vous",
-        
-        # Summary labels
-        "name_label": "Nom",
-        "dob_label": "Date de Naissance",
-        "has_symptoms_label": "A des Symptômes",
-        "symptoms_label": "Symptômes",
-        "symptoms_duration_label": "Durée des Symptômes",
-        "last_period_label": "Dernières Règles",
-        "medical_history_label": "Antécédents Médicaux",
-        "smoking_label": "Statut Tabagique",
-        "drugs_label": "Drogues Récréatives",
-        "alcohol_label": "Alcool (unités/semaine)",
-        "emergency_contraception_label": "Besoin de Contraception d'Urgence",
-        
-        # Yes/No options
-        "yes": "Oui",
-        "no": "Non",
-        
-        # Phone number
-        "phone_number": "Numéro de Téléphone",
-        "phone_placeholder": "Entrez votre numéro de téléphone",
-
-        "needs_translator": "Avez-vous besoin d'un traducteur pour votre rendez-vous?",
-        "translator_language": "Pour quelle langue avez-vous besoin d'une traduction?",
-        
-    },
-    "Español": {
-        # Add Spanish translations here
-    },
-    "Deutsch": {
-        # Add German translations here
-    },
-    "العربية": {
-        # Add Arabic translations here
-    },
-    "中文": {
-        # Add Chinese translations here
-    },
-    "हिंदी": {
-        # Add Hindi translations here
-    },
-    "Português": {
-        # Add Portuguese translations here
-    }
-}
 
 # Function to get translated text
 def t(key):
-    return TRANSLATIONS[st.session_state.language].get(key, key)
+    return translate("patient", st.session_state.language, key)
 
 ##############################################
 # Streamlit UI - Integrated Multi-Step Triage & Booking
 ##############################################
 
+# A new session picks up the progress saved under the URL's resume token, which may
+# have been written by another server process or before a restart
+if session_store() and "resume_token" not in st.session_state:
+    prepare_database()
+    resume_token = st.query_params.get("resume")
+    saved_session = session_store().load(resume_token) if resume_token else None
+    if saved_session is None:
+        resume_token = new_resume_token()
+        st.query_params["resume"] = resume_token
+    else:
+        restore_session(st.session_state, saved_session)
+        st.session_state.language_selector = st.session_state.language
+    st.session_state.resume_token = resume_token
+    st.session_state.saved_session = saved_session
+
 # Session state initialization
 if "language" not in st.session_state:
     st.session_state.language = "English"
@@ -286,6 +120,18 @@ if "triage_severity" not in st.session_state:
 if "priority" not in st.session_state:
     st.session_state.priority = None  # To store parsed priority from GPT
 
+# Time this script run under the step it renders. A run that ended in st.rerun() never reached
+# the stop at the bottom; the rerun starts straight away, so stopping its timer now is accurate.
+if "run_timer" in st.session_state:
+    st.session_state.run_timer.stop()
+st.session_state.run_timer = metrics.start_timer("script_run_seconds", app="patient",
+                                                 step=str(st.session_state.current_step))
+metrics.record_step(st.session_state.setdefault("funnel", {}), "patient", st.session_state.current_step)
+metrics.start_server()
+
+# Schema and slot calendar are prepared once per process, not on every rerun
+prepare_database()
+
 # Sidebar and header
 st.sidebar.image(
     r"Logo.png",
@@ -314,7 +160,7 @@ st.sidebar.title(t("sidebar_title"))
 # Language selector
 language_selector = st.sidebar.selectbox(
     "Language / Langue / Idioma / Sprache / لغة / 语言 / भाषा / Língua:",
-    list(TRANSLATIONS.keys()),  # Use keys from TRANSLATIONS dictionary
+    list(available_languages("patient")),
     key="language_selector",
     on_change=lambda: setattr(st.session_state, "language", st.session_state.language_selector)
 )
@@ -322,6 +168,13 @@ st.title(t("page_title"))
 st.warning(t("warning"))
 
 
+# Answers that decide the triage fast path and fallback, as booleans
+def triage_flags():
+    has_symptoms = st.session_state.responses.get("has_symptoms") == t("yes")
+    needs_contraception = st.session_state.responses.get("emergency_contraception") == t("yes")
+    return has_symptoms, needs_contraception
+
+
 # Function to calculate age from date of birth
 def calculate_age(dob):
     today = datetime.today()
@@ -499,6 +352,20 @@ elif st.session_state.current_step == 13:
     summary = "\n".join(summary_items)
     
     st.text_area(t("summary"), value=summary, height=300)
+
+    # Every input triage needs is known now, so start it in the background while the
+    # patient reads the summary. A job for older answers is cancelled and replaced.
+    has_symptoms, needs_contraception = triage_flags()
+    speculative_key = triage_key(st.session_state.responses, has_symptoms, needs_contraception)
+    triage_job = st.session_state.get("triage_job")
+    if not triage_job or triage_job[0] != speculative_key:
+        if triage_job:
+            triage_job[1].cancel()
+            metrics.increment("speculative_triage_total", result="discarded")
+        st.session_state.triage_job = (speculative_key,
+                                       submit_triage(st.session_state.responses, has_symptoms, needs_contraception,
+                                                     generate_openai_response, cache_connection=connection))
+
     if st.button(t("confirm")):
         st.session_state.confirmed_summary = True
         st.session_state.current_step = 14
@@ -508,109 +375,54 @@ elif st.session_state.current_step == 13:
 elif st.session_state.current_step == 14:
     st.header(t("triage_classification"))
     
-    # Build prompt for priority determination
-    has_symptoms = st.session_state.responses.get("has_symptoms") == t("yes")
-    needs_contraception = st.session_state.responses.get("emergency_contraception") == t("yes")
+    # Answers that drive the fast-path rules and the fallback priority
+    has_symptoms, needs_contraception = triage_flags()
     
-    # Build patient summary for LLM
-    summary_items = [
-        f"Name: {st.session_state.responses.get('name')}",
-        f"Date of Birth: {st.session_state.responses.get('date_of_birth')}",
-        f"Age: {st.session_state.responses.get('age')}",
-        f"Has Symptoms: {st.session_state.responses.get('has_symptoms')}"
-    ]
-    
-    if has_symptoms:
-        summary_items.extend([
-            f"Symptoms: {st.session_state.responses.get('symptoms')}",
-            f"Symptoms Duration: {st.session_state.responses.get('symptoms_duration')}",
-            f"Last Period: {st.session_state.responses.get('last_period')}",
-            f"Smoking: {st.session_state.responses.get('smoking')}",
-            f"Recreational Drugs: {st.session_state.responses.get('drugs')}",
-            f"Alcohol: {st.session_state.responses.get('alcohol')}"
-        ])
-    
-    summary_items.extend([
-        f"Medical History: {st.session_state.responses.get('medical_history')}",
-        f"Needs Emergency Contraception: {st.session_state.responses.get('emergency_contraception')}"
-    ])
-    
-    patient_summary = "\n".join(summary_items)
-    
-    prompt_priority = (
-        f"Patient's information summary:\n{patient_summary}\n\n"
-        f"Based on this information, classify the patient into exactly one of these priority categories:\n"
-        f"1. 'Urgent' - for patients with severe symptoms requiring immediate attention\n"
-        f"2. 'Routine Symptoms' - for patients with mild symptoms that are not urgent\n"
-        f"3. 'Routine No Symptoms' - for patients seeking screening with no symptoms\n"
-        f"4. 'Contraception Referral' - for patients primarily needing emergency contraception\n\n"
-        f"Provide only the priority level in this format: 'Priority Level: [Category]'"
-    )
-    
-    system_role = "You are a sexual health triage assistant. Classify patients based on their symptoms and needs."
-    messages = [{"role": "system", "content": system_role}]
-    
-    # Only call the API if we haven't done it already
-    if "classification_response" not in st.session_state:
+    def complete_with_spinner(prompt, messages):
         with st.spinner("Analyzing patient information..."):
-            messages.append({"role": "user", "content": prompt_priority})
-            classification_response = generate_openai_response("", messages)
-            st.session_state.classification_response = classification_response
-    else:
-        classification_response = st.session_state.classification_response
+            return generate_openai_response(prompt, messages)
+
+    # Only run triage once per visit to this step: fast-path rules, then the cache, then the LLM.
+    # Usually the speculative job from step 13 has already finished and we just collect it.
+    if "triage_decision" not in st.session_state:
+        triage_decision = None
+        triage_job = st.session_state.pop("triage_job", None)
+        if triage_job and triage_job[0] == triage_key(st.session_state.responses, has_symptoms, needs_contraception):
+            try:
+                with st.spinner("Analyzing patient information..."):
+                    triage_decision = triage_job[1].result()
+            except Exception:
+                logger.exception("Speculative triage failed; classifying again")
+        if triage_job:
+            triage_job[1].cancel()  # Answers changed since it started; a no-op once it has finished
+            metrics.increment("speculative_triage_total",
+                              result="used" if triage_decision is not None else "discarded")
+        if triage_decision is not None:
+            # Background jobs leave their decision out of the triage stats until it is used
+            record_decision(triage_decision)
+        else:
+            triage_decision = classify_patient(st.session_state.responses, has_symptoms, needs_contraception,
+                                               complete_with_spinner, cache_connection=connection)
+        st.session_state.triage_decision = triage_decision
+    triage_decision = st.session_state.triage_decision
+    priority = triage_decision.priority
     
     st.write(f"{t('triage_classification')}:")
     
-    try:
-        # Parse the response
-        response_text = classification_response.lower()
-        
-        # Extract priority
-        priority = None
-        priority_terms = ["urgent", "routine symptoms", "routine no symptoms", "contraception referral"]
-        
-        for term in priority_terms:
-            if term in response_text:
-                priority = term.title()
-                break
-                
-        # Set default Face-to-Face mode
-        mode = "Face-to-Face"
-            
-        if not priority:
-            # Fallback logic
-            if needs_contraception:
-                priority = "Contraception Referral"
-            elif has_symptoms:
-                priority = "Routine Symptoms"
-            else:
-                priority = "Routine No Symptoms"
-            
-    except Exception as e:
-        st.write(f"Error parsing classification: {e}")
-        # Fallback logic
-        if needs_contraception:
-            priority = "Contraception Referral"
-        elif has_symptoms:
-            priority = "Routine Symptoms"
-        else:
-            priority = "Routine No Symptoms"
-        
-        mode = "Face-to-Face"  # Default consultation mode
-    
     # Display the results
     st.write(f"{t('determined_priority')} {priority}")
     
     # Store for later use
     st.session_state.priority = priority
+    st.session_state.triage_source = triage_decision.source
     st.session_state.recommended_mode = "Face-to-Face"
     
     # Add a button to continue to the next step
     if st.button(t("next")):
         st.session_state.current_step = 15
-        # Clear the stored response for future use
-        if "classification_response" in st.session_state:
-            del st.session_state.classification_response
+        # Clear the stored decision for future use
+        if "triage_decision" in st.session_state:
+            del st.session_state.triage_decision
         st.rerun()
 
 # Step 15: Additional Booking Details
@@ -629,7 +441,7 @@ elif st.session_state.current_step == 15:
     # If translator is needed, show language selection
     translator_language = None
     if needs_translator == t("yes"):
-        translator_language = st.selectbox(t("translator_language"), ["English", "Français", "Español", "Deutsch", "العربية", "中文", "हिंदी", "Português"], key="translator_language_input")
+        translator_language = st.selectbox(t("translator_language"), list(LANGUAGES), key="translator_language_input")
     
     # Add phone number field
     phone_number = st.text_input(t("phone_number"), placeholder=t("phone_placeholder"))
@@ -641,81 +453,69 @@ elif st.session_state.current_step == 15:
         st.session_state.phone_number = phone_number
         st.session_state.needs_translator = needs_translator
         st.session_state.translator_language = translator_language if needs_translator == t("yes") else None
+        # Identifies this booking so reruns of step 16 never save the appointment twice
+        st.session_state.submission_token = uuid.uuid4().hex
         st.session_state.current_step = 16
         st.rerun()
 
 # Step 16: Appointment Slot Selection & Booking
 elif st.session_state.current_step == 16:
     st.header(t("appointment_booking"))
-    # Initialize and populate DB
-    init_db()
-    populate_slots()
-    conn = sqlite3.connect('appointments.db')
-    c = conn.cursor()
-
-    # Save appointment in the database with all collected data
-    symptoms_summary = ""
-    for key, value in st.session_state.responses.items():
-        symptoms_summary += f"{key}: {value}\n"
-
-    c.execute('''INSERT INTO appointments 
-                (name, priority, clinic, time_preference, mode_of_consultation, phone_number, 
-                 symptoms_summary, severity_classification, date_of_birth, has_symptoms, 
-                 emergency_contraception, needs_translator, translator_language)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-              (st.session_state.responses.get('name'),
-               st.session_state.priority,
-               st.session_state.clinic,
-               st.session_state.time_preference,
-               st.session_state.mode_of_consultation,
-               st.session_state.phone_number,
-               symptoms_summary.strip(),
-               st.session_state.priority,  # Using priority as severity classification
-               st.session_state.responses.get('date_of_birth'),
-               st.session_state.responses.get('has_symptoms'),
-               st.session_state.responses.get('emergency_contraception'),
-               st.session_state.needs_translator,
-               st.session_state.translator_language))
-    conn.commit()
-
-    st.write(t("choose_slot"))
-    # Determine time range based on time preference
-    if st.session_state.time_preference == "Morning":
-        start_hour, end_hour = 8, 11
-    elif st.session_state.time_preference == "Day":
-        start_hour, end_hour = 11, 17
-    elif st.session_state.time_preference == "Evening":
-        start_hour, end_hour = 17, 19
+
+    # The appointment is saved by the Book button callback, together with the slot claim
+    booking_result = st.session_state.get("booking_result")
+    if booking_result and booking_result.reserved:
+        st.success(t("booking_success").format(slot_id=booking_result.slot_id))
+        if st.session_state.responses.get('emergency_contraception') == t("yes"):
+            st.markdown("[Click here for more information on emergency contraception](https://www.nhs.uk/contraception/emergency-contraception/)")
     else:
-        start_hour, end_hour = 8, 19
-
-    available_slots = []
-    for hour in range(start_hour, end_hour):
-        for minute in range(0, 60, 15):
-            time_str = f"{hour:02}:{minute:02}"
-            # Match by priority and consultation mode
-            c.execute('''SELECT id, clinic, time FROM available_slots 
-                        WHERE clinic = ? AND time = ? 
-                          AND priority = ? 
-                          AND mode_of_consultation = ? 
-                          AND is_booked = 0''',
-                      (st.session_state.clinic, time_str, 
-                       st.session_state.priority, 
-                       st.session_state.mode_of_consultation))
-            slots = c.fetchall()
-            available_slots.extend(slots)
-
-    if available_slots:
-        st.write(t("available_slots"))
-        slot_options = {slot[0]: f"Clinic: {slot[1]}, Time: {slot[2]}" for slot in available_slots}
-        selected_slot_id = st.selectbox(t("select_slot"), list(slot_options.keys()),
-                                        format_func=lambda x: slot_options[x])
-        if st.button(t("book")):
-            c.execute("UPDATE available_slots SET is_booked = 1 WHERE id = ?", (selected_slot_id,))
-            conn.commit()
-            st.success(t("booking_success").format(slot_id=selected_slot_id))
-            if st.session_state.responses.get('emergency_contraception') == t("yes"):
-                st.markdown("[Click here for more information on emergency contraception](https://www.nhs.uk/contraception/emergency-contraception/)")
+        st.write(t("choose_slot"))
+        # Determine time range based on time preference
+        start_hour, end_hour = time_window(st.session_state.time_preference)
+
+        # Free capacity this priority may book, earliest first: its own slots, less pressing
+        # priorities' slots, and urgent slots nobody has taken close to their start
+        available_slots = get_repository().find_pooled_slots(st.session_state.clinic,
+                                                             st.session_state.priority,
+                                                             st.session_state.mode_of_consultation,
+                                                             start_hour, end_hour)
+        # The earliest slots at the other clinics or outside the preferred hours, in one query
+        alternative_slots = get_repository().find_alternative_slots(st.session_state.clinic,
+                                                                    st.session_state.priority,
+                                                                    st.session_state.mode_of_consultation,
+                                                                    start_hour, end_hour)
+
+        if available_slots or alternative_slots:
+            # Another patient claimed the slot we tried to book; the next nearest one is preselected
+            if booking_result:
+                st.warning(t("slot_conflict"))
+            if not available_slots:
+                st.info(t("alternative_slots_only"))
+            st.write(t("available_slots"))
+            slot_options = {slot[0]: f"Clinic: {slot[1]}, Date: {slot[2]}, Time: {slot[3]}" for slot in available_slots}
+            slot_options.update({slot[0]: f"Clinic: {slot[1]}, Date: {slot[2]}, Time: {slot[3]} "
+                                          f"({t('alternative_slot')})" for slot in alternative_slots})
+            if st.session_state.get("selected_slot_id") not in slot_options:
+                st.session_state.pop("selected_slot_id", None)
+            st.selectbox(t("select_slot"), list(slot_options.keys()),
+                         format_func=lambda x: slot_options[x], key="selected_slot_id")
+            st.button(t("book"), on_click=book_selected_slot)
+        else:
+            st.warning(t("no_slots"))
+
+# Checkpoint after every run that changed the saved keys. Runs cut short by st.rerun() are
+# covered by the run that follows, which renders the new step.
+if session_store():
+    booking_result = st.session_state.get("booking_result")
+    if booking_result and booking_result.reserved:
+        # Nothing is left to resume once booked, so the patient's answers are not kept for the TTL
+        if st.session_state.saved_session is not None:
+            session_store().delete(st.session_state.resume_token)
+            st.session_state.saved_session = None
     else:
-        st.warning(t("no_slots"))
-    conn.close()
\ No newline at end of file
+        session_payload = encode_session(st.session_state)
+        if session_payload != st.session_state.saved_session:
+            session_store().save(st.session_state.resume_token, session_payload)
+            st.session_state.saved_session = session_payload
+
+st.session_state.run_timer.stop()
@@ -1,52 +1,75 @@
-import sqlite3
+from datetime import date
+
 import pandas as pd
 import streamlit as st
-from openai import OpenAI
-import os
+import metrics
+from db import connection, init_db
+from i18n import available_languages, translate
+from llm import LLMUnavailableError, get_gateway
+from profiles import build_profile_prompt, profile_summary
+from slots import CLINIC_LOCATIONS, SLOT_PRIORITIES
+from storage import get_repository
+from translation import free_text_answers, translate_answers, translation_cache
+from triage import triage_cache
+
+@st.cache_resource
+def prepare_database():
+    with connection() as conn:
+        init_db(conn)
+    get_repository().init_schema()
 
-def get_db_connection():
-    return sqlite3.connect('appointments.db')
+PAGE_SIZE = 25
 
-def fetch_appointments():
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM appointments", conn)
-    conn.close()
-    return df
+def fetch_appointment_page(before_id, priority, clinic, booked_from, booked_to):
+    """Returns (rows, has_next_page) for one page of the filtered patient list."""
+    rows = get_repository().list_appointments(PAGE_SIZE + 1, before_id, priority, clinic, booked_from, booked_to)
+    return rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
 
 def fetch_appointment_by_id(appointment_id):
-    conn = get_db_connection()
-    df = pd.read_sql_query(f"SELECT * FROM appointments WHERE id = {appointment_id}", conn)
-    conn.close()
-    return df
+    return get_repository().get_appointment(appointment_id)
 
-gemini_model = "gemini-2.0-flash"
-gemini_api_key = os.getenv("GEMINI_API_KEY")
-google_client = OpenAI(api_key=gemini_api_key, base_url="https://generativelanguage.googleapis.com/v1beta/openai/")
+def fetch_stored_profile(appointment_id, language):
+    return get_repository().get_stored_profile(appointment_id, language)
 
-# Language Support
-TRANSLATIONS = {
-    "English": {
-        "page_title": "Saved Appointments",
-        "sidebar_title": "Appointment Service",
-        "select_patient": "Select a patient",
-        "patient_summary": "Patient Summary",
-        "format_profile": "Format Patient Profile",
-        "formatted_profile": "Formatted Patient Profile",
-        "no_appointments": "No appointments found."
-    },
-    "Français": {
-        "page_title": "Rendez-vous Enregistrés",
-        "sidebar_title": "Service de Rendez-vous",
-        "select_patient": "Sélectionnez un patient",
-        "patient_summary": "Résumé du Patient",
-        "format_profile": "Formater le Profil du Patient",
-        "formatted_profile": "Profil du Patient Formaté",
-        "no_appointments": "Aucun rendez-vous trouvé."
+def save_profile(appointment, language, formatted_profile):
+    get_repository().store_profile(appointment["id"], language, appointment["row_version"], formatted_profile)
+
+def fetch_translated_answers(appointment, language):
+    """Free-text answers in language, remembered per session so reruns don't count as cache hits."""
+    memo_key = (appointment["id"], appointment["row_version"], language)
+    if memo_key not in st.session_state.translated_answers:
+        st.session_state.translated_answers[memo_key] = translate_answers(
+            appointment, language, get_gateway().complete, connection)
+    return st.session_state.translated_answers[memo_key]
+
+def fetch_capacity(day, clinic):
+    """Free and booked slot counts per clinic, hour and priority on day."""
+    return get_repository().availability_summary(day, clinic=clinic)
+
+# Whole-table aggregates; recomputed at most this often instead of on every click
+SIDEBAR_STATS_TTL_SECONDS = 30
+
+@st.cache_data(ttl=SIDEBAR_STATS_TTL_SECONDS, show_spinner=False)
+def fetch_sidebar_stats():
+    """Triage, profile and translation cache figures for the sidebar, shared by all sessions."""
+    with connection() as conn:
+        triage_stats = triage_cache.stats(conn)
+        translation_stats = translation_cache.stats(conn)
+    return {
+        "triage_cache": triage_stats,
+        "triage_sources": get_repository().triage_source_counts(),
+        "profile_progress": get_repository().profile_job_progress(),
+        "translation_cache": translation_stats,
     }
-}
+
+def reset_pagination():
+    st.session_state.page_cursors = []
+
+
+# Language Support
 
 def t(key):
-    return TRANSLATIONS[st.session_state.language].get(key, key)
+    return translate("clinician", st.session_state.language, key)
 
 # Session state initialization
 if "language" not in st.session_state:
@@ -55,6 +78,19 @@ if "language" not in st.session_state:
 if "confirmed_summary" not in st.session_state:
     st.session_state.confirmed_summary = False
 
+if "page_cursors" not in st.session_state:
+    st.session_state.page_cursors = []  # before_id of every page visited after the first
+
+if "translated_answers" not in st.session_state:
+    st.session_state.translated_answers = {}  # (appointment id, row_version, language) -> {field: text}
+
+# Time this script run; one left unfinished by st.rerun() ends now, as the rerun starts at once
+if "run_timer" in st.session_state:
+    st.session_state.run_timer.stop()
+st.session_state.run_timer = metrics.start_timer("script_run_seconds", app="clinician",
+                                                 step="profile" if st.session_state.confirmed_summary else "list")
+metrics.start_server()
+
 # Sidebar and header
 st.sidebar.image(
     r"Logo.png",
@@ -82,40 +118,130 @@ st.sidebar.title(t("sidebar_title"))
 # Language selector
 language_selector = st.sidebar.selectbox(
     "Language / Langue / Idioma / Sprache:",
-    list(TRANSLATIONS.keys()),
+    list(available_languages("clinician")),
     key="language_selector",
     on_change=lambda: setattr(st.session_state, "language", st.session_state.language_selector)
 )
 
+prepare_database()
+sidebar_stats = fetch_sidebar_stats()
+
+# How many LLM calls the patient app's triage rules and cache have saved so far
+cache_stats = sidebar_stats["triage_cache"]
+source_counts = sidebar_stats["triage_sources"]
+triaged = sum(source_counts.values())
+without_llm = sum(count for source, count in source_counts.items() if not source.startswith("llm"))
+st.sidebar.subheader(t("triage_cache"))
+st.sidebar.metric(t("decided_without_llm"), f"{without_llm / triaged:.0%}" if triaged else "-")
+st.sidebar.metric(t("llm_calls_saved"), cache_stats["llm_calls_saved"])
+st.sidebar.metric(t("llm_seconds_saved"), f"{cache_stats['llm_seconds_saved']:.1f}s")
+
+# Profiles pre-formatted by profile_worker.py for the current version of each appointment
+profile_progress = sidebar_stats["profile_progress"]
+st.sidebar.metric(t("profiles_ready"), f"{profile_progress.get('done', 0)}/{sum(profile_progress.values())}")
+
+# Free-text answers translated into clinicians' languages, each text at most once per language
+translation_stats = sidebar_stats["translation_cache"]
+st.sidebar.subheader(t("translation_cache"))
+st.sidebar.metric(t("translation_hit_rate"), f"{translation_stats['hit_rate']:.0%}"
+                  if translation_stats["hits"] + translation_stats["misses"] else "-")
+st.sidebar.metric(t("translations_cached"), f"{translation_stats['entries']} "
+                  f"({translation_stats['bytes'] / 1024:.1f} KiB)")
+
 if not st.session_state.confirmed_summary:
     st.title(t("page_title"))
 
-appointments_df = fetch_appointments()
-if not appointments_df.empty:
+# Patient list filters; changing any of them goes back to the first page
+st.sidebar.subheader(t("filters"))
+filter_priority = st.sidebar.selectbox(t("filter_priority"), [None] + SLOT_PRIORITIES,
+                                       format_func=lambda x: t("all") if x is None else x,
+                                       on_change=reset_pagination)
+filter_clinic = st.sidebar.selectbox(t("filter_clinic"), [None] + CLINIC_LOCATIONS,
+                                     format_func=lambda x: t("all") if x is None else x,
+                                     on_change=reset_pagination)
+booked_dates = st.sidebar.date_input(t("filter_booked"), value=(), format="DD/MM/YYYY",
+                                     on_change=reset_pagination)
+booked_from = booked_dates[0] if len(booked_dates) > 0 else None
+booked_to = booked_dates[1] if len(booked_dates) > 1 else booked_from
+
+# Free and booked slots per hour, read from counters the booking triggers keep current
+if not st.session_state.confirmed_summary:
+    with st.expander(t("clinic_capacity")):
+        capacity_day = st.date_input(t("capacity_date"), value=date.today(), format="DD/MM/YYYY")
+        capacity = pd.DataFrame(fetch_capacity(capacity_day, filter_clinic),
+                                columns=["slot_date", "clinic", "hour", "priority", "free", "booked"])
+        if capacity.empty:
+            st.write(t("no_capacity"))
+        else:
+            free_column, booked_column = st.columns(2)
+            free_column.metric(t("free_slots"), int(capacity["free"].sum()))
+            booked_column.metric(t("booked_slots"), int(capacity["booked"].sum()))
+            capacity["hour"] = capacity["hour"].map("{:02d}:00".format)
+            free_by_priority = capacity.pivot_table(index=["clinic", "hour"], columns="priority", values="free",
+                                                    aggfunc="sum", fill_value=0)
+            free_by_priority = free_by_priority.reindex(columns=[p for p in SLOT_PRIORITIES
+                                                                 if p in free_by_priority.columns])
+            free_by_priority.index.names = [t("capacity_clinic"), t("capacity_hour")]
+            with metrics.timer("dataframe_render_seconds", view="clinic_capacity"):
+                st.dataframe(free_by_priority)
+
+before_id = st.session_state.page_cursors[-1] if st.session_state.page_cursors else None
+page_rows, has_next_page = fetch_appointment_page(before_id, filter_priority, filter_clinic, booked_from, booked_to)
+if page_rows:
     if "confirmed_summary" not in st.session_state:
         st.session_state.confirmed_summary = False
 
     if not st.session_state.confirmed_summary:
-        appointment_id = st.selectbox(t("select_patient"), appointments_df['id'])
+        patient_labels = {row[0]: f"#{row[0]} {row[1]} ({row[2]})" for row in page_rows}
+        appointment_id = st.selectbox(t("select_patient"), list(patient_labels.keys()),
+                                      format_func=lambda x: patient_labels[x])
+
+        previous_column, next_column = st.columns(2)
+        if st.session_state.page_cursors and previous_column.button(t("previous_page")):
+            st.session_state.page_cursors.pop()
+            st.rerun()
+        if has_next_page and next_column.button(t("next_page")):
+            st.session_state.page_cursors.append(page_rows[-1][0])
+            st.rerun()
+
         if appointment_id:
             selected_appointment = fetch_appointment_by_id(appointment_id)
             st.subheader(t("patient_summary"))
-            st.write(selected_appointment)
+            with metrics.timer("dataframe_render_seconds", view="patient_summary"):
+                st.write(pd.DataFrame([selected_appointment]))
+
+            if free_text_answers(selected_appointment):
+                st.subheader(t("translated_answers"))
+                try:
+                    with st.spinner(t("translating")):
+                        translated_answers = fetch_translated_answers(selected_appointment, st.session_state.language)
+                except LLMUnavailableError:
+                    st.warning(t("translation_unavailable"))
+                    translated_answers = free_text_answers(selected_appointment)
+                for field, text in translated_answers.items():
+                    st.markdown(f"**{t(field)}:** {text}")
             
             if st.button(t("format_profile")):
-                patient_summary = selected_appointment.to_string(index=False)
-                prompt = f"Format the following patient's profile in a neat and concise way:\n{patient_summary}"
-                if st.session_state.language == "Français":
-                    prompt = f"Formatez le profil du patient suivant de manière soignée et concise:\n{patient_summary}"
-                response = google_client.chat.completions.create(
-                    model=gemini_model,
-                    messages=[{"role": "user", "content": prompt}]
-                )
-                st.session_state.formatted_profile = response.choices[0].message.content.strip()
-                st.session_state.confirmed_summary = True
-                st.rerun()
+                # Normally ready already; only format on demand if the worker hasn't got to it yet
+                formatted_profile = fetch_stored_profile(appointment_id, st.session_state.language)
+                if formatted_profile is None:
+                    prompt = build_profile_prompt(profile_summary(selected_appointment), st.session_state.language)
+                    st.subheader(t("formatted_profile"))
+                    try:
+                        # Render tokens as they arrive; time to first token is what clinicians notice
+                        formatted_profile = st.write_stream(
+                            get_gateway().stream([{"role": "user", "content": prompt}])).strip()
+                        save_profile(selected_appointment, st.session_state.language, formatted_profile)
+                    except LLMUnavailableError:
+                        st.error(t("llm_unavailable"))
+                if formatted_profile is not None:
+                    st.session_state.formatted_profile = formatted_profile
+                    st.session_state.confirmed_summary = True
+                    st.rerun()
     else:
         st.subheader(t("formatted_profile"))
         st.write(st.session_state.formatted_profile)
 else:
     st.write(t("no_appointments"))
+
+st.session_state.run_timer.stop()
@@ -0,0 +1,184 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import metrics
+from slots import ReservationResult, claim_slot, next_pooled_slot
+
+##############################################
+# Appointment Persistence
+##############################################
+
+# Columns written straight from the appointment dict; priority and clinic are
+# stored as ids in the priorities and clinics lookup tables.
+APPOINTMENT_COLUMNS = [
+    "name", "time_preference", "mode_of_consultation", "phone_number", "answers",
+    "date_of_birth", "has_symptoms", "emergency_contraception", "needs_translator",
+    "translator_language", "triage_source",
+]
+
+
+def create_appointments_table(conn, table="appointments"):
+    """Creates the appointments table.
+
+    answers is the questionnaire as a JSON object; age and gender are generated
+    from it so they can be indexed. has_symptoms, emergency_contraception and
+    needs_translator are 0/1 flags and date_of_birth is an ISO date.
+    """
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     name TEXT,
+                     priority_id INTEGER REFERENCES priorities (id),
+                     clinic_id INTEGER REFERENCES clinics (id),
+                     time_preference TEXT,
+                     mode_of_consultation TEXT,
+                     phone_number TEXT,
+                     answers TEXT,
+                     date_of_birth TEXT,
+                     has_symptoms INTEGER,
+                     emergency_contraception INTEGER,
+                     needs_translator INTEGER,
+                     translator_language TEXT,
+                     submission_token TEXT,
+                     slot_id INTEGER,
+                     triage_source TEXT,
+                     created_at TEXT,
+                     row_version INTEGER DEFAULT 1,
+                     age INTEGER GENERATED ALWAYS AS (json_extract(answers, '$.age')) VIRTUAL,
+                     gender TEXT GENERATED ALWAYS AS (json_extract(answers, '$.gender')) VIRTUAL
+                     )''')
+
+
+def create_appointment_indexes(conn):
+    """Creates the appointments indexes and the row_version trigger. Does not commit."""
+    # Any edit to an appointment bumps its version, so profiles formatted from the old row are ignored
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_appointments_row_version
+                    AFTER UPDATE ON appointments
+                    WHEN NEW.row_version IS OLD.row_version
+                    BEGIN
+                        UPDATE appointments SET row_version = OLD.row_version + 1 WHERE id = NEW.id;
+                    END''')
+    # One row per submitted booking form, however many times Streamlit reruns the page
+    conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_submission_token
+                    ON appointments (submission_token)''')
+    # Clinician list filters, each ending in id so keyset pagination stays an index range scan
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_priority ON appointments (priority_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_clinic ON appointments (clinic_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_created_at ON appointments (created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_age ON appointments (age)")
+
+
+def find_booking(conn, submission_token):
+    """Returns the slot_id already booked under submission_token, or None."""
+    row = conn.execute("SELECT slot_id FROM appointments WHERE submission_token = ?",
+                       (submission_token,)).fetchone()
+    return row[0] if row else None
+
+
+@metrics.timed("db_query_seconds", query="book_appointment")
+def book_appointment(conn, submission_token, appointment, slot_id):
+    """Claims slot_id and inserts the appointment row in one transaction.
+
+    appointment maps APPOINTMENT_COLUMNS, "priority" and "clinic" to values. The
+    call is idempotent per submission_token: a repeated submission returns the
+    original booking instead of writing a second row. Returns a ReservationResult.
+    """
+    booked_slot_id = find_booking(conn, submission_token)
+    if booked_slot_id is not None:
+        metrics.increment("bookings_total", result="duplicate")
+        return ReservationResult(True, booked_slot_id, None)
+
+    # Take the write lock up front so the claim and the insert commit together
+    with metrics.timer("sqlite_lock_wait_seconds", operation="book_appointment"):
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not claim_slot(conn, slot_id):
+            conn.rollback()
+            metrics.increment("bookings_total", result="conflict")
+            return ReservationResult(False, slot_id, next_pooled_slot(conn, slot_id, appointment.get("priority")))
+        columns = APPOINTMENT_COLUMNS + ["submission_token", "slot_id", "created_at"]
+        values = [appointment.get(column) for column in APPOINTMENT_COLUMNS] + [
+            submission_token, slot_id, datetime.now().isoformat(sep=" ", timespec="seconds")]
+        conn.execute(f'''INSERT INTO appointments ({", ".join(columns)}, priority_id, clinic_id)
+                         VALUES ({", ".join("?" * len(columns))},
+                                 (SELECT id FROM priorities WHERE name = ?),
+                                 (SELECT id FROM clinics WHERE name = ?))''',
+                     values + [appointment.get("priority"), appointment.get("clinic")])
+        conn.commit()
+    except sqlite3.IntegrityError:
+        # The same submission won a race on another connection; keep its booking
+        conn.rollback()
+        metrics.increment("bookings_total", result="duplicate")
+        return ReservationResult(True, find_booking(conn, submission_token), None)
+    except Exception:
+        conn.rollback()
+        raise
+    metrics.increment("bookings_total", result="reserved")
+    return ReservationResult(True, slot_id, None)
+
+
+def triage_source_counts(conn):
+    """Returns {triage_source: appointments} over all saved appointments."""
+    return dict(conn.execute('''SELECT COALESCE(triage_source, 'unknown'), COUNT(*)
+                                FROM appointments GROUP BY 1''').fetchall())
+
+##############################################
+# Clinician Queries
+##############################################
+
+# Only what the patient picker needs; the full row is loaded by get_appointment
+APPOINTMENT_LIST_COLUMNS = ["a.id", "a.name", "p.name", "c.name", "a.created_at"]
+
+# Appointments (aliased a) with their priority and clinic names
+APPOINTMENT_JOIN_SQL = '''appointments AS a
+                          LEFT JOIN priorities AS p ON p.id = a.priority_id
+                          LEFT JOIN clinics AS c ON c.id = a.clinic_id'''
+
+
+@metrics.timed("db_query_seconds", query="list_appointments")
+def list_appointments(conn, page_size=25, before_id=None, priority=None, clinic=None,
+                      booked_from=None, booked_to=None):
+    """Returns one page of appointments, newest first, as (id, name, priority, clinic, created_at) rows.
+
+    Keyset pagination: pass the last id of the previous page as before_id. The
+    optional filters match priority and clinic exactly and limit created_at to
+    the dates booked_from..booked_to inclusive.
+    """
+    conditions = []
+    params = []
+    if before_id is not None:
+        conditions.append("a.id < ?")
+        params.append(before_id)
+    if priority:
+        conditions.append("a.priority_id = (SELECT id FROM priorities WHERE name = ?)")
+        params.append(priority)
+    if clinic:
+        conditions.append("a.clinic_id = (SELECT id FROM clinics WHERE name = ?)")
+        params.append(clinic)
+    if booked_from:
+        conditions.append("a.created_at >= ?")
+        params.append(booked_from.isoformat())
+    if booked_to:
+        conditions.append("a.created_at < ?")
+        params.append((booked_to + timedelta(days=1)).isoformat())
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    c = conn.execute(f'''SELECT {", ".join(APPOINTMENT_LIST_COLUMNS)} FROM {APPOINTMENT_JOIN_SQL}
+                          {where}
+                          ORDER BY a.id DESC
+                          LIMIT ?''', params + [page_size])
+    return c.fetchall()
+
+
+@metrics.timed("db_query_seconds", query="get_appointment")
+def get_appointment(conn, appointment_id):
+    """Returns the full appointments row as a {column: value} dict, or None.
+
+    Lookup ids are replaced by the priority and clinic names.
+    """
+    c = conn.execute(f'''SELECT a.*, p.name AS priority, c.name AS clinic FROM {APPOINTMENT_JOIN_SQL}
+                          WHERE a.id = ?''', (appointment_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    appointment = dict(zip([column[0] for column in c.description], row))
+    del appointment["priority_id"], appointment["clinic_id"]
+    return appointment
@@ -0,0 +1,200 @@
+"""Triages questionnaires in bulk, outside the Streamlit flow.
+
+Reads CSV or JSONL records whose columns are the questionnaire answers app.py
+collects (name, date_of_birth, age, gender, has_symptoms, symptoms, ...), plus an
+optional id and language. Every record goes through classify_patient, so the
+fast-path rules, triage cache, prompt, priority parsing and fallback are exactly
+those of step 14. Results are appended to a JSONL file as they complete; run
+the same command again after an interruption and finished records are skipped.
+Records the LLM could not classify, or that raised an error, are written to a
+retry file next to the output instead, so the next run tries them again.
+
+    python batch_triage.py referrals.csv --output triaged.jsonl --concurrency 8
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from db import DB_PATH, connection, init_db
+from i18n import DEFAULT_LANGUAGE, LANGUAGES, translate
+from triage import classify_patient, generate_openai_response
+
+##############################################
+# Input Records
+##############################################
+
+def read_records(path, input_format=None):
+    """Yields each record of a CSV or JSONL file as a dict, leaving out empty CSV cells."""
+    input_format = input_format or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    with open(path, newline="", encoding="utf-8") as f:
+        if input_format == "csv":
+            for row in csv.DictReader(f):
+                yield {column: value for column, value in row.items() if column and value not in ("", None)}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def record_id(record, number, id_field):
+    """The record's id_field value, or its 1-based position in the input when it has none."""
+    value = record.get(id_field)
+    return str(value) if value not in (None, "") else str(number)
+
+
+def answer_is_yes(value, language):
+    """Same test as app.py's triage_flags(): the answer is exactly "Yes" in the patient's language.
+
+    Other spellings ("1", "true", "y", or "Yes" in a record whose language is
+    Français) count as no, just as they would in the app.
+    """
+    return value == translate("patient", language, "yes")
+
+
+def record_responses(record, id_field):
+    """Splits a record into (responses as app.py would hold them, has_symptoms, needs_contraception)."""
+    language = record.get("language") if record.get("language") in LANGUAGES else DEFAULT_LANGUAGE
+    responses = {field: value for field, value in record.items() if field not in (id_field, "language")}
+    return (responses, answer_is_yes(responses.get("has_symptoms"), language),
+            answer_is_yes(responses.get("emergency_contraception"), language))
+
+##############################################
+# Resumable Output
+##############################################
+
+def completed_ids(output_path):
+    """Returns the ids already in output_path, dropping a last line cut off by an interruption."""
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    return {json.loads(line)["id"] for line in data.decode("utf-8").splitlines() if line.strip()}
+
+
+def retry_path(output_path):
+    """Where records to retry are listed: triaged.jsonl -> triaged.retry.jsonl."""
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.retry{ext or '.jsonl'}"
+
+
+# Row sources that are not final: the record is left out of the output and retried on the next run
+RETRY_SOURCES = {"unavailable+fallback", "error"}
+
+
+def triage_record(record_key, responses, has_symptoms, needs_contraception, db_path):
+    """Classifies one record and returns its output row; an exception becomes a row with source "error"."""
+    started = time.perf_counter()
+    cache_connection = (lambda: connection(db_path)) if db_path else None
+    try:
+        decision = classify_patient(responses, has_symptoms, needs_contraception, generate_openai_response,
+                                    cache_connection=cache_connection)
+    except Exception as e:
+        return {"id": record_key, "priority": None, "source": "error", "error": f"{type(e).__name__}: {e}",
+                "seconds": round(time.perf_counter() - started, 3)}
+    return {
+        "id": record_key,
+        "priority": decision.priority,
+        "source": decision.source,
+        "confidence": decision.confidence,
+        "response": decision.response,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+##############################################
+# Batch Runner
+##############################################
+
+def run_batch(input_path, output_path, concurrency=8, id_field="id", input_format=None, db_path=DB_PATH,
+              progress_seconds=5.0):
+    """Triages every record of input_path not yet in output_path. Returns Counter of row sources.
+
+    Rows whose source is in RETRY_SOURCES go to retry_path(output_path), which
+    each run rewrites, rather than to output_path. At most 2 x concurrency
+    records are read ahead of the workers, so memory use does not grow with the
+    input size.
+    """
+    if db_path:
+        with connection(db_path) as conn:
+            init_db(conn)
+    done = completed_ids(output_path)
+    sources = Counter()
+    skipped = 0
+    started = last_report = time.perf_counter()
+
+    def report(final=None):
+        elapsed = time.perf_counter() - started
+        written = sum(sources.values())
+        to_retry = sum(sources[source] for source in RETRY_SOURCES)
+        print(f"{final + ': ' if final else ''}{written} triaged, {skipped} already done, "
+              f"{written / elapsed if elapsed else 0:.1f} records/s"
+              + (" (" + ", ".join(f"{s}: {n}" for s, n in sources.most_common()) + ")" if final else "")
+              + (f"; {to_retry} to retry, listed in {retry_path(output_path)}" if final and to_retry else ""),
+              file=sys.stderr, flush=True)
+
+    with open(output_path, "a", encoding="utf-8") as output, \
+            open(retry_path(output_path), "w", encoding="utf-8") as retries, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-triage") as pool:
+        pending = set()
+
+        def drain(return_when):
+            nonlocal pending, last_report
+            finished, pending = wait(pending, return_when=return_when)
+            for future in finished:
+                row = future.result()
+                target = retries if row["source"] in RETRY_SOURCES else output
+                target.write(json.dumps(row, ensure_ascii=False) + "\n")
+                sources[row["source"]] += 1
+            output.flush()
+            retries.flush()
+            if time.perf_counter() - last_report >= progress_seconds:
+                last_report = time.perf_counter()
+                report()
+
+        outcome = "Stopped"
+        try:
+            for number, record in enumerate(read_records(input_path, input_format), start=1):
+                key = record_id(record, number, id_field)
+                if key in done:
+                    skipped += 1
+                    continue
+                done.add(key)
+                pending.add(pool.submit(triage_record, key, *record_responses(record, id_field), db_path))
+                if len(pending) >= 2 * concurrency:
+                    drain(FIRST_COMPLETED)
+            while pending:
+                drain(FIRST_COMPLETED)
+            outcome = "Done"
+        except KeyboardInterrupt:
+            # Keep what finished; unstarted records are picked up on the next run
+            for future in pending:
+                future.cancel()
+            print("Interrupted; run again to resume.", file=sys.stderr)
+            raise
+        finally:
+            report(final=outcome)
+    return sources
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Triage questionnaire records from a CSV or JSONL file.")
+    parser.add_argument("input")
+    parser.add_argument("--output", required=True, help="JSONL results file; appended to, and used to resume")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="default: from the input file extension")
+    parser.add_argument("--id-field", default="id", help="record field identifying it (default: id)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--db", default=DB_PATH, help="database holding the triage cache")
+    parser.add_argument("--no-cache", action="store_true", help="classify every record afresh")
+    args = parser.parse_args()
+    try:
+        run_batch(args.input, args.output, args.concurrency, args.id_field, args.format,
+                  None if args.no_cache else args.db)
+    except KeyboardInterrupt:
+        sys.exit(130)
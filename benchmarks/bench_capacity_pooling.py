@@ -0,0 +1,112 @@
+"""Capacity pooling simulation: utilization and urgent waits under synthetic demand.
+
+Patients arrive at random times over --days days with a fixed mix of
+priorities, and each books the earliest slot that find_pooled_slots offers them
+at one clinic. The same arrivals are replayed under strict per-priority
+partitions and under pooling with several urgent reserve cutoffs. Reports the
+share of slots used over the arrival period, how many patients found no slot
+within the booking horizon, and waits from arrival to appointment.
+
+Usage:
+    python benchmarks/bench_capacity_pooling.py [--days 14] [--patients-per-day 160] [--urgent-share 0.15]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from slots import (CLINIC_LOCATIONS, CLOSING_MINUTE, OPENING_MINUTE, POOLED_POLICY, SLOT_HORIZON_DAYS,  # noqa: E402
+                   SLOT_MODE, STRICT_POLICY, claim_slot, find_pooled_slots, generate_slot_calendar,
+                   init_lookup_tables, init_slot_table)
+
+CLINIC = CLINIC_LOCATIONS[0]
+START = datetime.combine(date.today(), datetime.min.time())
+
+
+def policies(cutoffs):
+    yield "strict", STRICT_POLICY
+    for hours in cutoffs:
+        yield f"pooled, {hours:g}h reserve", POOLED_POLICY._replace(reserve_cutoff_hours=hours)
+
+
+def arrivals(args):
+    """Returns [(arrival datetime, priority)] in arrival order, the same for every policy."""
+    rng = random.Random(args.seed)
+    rest = (1 - args.urgent_share) / 3
+    mix = {"Urgent": args.urgent_share, "Contraception Referral": rest,
+           "Routine Symptoms": rest, "Routine No Symptoms": rest}
+    patients = []
+    for day in range(args.days):
+        for _ in range(args.patients_per_day):
+            minute = rng.uniform(OPENING_MINUTE - 120, CLOSING_MINUTE)
+            priority = rng.choices(list(mix), weights=list(mix.values()))[0]
+            patients.append((START + timedelta(days=day, minutes=minute), priority))
+    return sorted(patients)
+
+
+def simulate(policy, patients, args):
+    conn = sqlite3.connect(":memory:")
+    init_lookup_tables(conn)
+    init_slot_table(conn)
+    # Later arrivals still see a full booking horizon ahead of them
+    generate_slot_calendar(conn, [CLINIC], args.days + SLOT_HORIZON_DAYS, start_date=START.date())
+    waits = defaultdict(list)
+    turned_away = Counter()
+    search_seconds = []
+    for arrived, priority in patients:
+        started = time.perf_counter()
+        found = find_pooled_slots(conn, CLINIC, priority, SLOT_MODE, 0, 24, now=arrived, policy=policy, limit=1)
+        search_seconds.append(time.perf_counter() - started)
+        if not found:
+            turned_away[priority] += 1
+            continue
+        slot_id, _, slot_date, slot_time = found[0]
+        claim_slot(conn, slot_id)
+        conn.commit()
+        hours, minutes = map(int, slot_time.split(":"))
+        starts = datetime.fromisoformat(slot_date) + timedelta(hours=hours, minutes=minutes)
+        waits[priority].append((starts - arrived).total_seconds() / 3600)
+
+    period_end = (START + timedelta(days=args.days)).date().isoformat()
+    booked, total = conn.execute("SELECT SUM(is_booked), COUNT(*) FROM available_slots WHERE slot_date < ?",
+                                 (period_end,)).fetchone()
+    conn.close()
+    return {"utilization": booked / total, "turned_away": turned_away, "waits": waits,
+            "search_ms": sorted(search_seconds)[len(search_seconds) // 2] * 1000}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=14, help="days over which patients arrive")
+    parser.add_argument("--patients-per-day", type=int, default=160, help="one clinic has 176 slots a day")
+    parser.add_argument("--urgent-share", type=float, default=0.15)
+    parser.add_argument("--cutoffs", type=float, nargs="+", default=[0, 4, 24],
+                        help="urgent reserve cutoffs to compare, in hours")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    patients = arrivals(args)
+    print(f"{len(patients)} patients over {args.days} days at one clinic, {args.urgent_share:.0%} urgent")
+    print(f"{'policy':<22} {'used':>6} {'no slot':>8} {'urgent':>8} {'urgent p50 h':>13} {'urgent p95 h':>13} "
+          f"{'other p50 h':>12} {'search ms':>10}")
+    for name, policy in policies(args.cutoffs):
+        r = simulate(policy, patients, args)
+        other = [w for priority, samples in r["waits"].items() if priority != "Urgent" for w in samples]
+        print(f"{name:<22} {r['utilization']:>6.1%} {sum(r['turned_away'].values()):>8} "
+              f"{r['turned_away']['Urgent']:>8} {percentile(r['waits']['Urgent'], 50):>13.1f} "
+              f"{percentile(r['waits']['Urgent'], 95):>13.1f} {percentile(other, 50):>12.1f} {r['search_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""LLM gateway behaviour under injected latency and errors, against the local stub server.
+
+For each scenario, fires concurrent completions through a fresh LLMGateway and
+reports how many succeeded, how many fell back (and how many of those were
+short-circuited by the breaker), latency percentiles and upstream requests sent.
+
+Usage:
+    python benchmarks/bench_llm_gateway.py [--calls 200] [--concurrency 16] [--deadline 2.0]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import OpenAI  # noqa: E402
+
+from llm import CircuitBreaker, CircuitOpenError, LLMGateway, LLMUnavailableError  # noqa: E402
+from stub_llm_server import StubConfig, start_stub_server  # noqa: E402
+
+SCENARIOS = [
+    # name, latency ms, jitter ms, error rate, hang rate
+    ("healthy", 50, 20, 0.0, 0.0),
+    ("slow", 1500, 1000, 0.0, 0.0),
+    ("flaky", 50, 20, 0.3, 0.0),
+    ("hanging", 50, 20, 0.0, 0.2),
+    ("outage", 50, 20, 1.0, 0.0),
+]
+
+
+def run_scenario(base_url, config, args):
+    client = OpenAI(api_key="stub", base_url=base_url, max_retries=0)
+    gateway = LLMGateway(client=client, model="stub", deadline_seconds=args.deadline, max_retries=2,
+                         backoff_base=0.05, max_concurrency=args.concurrency,
+                         breaker=CircuitBreaker(failure_threshold=5, reset_seconds=1.0))
+    messages = [{"role": "user", "content": "Classify this patient."}]
+
+    def call(_):
+        start = time.perf_counter()
+        try:
+            gateway.complete(messages)
+            outcome = "ok"
+        except CircuitOpenError:
+            outcome = "breaker"
+        except LLMUnavailableError:
+            outcome = "fallback"
+        return outcome, (time.perf_counter() - start) * 1000
+
+    config.requests = 0
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(call, range(args.calls)))
+    latencies = sorted(ms for _, ms in results)
+    outcomes = [outcome for outcome, _ in results]
+    return {
+        "ok": outcomes.count("ok"),
+        "fallback": outcomes.count("fallback") + outcomes.count("breaker"),
+        "breaker": outcomes.count("breaker"),
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "upstream": config.requests,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--deadline", type=float, default=2.0)
+    args = parser.parse_args()
+
+    config = StubConfig()
+    server, base_url = start_stub_server(config)
+    print(f"{'scenario':<10} {'ok':>5} {'fallback':>9} {'breaker':>8} {'p50 ms':>9} {'p99 ms':>9} {'upstream':>9}")
+    for name, latency_ms, jitter_ms, error_rate, hang_rate in SCENARIOS:
+        config.latency_ms, config.jitter_ms = latency_ms, jitter_ms
+        config.error_rate, config.hang_rate = error_rate, hang_rate
+        r = run_scenario(base_url, config, args)
+        print(f"{name:<10} {r['ok']:>5} {r['fallback']:>9} {r['breaker']:>8} "
+              f"{r['p50']:>9.1f} {r['p99']:>9.1f} {r['upstream']:>9}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""End-to-end load test: concurrent synthetic patients driven through every step of app.py.
+
+Each simulated patient runs app.py headlessly in Streamlit's AppTest, answering
+the questionnaire along one of the branches below, then triage, booking details
+and slot booking. AppTest sessions can't share a process, so concurrent patients
+run in separate worker processes against one database file. Gemini is replaced
+by the local stub server with configurable latency. Reports sessions/s, the latency of getting each step on screen, SQLite
+write-lock and connection-pool waits, and how each session ended, and appends
+the results as one JSON line to --output so runs can be compared over time.
+
+Usage:
+    python benchmarks/bench_patient_flow.py [--patients 40] [--concurrency 8] [--latency-ms 300]
+                                            [--output patient_flow_results.jsonl]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Collect app metrics in the worker processes; must be set before metrics is first imported
+os.environ.setdefault("METRICS_ENABLED", "1")
+
+import metrics  # noqa: E402
+from i18n import translate  # noqa: E402
+from stub_llm_server import StubConfig, start_stub_server  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+from streamlit.testing.v1.element_tree import Widget  # noqa: E402
+
+APP_PATH = os.path.join(ROOT, "app.py")
+
+# name, gender, has symptoms, needs emergency contraception, translator language
+BRANCHES = [
+    ("symptoms", "Male", True, False, None),
+    ("contraception_only", "Female", False, True, None),
+    ("female_last_period", "Female", True, False, None),
+    ("translator", "Other", True, False, "Français"),
+    ("screening", "Male", False, False, None),
+]
+
+MAX_BOOKING_ATTEMPTS = 5
+
+
+def t(key):
+    return translate("patient", "English", key)
+
+
+def _by_label(widgets, key):
+    return next(widget for widget in widgets if widget.label == t(key))
+
+
+def _drop_stale_widgets(at):
+    """Removes widgets left in the tree by a run that st.rerun() cut short.
+
+    A browser drops them when the rerun finishes; AppTest keeps them, and then
+    fails on their missing state at the next run.
+    """
+    def prune(block):
+        for index, node in list(block.children.items()):
+            if isinstance(node, Widget):
+                try:
+                    at.session_state[node.id]
+                except KeyError:
+                    del block.children[index]
+            elif getattr(node, "children", None):
+                prune(node)
+
+    prune(at.main)
+    prune(at.sidebar)
+
+
+def _answer_step(at, step, branch, rng):
+    """Fills in the widgets of one questionnaire step (1-15) and presses its button."""
+    _, gender, has_symptoms, contraception, translator = branch
+    yes_no = {True: t("yes"), False: t("no")}
+    if step == 1:
+        at.text_input(key="patient_name").input(f"Patient {rng.randrange(10 ** 6)}")
+    elif step == 2:
+        at.radio(key="gender").set_value(gender)
+    elif step == 3:
+        at.date_input[0].set_value(date(rng.randint(1950, 2005), rng.randint(1, 12), rng.randint(1, 28)))
+    elif step == 4:
+        at.radio(key="has_symptoms").set_value(yes_no[has_symptoms])
+    elif step == 5:
+        at.text_area(key="symptoms").input(rng.choice(["Burning when urinating", "Unusual discharge", "Rash"]))
+    elif step == 6:
+        at.text_input(key="symptoms_duration").input(f"{rng.randint(1, 14)} days")
+    elif step == 7:
+        at.radio(key="emergency_contraception").set_value(yes_no[contraception])
+    elif step == 8:
+        at.date_input[0].set_value(date.today() - timedelta(days=rng.randint(5, 40)))
+    elif step == 9:
+        at.text_area(key="medical_history").input(rng.choice(["None", "Asthma", "Type 2 diabetes"]))
+    elif step == 10:
+        at.radio(key="smoking").set_value(yes_no[rng.random() < 0.3])
+    elif step == 11:
+        at.radio(key="drugs").set_value(t("no"))
+    elif step == 12:
+        at.text_input(key="alcohol").input(str(rng.randint(0, 20)))
+    elif step == 15:
+        _by_label(at.selectbox, "clinic_location").set_value(rng.choice(_by_label(at.selectbox, "clinic_location").options))
+        _by_label(at.selectbox, "time_preference").set_value(rng.choice(["Morning", "Day", "Evening"]))
+        _by_label(at.text_input, "phone_number").input(f"07{rng.randrange(10 ** 9):09d}")
+        at.radio(key="needs_translator_input").set_value(yes_no[translator is not None])
+        if translator:
+            # The language list only appears once "Yes" is chosen
+            at.run()
+            _drop_stale_widgets(at)
+            at.selectbox(key="translator_language_input").set_value(translator)
+    at.button[0].click()
+
+
+def run_patient(patient_id, branch, timeout):
+    """Drives one session to a booking.
+
+    Returns (outcome, [(step shown, seconds)], error or None, the session's metrics
+    snapshot with samples). Sessions in one worker process run one at a time.
+    """
+    metrics.reset()
+    outcome, timings, error = _drive_patient(patient_id, branch, timeout)
+    return outcome, timings, error, metrics.snapshot(include_samples=True)
+
+
+def _drive_patient(patient_id, branch, timeout):
+    rng = random.Random(patient_id)
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    timings = []
+
+    def timed_run():
+        started = time.perf_counter()
+        at.run()
+        timings.append((at.session_state["current_step"], time.perf_counter() - started))
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        _drop_stale_widgets(at)
+
+    try:
+        timed_run()
+        while at.session_state["current_step"] < 16:
+            step = at.session_state["current_step"]
+            _answer_step(at, step, branch, rng)
+            timed_run()
+            if at.session_state["current_step"] == step and step != 15:
+                raise RuntimeError(f"stuck at step {step}")
+
+        for _ in range(MAX_BOOKING_ATTEMPTS):
+            if any(s.value.startswith(t("booking_success").split("{")[0]) for s in at.success):
+                return "booked", timings, None
+            if not at.button:
+                return "no_slots", timings, None
+            # After a conflict the app preselects the nearest free slot; just press Book again
+            at.button[0].click()
+            timed_run()
+        return "gave_up", timings, None
+    except Exception as e:
+        return "error", timings, f"{type(e).__name__}: {e}"
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return {f"p{pct}": ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] for pct in (50, 95, 99)}
+
+
+def merge_histograms(snapshots, names):
+    """Combines the named histograms of many snapshots into {name[/label values]: count, total and percentiles}."""
+    merged = defaultdict(lambda: [0, 0.0, []])
+    for snapshot in snapshots:
+        for h in snapshot["histograms"]:
+            if h["name"] in names:
+                key = "/".join([h["name"]] + [value for _, value in sorted(h["labels"].items())])
+                merged[key][0] += h["count"]
+                merged[key][1] += h["sum"]
+                merged[key][2].extend(h["samples"])
+    return {key: {"count": count, "total_ms": total * 1000,
+                  **{q: v * 1000 for q, v in percentiles(samples).items()}}
+            for key, (count, total, samples) in sorted(merged.items())}
+
+
+def merge_counters(snapshots):
+    """Sums every counter over snapshots into {name{labels}: value}."""
+    totals = Counter()
+    for snapshot in snapshots:
+        for c in snapshot["counters"]:
+            labels = ",".join(f"{k}={v}" for k, v in sorted(c["labels"].items()))
+            totals[f"{c['name']}{{{labels}}}" if labels else c["name"]] += c["value"]
+    return dict(sorted(totals.items()))
+
+
+def _init_worker():
+    # Pay for the app's imports before the timed run rather than in each worker's first session
+    import appointments, db, llm, pandas, slots, triage  # noqa: F401
+
+
+def _ready(_):
+    return os.getpid()
+
+
+def _run_patient(patient, timeout):
+    return run_patient(*patient, timeout)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds allowed per script run")
+    parser.add_argument("--output", default="patient_flow_results.jsonl",
+                        help="JSON lines file the run's results are appended to")
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.jitter_ms)
+    server, base_url = start_stub_server(config)
+    tmp = tempfile.TemporaryDirectory()
+    # Read by db.py and llm.py when app.py first imports them
+    os.environ.update(APPOINTMENTS_DB=os.path.join(tmp.name, "load.db"), GEMINI_BASE_URL=base_url,
+                      GEMINI_API_KEY="stub")
+    os.chdir(ROOT)  # app.py loads Logo.png relative to the working directory
+
+    # Fresh interpreters, so no worker inherits SQLite connections or Streamlit state
+    context = multiprocessing.get_context("spawn")
+    # AppTest makes app.py the workers' __main__, so tasks must name this file by its module name
+    import bench_patient_flow as harness
+    # One warm-up session creates the schema and slot calendar outside the timed run
+    with context.Pool(1) as pool:
+        pool.apply(harness.run_patient, (-1, BRANCHES[-1], args.timeout))
+    config.requests = 0
+
+    patients = [(i, BRANCHES[i % len(BRANCHES)]) for i in range(args.patients)]
+    with context.Pool(args.concurrency, initializer=harness._init_worker) as pool:
+        # Tasks only reach a worker once its initializer is done, so this waits for the imports
+        pool.map(harness._ready, range(args.concurrency * 4), chunksize=1)
+        started = time.perf_counter()
+        results = pool.starmap(harness._run_patient, [(patient, args.timeout) for patient in patients], chunksize=1)
+        elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    outcomes = Counter(outcome for outcome, _, _, _ in results)
+    by_branch = defaultdict(Counter)
+    step_seconds = defaultdict(list)
+    for (_, branch), (outcome, timings, _, _) in zip(patients, results):
+        by_branch[branch[0]][outcome] += 1
+        for step, seconds in timings:
+            step_seconds[step].append(seconds)
+    snapshots = [snapshot for _, _, _, snapshot in results]
+    waits = merge_histograms(snapshots, ("sqlite_lock_wait_seconds", "db_pool_wait_seconds"))
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "config": vars(args),
+        "sessions": len(results),
+        "outcomes": dict(outcomes),
+        "branches": {name: dict(counts) for name, counts in by_branch.items()},
+        "errors": sorted({error for _, _, error, _ in results if error})[:10],
+        "elapsed_seconds": elapsed,
+        "sessions_per_second": len(results) / elapsed,
+        "llm_requests": config.requests,
+        "step_latency_ms": {str(step): {"count": len(samples),
+                                        **{q: v * 1000 for q, v in percentiles(samples).items()}}
+                            for step, samples in sorted(step_seconds.items())},
+        "lock_waits_ms": waits,
+        "app_timings_ms": merge_histograms(snapshots, ("db_query_seconds", "llm_call_seconds")),
+        "counters": merge_counters(snapshots),
+    }
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(report) + "\n")
+    tmp.cleanup()
+
+    print(f"sessions:     {len(results)} over {args.concurrency} concurrent, stub LLM {args.latency_ms:.0f}ms")
+    print(f"outcomes:     " + ", ".join(f"{outcome}: {count}" for outcome, count in sorted(outcomes.items())))
+    print(f"throughput:   {report['sessions_per_second']:.2f} sessions/s ({elapsed:.1f}s, "
+          f"{config.requests} LLM requests)")
+    print(f"{'step':>6} {'runs':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for step, row in report["step_latency_ms"].items():
+        print(f"{step:>6} {row['count']:>6} {row['p50']:>9.1f} {row['p95']:>9.1f} {row['p99']:>9.1f}")
+    for name, row in waits.items():
+        print(f"{name}: {row['count']} waits, total {row['total_ms']:.1f}ms, p99 {row['p99']:.2f}ms")
+    for error in report["errors"]:
+        print(f"error: {error}")
+    print(f"Appended results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Slot search latency: per-15-minute query loop vs. single indexed range query.
+
+Usage:
+    python benchmarks/bench_slot_search.py [--sizes 10000 100000 1000000] [--repeat 50]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from slots import (SLOT_HORIZON_DAYS, SLOT_MODE, SLOT_PRIORITIES, add_lookup_names,  # noqa: E402
+                   create_slot_indexes, create_slot_table, find_available_slots, init_lookup_tables, lookup_ids,
+                   slot_start_minutes)
+
+TODAY = date.today()
+START_OF_DAY = datetime.combine(TODAY, datetime.min.time())
+
+
+def build_db(path, n_rows, days=SLOT_HORIZON_DAYS):
+    """Fills available_slots with n_rows dated slots spread over synthetic clinics."""
+    conn = sqlite3.connect(path)
+    init_lookup_tables(conn)
+    create_slot_table(conn)
+    minutes = slot_start_minutes()
+    dates = [(TODAY + timedelta(days=offset)).isoformat() for offset in range(days)]
+    per_clinic = len(dates) * len(minutes) * len(SLOT_PRIORITIES)
+    n_clinics = max(1, n_rows // per_clinic)
+    add_lookup_names(conn, "clinics", [f"Clinic {c}" for c in range(n_clinics + 1)])
+    clinic_ids = lookup_ids(conn, "clinics")
+    priority_ids = lookup_ids(conn, "priorities")
+
+    def rows():
+        count = 0
+        for c in range(n_clinics + 1):
+            for slot_date in dates:
+                for minute in minutes:
+                    for priority in SLOT_PRIORITIES:
+                        if count >= n_rows:
+                            return
+                        count += 1
+                        yield (clinic_ids[f"Clinic {c}"], slot_date, minute, priority_ids[priority], SLOT_MODE,
+                               count % 3 == 0)
+
+    conn.executemany('''INSERT INTO available_slots
+                        (clinic_id, slot_date, start_minute, priority_id, mode_of_consultation, is_booked)
+                        VALUES (?, ?, ?, ?, ?, ?)''', rows())
+    conn.commit()
+    return conn, n_clinics
+
+
+def legacy_search(conn, clinic, priority, start_hour, end_hour):
+    """The original step 16 lookup: one query per 15-minute mark (for a single day)."""
+    c = conn.cursor()
+    found = []
+    for hour in range(start_hour, end_hour):
+        for minute in range(0, 60, 15):
+            c.execute('''SELECT s.id, c.name, s.slot_date, s.start_minute FROM available_slots AS s
+                         JOIN clinics AS c ON c.id = s.clinic_id
+                         WHERE c.name = ? AND s.slot_date = ? AND s.start_minute = ?
+                           AND s.priority_id = (SELECT id FROM priorities WHERE name = ?)
+                           AND s.mode_of_consultation = ?
+                           AND s.is_booked = 0''',
+                      (clinic, TODAY.isoformat(), hour * 60 + minute, priority, SLOT_MODE))
+            found.extend(c.fetchall())
+    return found
+
+
+def range_search(conn, clinic, priority, start_hour, end_hour):
+    """The single range query, restricted to the same single day as legacy_search."""
+    return find_available_slots(conn, clinic, priority, SLOT_MODE, start_hour, end_hour, days=1, now=START_OF_DAY)
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'variant':<22} {'p50 ms':>9} {'p99 ms':>9}")
+    for n_rows in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            conn, n_clinics = build_db(os.path.join(tmp, "bench.db"), n_rows)
+            clinic = f"Clinic {n_clinics // 2}"
+            variants = [
+                ("loop, no index", lambda: legacy_search(conn, clinic, "Urgent", 8, 19)),
+                ("range, no index", lambda: range_search(conn, clinic, "Urgent", 8, 19)),
+            ]
+            results = [(name, timed(fn, args.repeat)) for name, fn in variants]
+            create_slot_indexes(conn)
+            results.append(("loop, indexed", timed(lambda: legacy_search(conn, clinic, "Urgent", 8, 19), args.repeat)))
+            results.append(("range, indexed", timed(lambda: range_search(conn, clinic, "Urgent", 8, 19), args.repeat)))
+            for name, (p50, p99) in results:
+                print(f"{n_rows:>10} {name:<22} {p50:>9.3f} {p99:>9.3f}")
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
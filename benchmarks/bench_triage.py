@@ -0,0 +1,251 @@
+"""Triage accuracy and latency over the labelled case corpus in triage_cases.jsonl.
+
+Every case goes through classify_patient with the triage cache off, so the
+fast-path rules, step 14 prompt, max_tokens/temperature, priority parsing and
+fallback are exactly those of the patient app. The LLM behind it is one of:
+
+    stub      the local stub server, answering each case with its label's code as
+              structured output, or with --no-schema (a backend that refuses
+              JSON schemas) with its free-text "stub_response", a wording the
+              legacy parser should cope with, or "Priority Level: <label>"
+    recorded  the stub server replaying responses from --responses, e.g. a file
+              written by --record during a live run; cases without one are skipped
+    live      Gemini, configured from the environment as for the apps
+
+Reports accuracy per class, the confusion matrix, how each case was decided,
+prompt and completion tokens per LLM call and latency percentiles, and appends
+the results as one JSON line to --output so prompt or parser changes can be
+compared run against run. The stub counts whitespace-separated words as tokens.
+
+Usage:
+    python benchmarks/bench_triage.py [--backend stub|recorded|live] [--no-schema] [--responses FILE] [--record FILE]
+                                      [--concurrency 8] [--repeat 5] [--latency-ms 300] [--min-accuracy 0.9]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Count LLM calls and tokens; must be set before metrics is first imported
+os.environ.setdefault("METRICS_ENABLED", "1")
+
+import llm  # noqa: E402
+import metrics  # noqa: E402
+from batch_triage import record_responses  # noqa: E402
+from stub_llm_server import StubConfig, start_stub_server  # noqa: E402
+from triage import (PRIORITY_CODES, apply_rules, build_patient_summary, build_priority_prompt,  # noqa: E402
+                    classify_patient, generate_openai_response)
+
+CASES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "triage_cases.jsonl")
+
+CLASSES = ["Urgent", "Routine Symptoms", "Routine No Symptoms", "Contraception Referral"]
+
+
+def load_cases(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_recorded(path):
+    """Returns {case id: response} from a JSONL file of {"id", "response"} lines."""
+    with open(path, encoding="utf-8") as f:
+        return {row["id"]: row["response"] for row in map(json.loads, filter(str.strip, f))
+                if row.get("response") is not None}
+
+
+def case_inputs(case):
+    """Returns (responses, has_symptoms, needs_contraception) as batch_triage.py would read the case."""
+    return record_responses(case["answers"], "id")
+
+
+def case_prompt(case):
+    """The classifier prompt classify_patient sends for case, which the stub uses to recognise it."""
+    responses, has_symptoms, _ = case_inputs(case)
+    return build_priority_prompt(build_patient_summary(responses, has_symptoms))
+
+
+def stub_responses(case):
+    """Returns (structured answer, free-text answer) the stub gives for case."""
+    code = next(code for code, priority in PRIORITY_CODES.items() if priority == case["label"])
+    return (json.dumps({"priority": code, "confidence": 0.9}),
+            case.get("stub_response", f"Priority Level: {case['label']}"))
+
+
+def prompt_responder(responses_by_prompt):
+    def respond(request):
+        structured, free_text = responses_by_prompt.get(request["messages"][-1]["content"], ("", ""))
+        return structured if request.get("response_format") else free_text
+    return respond
+
+
+def run_case(case, recorder=None):
+    """Classifies one case without the triage cache. Returns (case, decision, seconds)."""
+    started = time.perf_counter()
+    decision = classify_patient(*case_inputs(case), generate_openai_response)
+    seconds = time.perf_counter() - started
+    if recorder and decision.response is not None:
+        recorder(case, decision)
+    return case, decision, seconds
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return {f"p{pct}": ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] for pct in (50, 95, 99)}
+
+
+def latency_summary(samples):
+    return {"count": len(samples), **{q: v * 1000 for q, v in percentiles(samples).items()},
+            "max": max(samples) * 1000} if samples else {"count": 0}
+
+
+def counter_total(snapshot, name, **labels):
+    return sum(c["value"] for c in snapshot["counters"]
+               if c["name"] == name and all(c["labels"].get(k) == v for k, v in labels.items()))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", default=CASES_PATH, help="labelled JSONL corpus")
+    parser.add_argument("--backend", choices=["stub", "recorded", "live"], default="stub")
+    parser.add_argument("--no-schema", action="store_true",
+                        help="stub and recorded backends refuse JSON schemas, exercising the legacy parser")
+    parser.add_argument("--responses", help="recorded responses to replay with --backend recorded")
+    parser.add_argument("--record", help="write each case's raw classifier response to this JSONL file")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5, help="times each case is classified")
+    parser.add_argument("--latency-ms", type=float, default=300, help="stub response latency")
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--min-accuracy", type=float, help="exit with status 1 below this overall accuracy")
+    parser.add_argument("--output", default="triage_bench_results.jsonl",
+                        help="JSON lines file the run's results are appended to")
+    args = parser.parse_args()
+    if args.backend == "recorded" and not args.responses:
+        parser.error("--backend recorded needs --responses")
+
+    cases = load_cases(args.cases)
+    server = None
+    if args.backend != "live":
+        if args.backend == "recorded":
+            recorded = load_recorded(args.responses)
+            # Cases the rules decide never reach the LLM, so they need no recording
+            cases = [case for case in cases if case["id"] in recorded or apply_rules(*case_inputs(case))[0]]
+            responses = {case["id"]: (recorded.get(case["id"], ""),) * 2 for case in cases}
+        else:
+            responses = {case["id"]: stub_responses(case) for case in cases}
+        config = StubConfig(args.latency_ms, args.jitter_ms, schema_support=not args.no_schema,
+                            responder=prompt_responder({case_prompt(case): responses[case["id"]] for case in cases}))
+        server, base_url = start_stub_server(config)
+        # Both are read when get_gateway() first runs
+        llm.GEMINI_BASE_URL = base_url
+        os.environ["GEMINI_API_KEY"] = "stub"
+    os.environ.setdefault("LLM_MAX_CONCURRENCY", str(args.concurrency))
+    llm.get_gateway()  # Create the client outside the timed run
+
+    recorder = None
+    if args.record:
+        record_file = open(args.record, "w", encoding="utf-8")
+        recorded_ids = set()
+        record_lock = threading.Lock()
+
+        def recorder(case, decision):
+            with record_lock:
+                if case["id"] not in recorded_ids:
+                    recorded_ids.add(case["id"])
+                    record_file.write(json.dumps({"id": case["id"], "label": case["label"],
+                                                  "response": decision.response}, ensure_ascii=False) + "\n")
+
+    runs = [case for _ in range(args.repeat) for case in cases]
+    metrics.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency, thread_name_prefix="bench-triage") as pool:
+        results = list(pool.map(lambda case: run_case(case, recorder), runs))
+    elapsed = time.perf_counter() - started
+    snapshot = metrics.snapshot()
+    if server:
+        server.shutdown()
+    if args.record:
+        record_file.close()
+
+    confusion = defaultdict(Counter)
+    sources = Counter()
+    seconds_by_path = defaultdict(list)
+    misclassified = {}
+    for case, decision, seconds in results:
+        confusion[case["label"]][decision.priority] += 1
+        path = decision.source.split(":")[0].split("+")[0]
+        sources[decision.source if path != "rule" else "rule"] += 1
+        seconds_by_path[path].append(seconds)
+        if decision.priority != case["label"]:
+            misclassified[case["id"]] = {"label": case["label"], "priority": decision.priority,
+                                         "source": decision.source, "response": decision.response}
+
+    correct = sum(confusion[label][label] for label in confusion)
+    llm_calls = counter_total(snapshot, "llm_calls_total", outcome="ok")
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "config": vars(args),
+        "cases": len(cases),
+        "classifications": len(results),
+        "accuracy": correct / len(results) if results else 0.0,
+        "class_accuracy": {label: confusion[label][label] / sum(confusion[label].values())
+                           for label in CLASSES if confusion[label]},
+        "confusion": {label: dict(confusion[label]) for label in CLASSES if confusion[label]},
+        "sources": dict(sources),
+        "misclassified": misclassified,
+        "llm_calls": llm_calls,
+        "prompt_tokens_per_call": counter_total(snapshot, "llm_tokens_total", kind="prompt") / llm_calls
+        if llm_calls else None,
+        "completion_tokens_per_call": counter_total(snapshot, "llm_tokens_total", kind="completion") / llm_calls
+        if llm_calls else None,
+        "elapsed_seconds": elapsed,
+        "classifications_per_second": len(results) / elapsed if elapsed else 0.0,
+        "latency_ms": {"all": latency_summary([s for _, _, s in results]),
+                       **{path: latency_summary(samples) for path, samples in sorted(seconds_by_path.items())}},
+    }
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(report, ensure_ascii=False) + "\n")
+
+    backend = f"{args.backend}, {args.latency_ms:.0f}ms" if args.backend != "live" else "live"
+    print(f"cases:        {len(cases)} x {args.repeat} over {args.concurrency} concurrent ({backend})")
+    print(f"accuracy:     {report['accuracy']:.1%}")
+    print(f"{'class':<24} {'accuracy':>9}   " + " ".join(f"{label[:12]:>12}" for label in CLASSES))
+    for label in CLASSES:
+        if confusion[label]:
+            print(f"{label:<24} {report['class_accuracy'][label]:>9.1%}   "
+                  + " ".join(f"{confusion[label][predicted]:>12}" for predicted in CLASSES))
+    print(f"decided by:   " + ", ".join(f"{source}: {count}" for source, count in sources.most_common()))
+    if llm_calls:
+        print(f"tokens/call:  {report['prompt_tokens_per_call']:.1f} prompt, "
+              f"{report['completion_tokens_per_call']:.1f} completion over {llm_calls:.0f} LLM calls")
+    print(f"throughput:   {report['classifications_per_second']:.1f} classifications/s ({elapsed:.1f}s)")
+    print(f"{'latency':<10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for path, row in report["latency_ms"].items():
+        if row["count"]:
+            print(f"{path:<10} {row['count']:>6} {row['p50']:>9.1f} {row['p95']:>9.1f} "
+                  f"{row['p99']:>9.1f} {row['max']:>9.1f}")
+    for case_id, miss in misclassified.items():
+        print(f"wrong: {case_id} ({miss['label']}) -> {miss['priority']} via {miss['source']}: {miss['response']!r}")
+    print(f"Appended results to {args.output}")
+    if args.min_accuracy is not None and report["accuracy"] < args.min_accuracy:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
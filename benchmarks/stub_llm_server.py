@@ -0,0 +1,138 @@
+"""Local OpenAI-compatible chat completions stub with injectable latency and errors.
+
+Point the apps or the benchmarks at it with GEMINI_BASE_URL, e.g.:
+
+    python benchmarks/stub_llm_server.py --port 8765 --latency-ms 800 --error-rate 0.2
+    GEMINI_BASE_URL=http://127.0.0.1:8765/v1 GEMINI_API_KEY=stub streamlit run app.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_RESPONSE = "Priority Level: Routine Symptoms"
+# Answer to requests that constrain the output with a response_format
+DEFAULT_STRUCTURED_RESPONSE = '{"priority": "ROUTINE_SYMPTOMS", "confidence": 0.8}'
+
+
+class StubConfig:
+    """Fault injection settings, shared by all request handlers and adjustable while running."""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, error_status=503, hang_rate=0.0,
+                 responder=None, schema_support=True):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hang_rate = hang_rate  # Share of requests that never answer within any sane timeout
+        # responder(request_json) -> completion text
+        self.responder = responder or (lambda request: DEFAULT_STRUCTURED_RESPONSE
+                                       if request.get("response_format") else DEFAULT_RESPONSE)
+        # When False, requests with a response_format are refused with 400, like a backend without JSON schemas
+        self.schema_support = schema_support
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+
+def _handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            config.count()
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if request.get("response_format") and not config.schema_support:
+                self._send_json(400, {"error": {"message": "response_format is not supported",
+                                                "type": "invalid_request_error"}})
+                return
+            if random.random() < config.hang_rate:
+                time.sleep(300)
+                return
+            time.sleep(max(0.0, config.latency_ms + random.uniform(-1, 1) * config.jitter_ms) / 1000)
+            if random.random() < config.error_rate:
+                self._send_json(config.error_status, {"error": {"message": "injected failure", "type": "stub"}})
+                return
+
+            text = config.responder(request)
+            words = text.split(" ")
+            usage = {"prompt_tokens": sum(len(str(m.get("content", "")).split()) for m in request.get("messages", [])),
+                     "completion_tokens": len(words)}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            if request.get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for i, word in enumerate(words):
+                    chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": request.get("model", "stub"),
+                             "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word},
+                                          "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                return
+            self._send_json(200, {
+                "id": "stub", "object": "chat.completion", "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    return Handler
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that time out hang up mid-response; that is expected here
+        pass
+
+
+def start_stub_server(config, host="127.0.0.1", port=0):
+    """Serves the stub on a background thread. Returns (server, base_url); call server.shutdown() to stop."""
+    server = _StubServer((host, port), _handler(config))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--response", default=DEFAULT_RESPONSE)
+    parser.add_argument("--no-schema", action="store_true", help="refuse requests with a response_format")
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.error_status, args.hang_rate,
+                        responder=lambda request: args.response, schema_support=not args.no_schema)
+    server, base_url = start_stub_server(config, port=args.port)
+    print(f"Stub LLM listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import metrics
+from appointments import create_appointment_indexes, create_appointments_table
+from migrations import SCHEMA_VERSION, migrate, set_schema_version, table_exists
+from profiles import init_profile_store
+from sessions import init_session_table
+from slots import init_availability_table, init_lookup_tables, init_slot_table
+from translation import init_translation_cache_table
+from triage import init_triage_cache_table
+
+##############################################
+# Connection Pool
+##############################################
+
+DB_PATH = os.getenv("APPOINTMENTS_DB", "appointments.db")
+POOL_SIZE = int(os.getenv("APPOINTMENTS_DB_POOL_SIZE", "8"))
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+
+
+def connect(path=DB_PATH):
+    """Opens a tuned connection: WAL journal, NORMAL sync, busy timeout and a larger statement cache.
+
+    check_same_thread is off because Streamlit runs every rerun on a fresh thread;
+    the pool guarantees a connection is only used by one thread at a time.
+    """
+    conn = sqlite3.connect(path,
+                           timeout=BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=STATEMENT_CACHE_SIZE,
+                           check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+
+class ConnectionPool:
+    """A bounded pool of long-lived connections to one database file."""
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """Checks a connection out for the duration of the block.
+
+        Blocks while all `size` connections are in use. Any transaction left open
+        by the caller is rolled back before the connection goes back to the pool.
+        """
+        with metrics.timer("db_pool_wait_seconds"):
+            self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = connect(self.path)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=DB_PATH):
+    """Returns the process-wide pool for path, creating it on first use."""
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
+
+
+def connection(path=DB_PATH):
+    """Shorthand for get_pool(path).connection()."""
+    return get_pool(path).connection()
+
+##############################################
+# Schema
+##############################################
+
+def init_db(conn):
+    """Creates the schema in a new database file, or migrates an existing one to SCHEMA_VERSION."""
+    if table_exists(conn, "appointments"):
+        migrate(conn)
+    else:
+        create_schema(conn)
+
+
+def create_schema(conn):
+    """Creates every table at the current schema version."""
+    init_lookup_tables(conn)
+    create_appointments_table(conn)
+    create_appointment_indexes(conn)
+    init_slot_table(conn)
+    init_availability_table(conn)
+    init_triage_cache_table(conn)
+    init_translation_cache_table(conn)
+    init_profile_store(conn)
+    init_session_table(conn)
+    set_schema_version(conn, SCHEMA_VERSION)
+    conn.commit()
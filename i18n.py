@@ -0,0 +1,135 @@
+"""Translation catalogs, loaded from locales/<domain>/<code>.json on first use.
+
+Each app has its own domain ("patient" for app.py, "clinician" for app_gp.py).
+A catalog is read and merged with its fallback chain once per process; after
+that a lookup is a single dict access, however many languages are installed.
+
+Check every catalog against English and against the keys the apps use with:
+
+    python i18n.py
+"""
+import json
+import os
+import re
+import sys
+from functools import lru_cache
+
+##############################################
+# Catalogs
+##############################################
+
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+
+# Display name (as shown in the language selectors) -> catalog file code
+LANGUAGES = {
+    "English": "en",
+    "Français": "fr",
+    "Español": "es",
+    "Deutsch": "de",
+    "العربية": "ar",
+    "中文": "zh",
+    "हिंदी": "hi",
+    "Português": "pt",
+}
+DEFAULT_LANGUAGE = "English"
+
+# Languages tried, in order, for keys a catalog lacks before the default language
+FALLBACKS = {
+    "Português": ["Español"],
+}
+
+
+def fallback_chain(language):
+    """Returns the languages to look a key up in, most specific first."""
+    chain = [language] + FALLBACKS.get(language, [])
+    if DEFAULT_LANGUAGE not in chain:
+        chain.append(DEFAULT_LANGUAGE)
+    return chain
+
+
+def catalog_path(domain, language):
+    return os.path.join(LOCALES_DIR, domain, f"{LANGUAGES[language]}.json")
+
+
+@lru_cache(maxsize=None)
+def load_messages(domain, language):
+    """Returns the messages in one catalog file, or {} if the language has none for domain."""
+    try:
+        with open(catalog_path(domain, language), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@lru_cache(maxsize=None)
+def catalog(domain, language):
+    """Returns {key: text} for language with its fallback chain already applied.
+
+    Built on first use of each (domain, language) and shared by every session in
+    the process, so only languages someone has selected are ever loaded.
+    """
+    messages = {}
+    for fallback in reversed(fallback_chain(language)):
+        messages.update(load_messages(domain, fallback))
+    return messages
+
+
+@lru_cache(maxsize=None)
+def available_languages(domain):
+    """Display names of the languages that have a catalog file for domain, in LANGUAGES order."""
+    return tuple(language for language in LANGUAGES if os.path.exists(catalog_path(domain, language)))
+
+
+def translate(domain, language, key):
+    """Returns the text for key in language, falling back along the chain and finally to key itself."""
+    return catalog(domain, language if language in LANGUAGES else DEFAULT_LANGUAGE).get(key, key)
+
+##############################################
+# Catalog Check
+##############################################
+
+# Apps whose t("...") calls are checked against each domain's default catalog
+DOMAIN_SOURCES = {
+    "patient": "app.py",
+    "clinician": "app_gp.py",
+}
+
+_T_CALL = re.compile(r"""\bt\(\s*["']([A-Za-z0-9_]+)["']\s*\)""")
+_PLACEHOLDER = re.compile(r"\{([A-Za-z0-9_]*)\}")
+
+
+def check_catalogs():
+    """Returns a list of problems: missing, unknown or empty keys and mismatched {placeholders}."""
+    problems = []
+    root = os.path.dirname(LOCALES_DIR)
+    for domain, source in DOMAIN_SOURCES.items():
+        reference = load_messages(domain, DEFAULT_LANGUAGE)
+        if not reference:
+            problems.append(f"{domain}: no {DEFAULT_LANGUAGE} catalog at {catalog_path(domain, DEFAULT_LANGUAGE)}")
+            continue
+        with open(os.path.join(root, source), encoding="utf-8") as f:
+            used = set(_T_CALL.findall(f.read()))
+        for key in sorted(used - set(reference)):
+            problems.append(f"{domain}: {source} uses '{key}', which the {DEFAULT_LANGUAGE} catalog lacks")
+
+        for language in available_languages(domain):
+            messages = load_messages(domain, language)
+            for key in sorted(set(reference) - set(messages)):
+                problems.append(f"{domain}/{language}: missing '{key}'")
+            for key in sorted(set(messages) - set(reference)):
+                problems.append(f"{domain}/{language}: unknown key '{key}'")
+            for key in sorted(set(reference) & set(messages)):
+                if not isinstance(messages[key], str) or not messages[key].strip():
+                    problems.append(f"{domain}/{language}: '{key}' is empty")
+                elif set(_PLACEHOLDER.findall(messages[key])) != set(_PLACEHOLDER.findall(reference[key])):
+                    problems.append(f"{domain}/{language}: '{key}' placeholders differ from {DEFAULT_LANGUAGE}")
+    return problems
+
+
+if __name__ == "__main__":
+    problems = check_catalogs()
+    for problem in problems:
+        print(problem)
+    counts = ", ".join(f"{domain}: {len(available_languages(domain))} languages" for domain in DOMAIN_SOURCES)
+    print(f"{len(problems)} problem(s) ({counts})")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,242 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from openai import OpenAI
+
+import metrics
+
+##############################################
+# LLM Gateway
+##############################################
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta/openai/")
+
+# Failures worth another attempt; anything else (bad request, auth) fails at once
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class LLMUnavailableError(Exception):
+    """The LLM could not produce an answer in time; callers should use their fallback."""
+
+
+class CircuitOpenError(LLMUnavailableError):
+    """Raised without calling the LLM while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failed calls and stays open for `reset_seconds`.
+
+    After that a single trial call is let through (half-open): success closes the
+    breaker again, failure re-opens it for another `reset_seconds`.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class LLMGateway:
+    """Chat completions with a deadline, jittered exponential backoff, a concurrency cap and a circuit breaker.
+
+    deadline_seconds bounds the whole call including retries; each attempt gets
+    whatever time is left as its request timeout. At most max_concurrency calls
+    are in flight at once; callers wait for a free slot within their deadline.
+    """
+
+    def __init__(self, client=None, model=GEMINI_MODEL, deadline_seconds=20.0, max_retries=2,
+                 backoff_base=0.5, backoff_max=4.0, max_concurrency=8, breaker=None):
+        self.client = client or OpenAI(api_key=os.getenv("GEMINI_API_KEY"), base_url=GEMINI_BASE_URL,
+                                       max_retries=0)
+        self.model = model
+        self.deadline_seconds = deadline_seconds
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+
+    def _backoff(self, attempt):
+        # "Full jitter": uniform over [0, capped exponential]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _call(self, deadline_seconds, request):
+        """Runs request(timeout) under the breaker, limiter and retry policy, recording its latency and outcome."""
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return self._call_with_policy(deadline_seconds, request)
+        except CircuitOpenError:
+            outcome = "circuit_open"
+            raise
+        except LLMUnavailableError:
+            outcome = "unavailable"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            metrics.observe("llm_call_seconds", time.perf_counter() - started, outcome=outcome)
+            metrics.increment("llm_calls_total", outcome=outcome)
+
+    def _call_with_policy(self, deadline_seconds, request):
+        # Fail fast without queueing for a slot while the breaker is open
+        if self.breaker.state == "open":
+            raise CircuitOpenError("LLM circuit breaker is open")
+        deadline = time.monotonic() + (deadline_seconds or self.deadline_seconds)
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise LLMUnavailableError("Timed out waiting for a free LLM slot")
+        try:
+            if not self.breaker.allow():
+                raise CircuitOpenError("LLM circuit breaker is open")
+            attempt = 0
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.breaker.record_failure()
+                    raise LLMUnavailableError("LLM deadline exceeded")
+                try:
+                    result = request(remaining)
+                    self.breaker.record_success()
+                    return result
+                except RETRYABLE_ERRORS as e:
+                    delay = self._backoff(attempt)
+                    attempt += 1
+                    if attempt > self.max_retries or time.monotonic() + delay >= deadline:
+                        self.breaker.record_failure()
+                        raise LLMUnavailableError(f"LLM call failed after {attempt} attempt(s): {e}") from e
+                    time.sleep(delay)
+                except openai.BadRequestError as e:
+                    # The backend is up and answered; only this request was refused
+                    self.breaker.record_success()
+                    raise LLMUnavailableError(f"LLM rejected the request: {e}") from e
+                except openai.APIError as e:
+                    self.breaker.record_failure()
+                    raise LLMUnavailableError(f"LLM call failed: {e}") from e
+                except LLMUnavailableError:
+                    # Raised by request for an answer without usable content; the backend itself is up
+                    self.breaker.record_success()
+                    raise
+                except Exception:
+                    # Anything unexpected still has to settle the breaker, or a half-open trial never ends
+                    self.breaker.record_failure()
+                    raise
+        finally:
+            self._slots.release()
+
+    def complete(self, messages, deadline_seconds=None, **params):
+        """Returns the stripped text of a chat completion for messages.
+
+        Raises LLMUnavailableError if the completion has no text, e.g. when the
+        backend's safety filter withheld it.
+        """
+        def request(timeout):
+            completion = self.client.chat.completions.create(model=self.model, messages=messages,
+                                                             timeout=timeout, **params)
+            if completion.usage:
+                metrics.increment("llm_tokens_total", completion.usage.prompt_tokens, kind="prompt")
+                metrics.increment("llm_tokens_total", completion.usage.completion_tokens, kind="completion")
+            content = completion.choices[0].message.content if completion.choices else None
+            if not content or not content.strip():
+                raise LLMUnavailableError("LLM returned an empty answer")
+            return content.strip()
+
+        return self._call(deadline_seconds, request)
+
+    def stream(self, messages, deadline_seconds=None, **params):
+        """Yields text deltas of a streamed chat completion as they arrive.
+
+        Retries and the concurrency slot cover opening the stream, so the first
+        token arrives within the deadline; a failure after that raises
+        LLMUnavailableError, since the partial text can't be replayed. So does a
+        stream that ends without any text.
+        """
+        def request(timeout):
+            return self.client.chat.completions.create(model=self.model, messages=messages, stream=True,
+                                                       timeout=timeout, **params)
+
+        completion = self._call(deadline_seconds, request)
+        has_text = False
+        try:
+            for chunk in completion:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    has_text = has_text or bool(chunk.choices[0].delta.content.strip())
+                    yield chunk.choices[0].delta.content
+        except openai.APIError as e:
+            self.breaker.record_failure()
+            raise LLMUnavailableError(f"LLM stream failed: {e}") from e
+        if not has_text:
+            raise LLMUnavailableError("LLM returned an empty answer")
+
+    def submit(self, messages, deadline_seconds=None, **params):
+        """Runs complete() on the gateway's worker pool and returns a concurrent.futures.Future."""
+        return self._executor.submit(self.complete, messages, deadline_seconds, **params)
+
+    async def acomplete(self, messages, deadline_seconds=None, **params):
+        """Awaitable complete() that doesn't block the event loop."""
+        return await asyncio.wrap_future(self.submit(messages, deadline_seconds, **params))
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """Returns the process-wide gateway, configured from the environment on first use."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway(
+                deadline_seconds=float(os.getenv("LLM_DEADLINE_SECONDS", "20")),
+                max_retries=int(os.getenv("LLM_MAX_RETRIES", "2")),
+                max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+                breaker=CircuitBreaker(failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+                                       reset_seconds=float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))),
+            )
+        return _gateway
@@ -0,0 +1,322 @@
+"""Timers, counters and a step funnel for the apps, served in Prometheus text format.
+
+Off unless one of these is set before the app starts:
+
+    METRICS_PORT=9101      serve http://127.0.0.1:9101/metrics (and /metrics.json)
+    METRICS_JSON=path      write every metric to path as JSON when the process exits
+    METRICS_ENABLED=1      collect without serving, e.g. for a load test reading snapshot()
+
+When off, timed() hands back the undecorated function and timer()/start_timer()
+a shared no-op, so instrumented code pays one flag check. Measure it with:
+
+    python metrics.py
+"""
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+##############################################
+# Registry
+##############################################
+
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_JSON = os.getenv("METRICS_JSON")
+ENABLED = bool(METRICS_PORT or METRICS_JSON or os.getenv("METRICS_ENABLED"))
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Quantiles are computed over each series' most recent samples
+RESERVOIR_SIZE = 2048
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [count, sum, deque of recent samples]
+
+
+# Labels added to every series recorded in the current context; see labelled()
+_context_labels = contextvars.ContextVar("metric_labels", default={})
+
+
+def _series(name, labels):
+    extra = _context_labels.get()
+    if extra:
+        labels = {**extra, **labels}
+    return name, tuple(sorted(labels.items()))
+
+
+@contextmanager
+def labelled(**labels):
+    """Adds labels to every metric recorded inside the with block by this thread.
+
+    Lets background work, e.g. speculative triage, be told apart from work a
+    patient is waiting on, without passing labels through every call.
+    """
+    token = _context_labels.set({**_context_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _context_labels.reset(token)
+
+
+def increment(name, amount=1, **labels):
+    """Adds amount to the counter name{labels}."""
+    if not ENABLED:
+        return
+    key = _series(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def add_to_gauge(name, amount, **labels):
+    """Moves the gauge name{labels} up or down by amount."""
+    if not ENABLED:
+        return
+    key = _series(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """Records one sample, e.g. a duration in seconds, in the histogram name{labels}."""
+    if not ENABLED:
+        return
+    key = _series(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0, 0.0, deque(maxlen=RESERVOIR_SIZE)]
+        histogram[0] += 1
+        histogram[1] += value
+        histogram[2].append(value)
+
+
+def reset():
+    """Forgets every recorded value."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+##############################################
+# Timers
+##############################################
+
+class Timer:
+    """Observes the seconds between start and stop() (or leaving a with block) in a histogram."""
+
+    __slots__ = ("name", "labels", "started")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.started = time.perf_counter()
+
+    def stop(self):
+        """Records the elapsed time once; later calls do nothing."""
+        if self.started is not None:
+            observe(self.name, time.perf_counter() - self.started, **self.labels)
+            self.started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def start_timer(name, **labels):
+    """Starts timing now; call stop() on the result to record the duration in histogram name."""
+    return Timer(name, labels) if ENABLED else _NULL_TIMER
+
+
+def timer(name, **labels):
+    """Context manager timing its block into histogram name, e.g. with timer("llm_call_seconds"): ..."""
+    return Timer(name, labels) if ENABLED else _NULL_TIMER
+
+
+def timed(name, **labels):
+    """Decorator timing every call into histogram name. A no-op unless metrics were on at import."""
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Timer(name, labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+##############################################
+# Step Funnel
+##############################################
+
+def record_step(progress, app, step):
+    """Counts a session reaching step, once per session.
+
+    progress is a per-session dict (e.g. in st.session_state). funnel_reached_total
+    counts sessions that ever reached each step; funnel_furthest_step is how many
+    sessions have got no further than each step, i.e. where they dropped off.
+    """
+    if not ENABLED:
+        return
+    reached = progress.setdefault("reached", set())
+    if step in reached:
+        return
+    reached.add(step)
+    increment("funnel_reached_total", app=app, step=str(step))
+    furthest = progress.get("furthest")
+    if furthest is None or step > furthest:
+        if furthest is not None:
+            add_to_gauge("funnel_furthest_step", -1, app=app, step=str(furthest))
+        add_to_gauge("funnel_furthest_step", 1, app=app, step=str(step))
+        progress["furthest"] = step
+
+##############################################
+# Export
+##############################################
+
+def _quantile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def snapshot(include_samples=False):
+    """Returns every metric as a JSON-serialisable dict.
+
+    With include_samples, each histogram also lists its recent samples, so
+    snapshots from several processes can be merged into exact percentiles.
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: (count, total, sorted(samples)) for key, (count, total, samples) in _histograms.items()}
+
+    def entry(key, **values):
+        return {"name": key[0], "labels": dict(key[1]), **values}
+
+    return {
+        "counters": [entry(key, value=value) for key, value in sorted(counters.items())],
+        "gauges": [entry(key, value=value) for key, value in sorted(gauges.items())],
+        "histograms": [entry(key, count=count, sum=total,
+                             **{f"p{round(q * 100)}": _quantile(ordered, q) for q in QUANTILES},
+                             **({"samples": ordered} if include_samples else {}))
+                       for key, (count, total, ordered) in sorted(histograms.items())],
+    }
+
+
+def _label_text(labels, **extra):
+    pairs = list(labels.items()) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def prometheus_text():
+    """Renders snapshot() in the Prometheus text exposition format; histograms become summaries."""
+    data = snapshot()
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for kind, section in (("counter", "counters"), ("gauge", "gauges")):
+        for metric in data[section]:
+            declare(metric["name"], kind)
+            lines.append(f"{metric['name']}{_label_text(metric['labels'])} {metric['value']}")
+    for metric in data["histograms"]:
+        name, labels = metric["name"], metric["labels"]
+        declare(name, "summary")
+        for q in QUANTILES:
+            lines.append(f"{name}{_label_text(labels, quantile=q)} {metric[f'p{round(q * 100)}']}")
+        lines.append(f"{name}_sum{_label_text(labels)} {metric['sum']}")
+        lines.append(f"{name}_count{_label_text(labels)} {metric['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def dump_json(path):
+    """Writes snapshot() to path."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(snapshot(), f, indent=2)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = prometheus_text().encode("utf-8"), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot()).encode("utf-8"), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_server(port=None, host="127.0.0.1"):
+    """Serves /metrics on port (default METRICS_PORT) in a daemon thread, once per process.
+
+    Returns the server, or None when no port is configured. Safe to call on every
+    Streamlit rerun.
+    """
+    global _server
+    port = port or METRICS_PORT
+    with _lock:
+        if _server is None and port:
+            _server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        return _server
+
+
+if METRICS_JSON:
+    atexit.register(dump_json, METRICS_JSON)
+
+
+if __name__ == "__main__":
+    # Per-call cost of an instrumented block, off and on
+    calls = 200_000
+    for ENABLED in (False, True):
+        reset()
+        started = time.perf_counter()
+        for _ in range(calls):
+            with timer("overhead_seconds", state="on"):
+                pass
+            increment("overhead_total")
+        per_call = (time.perf_counter() - started) / calls
+        print(f"metrics {'on ' if ENABLED else 'off'}: {per_call * 1e9:.0f} ns per timed block + counter")
@@ -0,0 +1,468 @@
+"""Versioned schema migrations for the appointments database, tracked in PRAGMA user_version.
+
+New database files are created at SCHEMA_VERSION directly (see db.init_db);
+existing files are brought up to date by the upgrades below, in order. Large
+tables are copied in id batches with a commit after each, so the apps can keep
+reading and booking while the copy runs; only the final swap takes the write
+lock. Run one migrator at a time. To convert an existing file and report its
+size and query latency before and after:
+
+    python migrations.py --db appointments.db --batch-size 1000 --vacuum
+
+To check the upgrade path on a generated pre-versioning file with booked slots:
+
+    python migrations.py --check-legacy
+"""
+import argparse
+import json
+import os
+import re
+import tempfile
+import time
+from datetime import date, datetime
+
+from appointments import create_appointment_indexes, create_appointments_table, list_appointments
+from profiles import init_profile_store
+from sessions import init_session_table
+from slots import (CLINIC_LOCATIONS, SLOT_MODE, SLOT_PRIORITIES, add_lookup_names, check_availability,
+                   claim_slot, create_slot_indexes, create_slot_table, find_available_slots,
+                   generate_slot_calendar, init_availability_table, init_lookup_tables, rebuild_availability)
+from translation import init_translation_cache_table
+from triage import init_triage_cache_table
+
+##############################################
+# Schema Versions
+##############################################
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def set_schema_version(conn, version):
+    """Records version in the file header. Does not commit; PRAGMA values can't be bound parameters."""
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def add_missing_columns(conn, table, columns):
+    """Adds each {name: type} column that an older database file does not have yet."""
+    existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    for name, column_type in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+
+def copy_in_batches(conn, source, copy_batch, batch_size, progress, start_id=0):
+    """Calls copy_batch(conn, low_id, high_id) over consecutive id ranges of source, committing after each.
+
+    Returns the highest id copied, so a final catch-up can copy rows inserted meanwhile.
+    """
+    last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {source}").fetchone()[0]
+    low = start_id
+    while low < last_id:
+        high = min(low + batch_size, last_id)
+        copy_batch(conn, low, high)
+        conn.commit()
+        progress(f"{source}: copied ids {low + 1}-{high} of {last_id}")
+        low = high
+    return max(last_id, start_id)
+
+##############################################
+# Version 1: the unversioned schema
+##############################################
+
+def upgrade_to_1(conn, batch_size, progress):
+    """Brings a file written before schema versioning to the last unversioned layout."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS appointments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT,
+                    priority TEXT,
+                    clinic TEXT,
+                    time_preference TEXT,
+                    mode_of_consultation TEXT,
+                    phone_number TEXT,
+                    symptoms_summary TEXT,
+                    severity_classification TEXT,
+                    date_of_birth TEXT,
+                    has_symptoms TEXT,
+                    emergency_contraception TEXT,
+                    needs_translator TEXT,
+                    translator_language TEXT
+                    )''')
+    add_missing_columns(conn, "appointments", {"submission_token": "TEXT", "slot_id": "INTEGER",
+                                               "triage_source": "TEXT", "created_at": "TEXT",
+                                               "row_version": "INTEGER DEFAULT 1"})
+    conn.execute('''CREATE TABLE IF NOT EXISTS available_slots (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    clinic TEXT,
+                    time TEXT,
+                    priority TEXT,
+                    mode_of_consultation TEXT,
+                    is_booked INTEGER DEFAULT 0
+                    )''')
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(available_slots)")]
+    if "slot_date" not in columns:
+        conn.execute("ALTER TABLE available_slots ADD COLUMN slot_date TEXT")
+        # Undated rows came from the old wipe-and-refill grid and can never be searched
+        conn.execute("DELETE FROM available_slots WHERE is_booked = 0")
+    conn.commit()
+    init_triage_cache_table(conn)
+    init_profile_store(conn)
+    set_schema_version(conn, 1)
+    conn.commit()
+
+##############################################
+# Version 2: typed columns and lookup ids
+##############################################
+
+# Yes/no answers were saved in the patient's display language
+LEGACY_YES = {"yes", "oui"}
+LEGACY_NO = {"no", "non"}
+
+# The response keys the old app wrote to symptoms_summary, one "key: value" line each
+LEGACY_SUMMARY_KEYS = {
+    "name", "gender", "date_of_birth", "age", "has_symptoms", "symptoms", "symptoms_duration",
+    "emergency_contraception", "last_period", "medical_history", "smoking", "drugs", "alcohol",
+}
+
+_SUMMARY_LINE = re.compile(r"^([a-z_]+): (.*)$")
+
+
+def legacy_flag(value):
+    if value is None:
+        return None
+    answer = value.strip().lower()
+    return 1 if answer in LEGACY_YES else 0 if answer in LEGACY_NO else None
+
+
+def legacy_date(value):
+    """Converts a 'DD/MM/YYYY' date of birth to ISO, leaving anything unparseable as it was."""
+    try:
+        return datetime.strptime(value, "%d/%m/%Y").date().isoformat()
+    except (TypeError, ValueError):
+        return value
+
+
+def legacy_answers(symptoms_summary):
+    """Parses the old 'key: value' lines of symptoms_summary back into a JSON object.
+
+    A line only starts a new answer if it names a LEGACY_SUMMARY_KEYS key not seen
+    yet; any other line, e.g. "pain: worse at night", continues the current answer.
+    """
+    answers = {}
+    key = None
+    for line in (symptoms_summary or "").splitlines():
+        match = _SUMMARY_LINE.match(line)
+        if match and match.group(1) in LEGACY_SUMMARY_KEYS and match.group(1) not in answers:
+            key, value = match.groups()
+            answers[key] = value
+        elif key:
+            # A multi-line free-text answer
+            answers[key] += "\n" + line
+    if str(answers.get("age", "")).isdigit():
+        answers["age"] = int(answers["age"])
+    return json.dumps(answers, ensure_ascii=False) if answers else None
+
+
+def _copy_slots(conn, low, high):
+    conn.execute('''INSERT OR REPLACE INTO available_slots_new
+                    (id, clinic_id, slot_date, start_minute, priority_id, mode_of_consultation, is_booked)
+                    SELECT s.id, c.id, s.slot_date,
+                           CAST(substr(s.time, 1, 2) AS INTEGER) * 60 + CAST(substr(s.time, 4, 2) AS INTEGER),
+                           p.id, s.mode_of_consultation, s.is_booked
+                    FROM available_slots AS s
+                    LEFT JOIN clinics AS c ON c.name = s.clinic
+                    LEFT JOIN priorities AS p ON p.name = s.priority
+                    WHERE s.id > ? AND s.id <= ?''', (low, high))
+
+
+def _copy_appointments(conn, low, high):
+    rows = conn.execute('''SELECT a.id, a.name, p.id, c.id, a.time_preference, a.mode_of_consultation,
+                                  a.phone_number, a.symptoms_summary, a.date_of_birth, a.has_symptoms,
+                                  a.emergency_contraception, a.needs_translator, a.translator_language,
+                                  a.submission_token, a.slot_id, a.triage_source, a.created_at, a.row_version
+                           FROM appointments AS a
+                           LEFT JOIN priorities AS p ON p.name = a.priority
+                           LEFT JOIN clinics AS c ON c.name = a.clinic
+                           WHERE a.id > ? AND a.id <= ?''', (low, high)).fetchall()
+    conn.executemany('''INSERT OR REPLACE INTO appointments_new
+                        (id, name, priority_id, clinic_id, time_preference, mode_of_consultation,
+                         phone_number, answers, date_of_birth, has_symptoms, emergency_contraception,
+                         needs_translator, translator_language, submission_token, slot_id, triage_source,
+                         created_at, row_version)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                     [row[:7] + (legacy_answers(row[7]), legacy_date(row[8]), legacy_flag(row[9]),
+                                 legacy_flag(row[10]), legacy_flag(row[11])) + row[12:]
+                      for row in rows])
+
+
+def upgrade_to_2(conn, batch_size, progress):
+    """Rebuilds available_slots and appointments with typed columns and clinic/priority lookup ids.
+
+    Slot times become minutes after midnight. The appointment questionnaire moves
+    from symptoms_summary text to the answers JSON column; severity_classification,
+    which always repeated priority, is dropped.
+    """
+    init_lookup_tables(conn)
+    for table, column in (("clinics", "clinic"), ("priorities", "priority")):
+        names = conn.execute(f'''SELECT {column} FROM appointments WHERE {column} IS NOT NULL
+                                 UNION SELECT {column} FROM available_slots WHERE {column} IS NOT NULL''')
+        add_lookup_names(conn, table, [row[0] for row in names])
+    create_slot_table(conn, "available_slots_new")
+    create_appointments_table(conn, "appointments_new")
+    conn.commit()
+
+    copied_slots = copy_in_batches(conn, "available_slots", _copy_slots, batch_size, progress)
+    copied_appointments = copy_in_batches(conn, "appointments", _copy_appointments, batch_size, progress)
+
+    # Catch up with writes made during the copy, then swap the tables in one short transaction
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _copy_slots(conn, copied_slots, float("inf"))
+        _copy_appointments(conn, copied_appointments, float("inf"))
+        conn.execute('''UPDATE available_slots_new SET is_booked = s.is_booked
+                        FROM available_slots AS s
+                        WHERE s.id = available_slots_new.id AND s.is_booked != available_slots_new.is_booked''')
+        conn.execute("DELETE FROM available_slots_new WHERE id NOT IN (SELECT id FROM available_slots)")
+        for table in ("available_slots", "appointments"):
+            conn.execute(f"DROP TABLE {table}")
+            conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        create_slot_indexes(conn)
+        create_appointment_indexes(conn)
+        set_schema_version(conn, 2)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    progress("Swapped in the typed available_slots and appointments tables")
+
+##############################################
+# Version 3: translation cache
+##############################################
+
+def upgrade_to_3(conn, batch_size, progress):
+    """Adds the cache of clinician-language translations of free-text answers."""
+    init_translation_cache_table(conn)
+    set_schema_version(conn, 3)
+    conn.commit()
+
+##############################################
+# Version 4: slot availability counters
+##############################################
+
+def upgrade_to_4(conn, batch_size, progress):
+    """Adds the per-(date, clinic, hour, priority) slot counters and counts the existing slots into them."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        init_availability_table(conn)
+        set_schema_version(conn, 4)
+        # Commits; the write lock keeps bookings from slipping in between the triggers and the count
+        rebuild_availability(conn)
+    except Exception:
+        conn.rollback()
+        raise
+
+##############################################
+# Version 5: patient session snapshots
+##############################################
+
+def upgrade_to_5(conn, batch_size, progress):
+    """Adds the table patients' questionnaire progress is checkpointed to."""
+    init_session_table(conn)
+    set_schema_version(conn, 5)
+    conn.commit()
+
+##############################################
+# Migration Runner
+##############################################
+
+# MIGRATIONS[n - 1] upgrades a file from version n - 1 to n and records version n
+MIGRATIONS = [upgrade_to_1, upgrade_to_2, upgrade_to_3, upgrade_to_4, upgrade_to_5]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn, batch_size=1000, progress=None):
+    """Applies every migration newer than the file's schema version. Returns the number applied."""
+    progress = progress or (lambda message: None)
+    applied = 0
+    for version, upgrade in enumerate(MIGRATIONS, start=1):
+        if schema_version(conn) < version:
+            started = time.perf_counter()
+            upgrade(conn, batch_size, progress)
+            progress(f"Migrated to version {version} in {time.perf_counter() - started:.2f}s")
+            applied += 1
+    return applied
+
+##############################################
+# Before/After Report
+##############################################
+
+def storage_bytes(conn):
+    """Returns (file bytes, bytes in use); the difference is free pages left behind until VACUUM."""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_count * page_size, (page_count - free_pages) * page_size
+
+
+def report_queries(conn):
+    """The queries compared before and after, written for the file's current schema version."""
+    today = date.today()
+    if schema_version(conn) < 2:
+        return {
+            "slot search": lambda: conn.execute(
+                '''SELECT id, clinic, slot_date, time FROM available_slots
+                   WHERE clinic = ? AND priority = ? AND mode_of_consultation = ? AND is_booked = 0
+                     AND slot_date >= ? AND time >= ? AND time < ?
+                   ORDER BY slot_date, time''',
+                (CLINIC_LOCATIONS[0], "Urgent", SLOT_MODE, today.isoformat(), "08:00", "19:00")).fetchall(),
+            "clinician list": lambda: conn.execute(
+                '''SELECT id, name, priority, clinic, created_at FROM appointments
+                   WHERE priority = ? ORDER BY id DESC LIMIT 25''', ("Urgent",)).fetchall(),
+            # Age only exists inside the summary text
+            "symptomatic aged 18-25": lambda: conn.execute(
+                '''SELECT COUNT(*) FROM appointments
+                   WHERE lower(has_symptoms) IN ('yes', 'oui')
+                     AND CAST(substr(symptoms_summary, instr(symptoms_summary, char(10) || 'age: ') + 6, 3)
+                              AS INTEGER) BETWEEN 18 AND 25''').fetchall(),
+        }
+    return {
+        "slot search": lambda: find_available_slots(
+            conn, CLINIC_LOCATIONS[0], "Urgent", SLOT_MODE, 8, 19,
+            now=datetime.combine(today, datetime.min.time())),
+        "clinician list": lambda: list_appointments(conn, 25, priority="Urgent"),
+        "symptomatic aged 18-25": lambda: conn.execute(
+            "SELECT COUNT(*) FROM appointments WHERE has_symptoms = 1 AND age BETWEEN 18 AND 25").fetchall(),
+    }
+
+
+def measure_queries(conn, repeat=20):
+    """Returns {query: median milliseconds} for report_queries."""
+    timings = {}
+    for name, query in report_queries(conn).items():
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            query()
+            samples.append((time.perf_counter() - started) * 1000)
+        timings[name] = sorted(samples)[len(samples) // 2]
+    return timings
+
+
+##############################################
+# Legacy Upgrade Check
+##############################################
+
+def create_legacy_file(conn, slots=40, appointments=10):
+    """Fills an empty file with the pre-versioning layout: an undated slot grid, half of it booked."""
+    conn.execute('''CREATE TABLE appointments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, priority TEXT, clinic TEXT,
+                    time_preference TEXT, mode_of_consultation TEXT, phone_number TEXT, symptoms_summary TEXT,
+                    severity_classification TEXT, date_of_birth TEXT, has_symptoms TEXT,
+                    emergency_contraception TEXT, needs_translator TEXT, translator_language TEXT)''')
+    conn.execute('''CREATE TABLE available_slots (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, clinic TEXT, time TEXT, priority TEXT,
+                    mode_of_consultation TEXT, is_booked INTEGER DEFAULT 0)''')
+    conn.executemany("INSERT INTO available_slots (clinic, time, priority, mode_of_consultation, is_booked) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     [(CLINIC_LOCATIONS[n % len(CLINIC_LOCATIONS)], f"{9 + n % 8:02d}:00",
+                       SLOT_PRIORITIES[n % len(SLOT_PRIORITIES)], SLOT_MODE, n % 2) for n in range(slots)])
+    conn.executemany('''INSERT INTO appointments (name, priority, clinic, symptoms_summary, date_of_birth,
+                                                has_symptoms, emergency_contraception, needs_translator)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                     [(f"Patient {n}", SLOT_PRIORITIES[n % len(SLOT_PRIORITIES)], CLINIC_LOCATIONS[0],
+                       f"name: Patient {n}\nage: {20 + n}\nsymptoms: itching\npain: worse at night\n"
+                       f"smoking: No", "01/02/1990", "No", "Non", "no")
+                      for n in range(appointments)])
+    conn.commit()
+
+
+def check_legacy_upgrade(batch_size=7):
+    """Migrates a create_legacy_file database to SCHEMA_VERSION, then books on it and checks the counters.
+
+    Raises AssertionError on the first mismatch. The small default batch_size
+    makes every table copy run in several batches.
+    """
+    from db import connect
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = connect(os.path.join(directory, "legacy.db"))
+        try:
+            create_legacy_file(conn)
+            booked = conn.execute("SELECT COUNT(*) FROM available_slots WHERE is_booked = 1").fetchone()[0]
+            migrate(conn, batch_size)
+            assert schema_version(conn) == SCHEMA_VERSION, f"schema version {schema_version(conn)}"
+            undated = conn.execute("SELECT COUNT(*) FROM available_slots WHERE slot_date IS NULL").fetchone()[0]
+            assert undated == booked, f"{undated} of {booked} booked legacy slots kept"
+            assert len(list_appointments(conn, 25)) == 10, "appointments lost"
+            answers = json.loads(conn.execute("SELECT answers FROM appointments LIMIT 1").fetchone()[0])
+            assert answers["symptoms"] == "itching\npain: worse at night", f"symptoms parsed as {answers}"
+            assert check_availability(conn) == 0, "counters drifted after the upgrade"
+
+            # The counter triggers must accept changes to both calendar and legacy rows
+            generate_slot_calendar(conn, CLINIC_LOCATIONS, 2)
+            slot_id = conn.execute("SELECT id FROM available_slots WHERE slot_date IS NOT NULL LIMIT 1").fetchone()[0]
+            assert claim_slot(conn, slot_id), "calendar slot not claimed"
+            conn.execute("UPDATE available_slots SET is_booked = 0 WHERE slot_date IS NULL")
+            conn.execute("DELETE FROM available_slots WHERE slot_date IS NULL")
+            conn.commit()
+            assert check_availability(conn) == 0, "counters drifted after booking"
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    from db import DB_PATH, connect, init_db
+
+    parser = argparse.ArgumentParser(description="Migrate an appointments database to the current schema.")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--vacuum", action="store_true", help="reclaim the space freed by the migration")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query when timing")
+    parser.add_argument("--check-legacy", action="store_true",
+                        help="migrate a generated pre-versioning file with booked slots instead, and verify it")
+    args = parser.parse_args()
+
+    if args.check_legacy:
+        check_legacy_upgrade()
+        print(f"Upgraded a pre-versioning file with booked slots to version {SCHEMA_VERSION}.")
+        raise SystemExit
+
+    conn = connect(args.db)
+    if not table_exists(conn, "appointments"):
+        init_db(conn)
+        print(f"Created {args.db} at schema version {schema_version(conn)}.")
+        raise SystemExit
+    version = schema_version(conn)
+    if version >= SCHEMA_VERSION:
+        print(f"{args.db} is already at schema version {version}.")
+        raise SystemExit
+
+    # Bring pre-versioning files to version 1 first so the "before" queries can run
+    if version < 1:
+        upgrade_to_1(conn, args.batch_size, print)
+    conn.execute("ANALYZE")
+    size_before = storage_bytes(conn)
+    timings_before = measure_queries(conn, args.repeat)
+    started = time.perf_counter()
+    migrate(conn, args.batch_size, print)
+    elapsed = time.perf_counter() - started
+    if args.vacuum:
+        conn.execute("VACUUM")
+    conn.execute("ANALYZE")
+    size_after = storage_bytes(conn)
+    timings_after = measure_queries(conn, args.repeat)
+    conn.close()
+
+    print(f"\nMigrated {args.db} from version {version} to {SCHEMA_VERSION} in {elapsed:.2f}s")
+    print(f"{'':<28} {'before':>12} {'after':>12}")
+    print(f"{'file size (KiB)':<28} {size_before[0] / 1024:>12.0f} {size_after[0] / 1024:>12.0f}")
+    print(f"{'in use (KiB)':<28} {size_before[1] / 1024:>12.0f} {size_after[1] / 1024:>12.0f}")
+    for name in timings_before:
+        print(f"{name + ' (ms)':<28} {timings_before[name]:>12.3f} {timings_after[name]:>12.3f}")
+    if not args.vacuum:
+        print(f"\nRun with --vacuum to return the {(size_after[0] - size_after[1]) / 1024:.0f} KiB of free pages "
+              f"to the file system.")
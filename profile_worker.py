@@ -0,0 +1,111 @@
+"""Formats clinician profiles (and translates free-text answers) in the background so app_gp.py can show
+them without waiting on Gemini.
+
+Runs headless, next to the Streamlit apps:
+
+    python profile_worker.py              # keep polling for new appointments
+    python profile_worker.py --once       # format everything outstanding, then exit
+
+Progress lives in the formatted_profiles table, so a stopped worker picks up
+where it left off when restarted. Appointments and profiles are read from the
+configured storage backend; with PostgreSQL, workers on several hosts share the
+queue without claiming the same jobs.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db import DB_PATH, connection, init_db
+from llm import LLMUnavailableError, get_gateway
+from profiles import PROFILE_LANGUAGES, build_profile_prompt, profile_summary
+from storage import STORAGE_BACKEND, open_repository
+from translation import translate_answers
+
+##############################################
+# Profile Worker
+##############################################
+
+# Polls only scan appointments booked since the last one. Every this often the
+# whole table is scanned again, for edited appointments (a new row_version of an
+# old id) and, with PostgreSQL, ids whose transactions committed out of order.
+FULL_SCAN_SECONDS = 600
+
+def format_job(repository, db_path, job, max_attempts):
+    """Formats one claimed (appointment_id, language, row_version) job. Returns True on success.
+
+    Any error puts the job back in the queue until it has used max_attempts,
+    rather than stopping the worker with the job still marked running.
+    """
+    appointment_id, language, row_version = job
+    try:
+        appointment = repository.get_appointment(appointment_id)
+        if appointment is None:
+            # Deleted since it was claimed; no later attempt can succeed
+            repository.fail_profile_job(appointment_id, language, row_version, "appointment not found", 0)
+            return False
+        prompt = build_profile_prompt(profile_summary(appointment), language)
+        profile = get_gateway().complete([{"role": "user", "content": prompt}])
+        repository.store_profile(appointment_id, language, row_version, profile)
+    except Exception as e:
+        if not isinstance(e, LLMUnavailableError):
+            print(f"Profile job {tuple(job)} failed: {type(e).__name__}: {e}", flush=True)
+        repository.fail_profile_job(appointment_id, language, row_version, e, max_attempts)
+        return False
+    # Warm the translation cache too, so the clinician view shows translated answers at once
+    try:
+        translate_answers(appointment, language, get_gateway().complete, lambda: connection(db_path))
+    except LLMUnavailableError:
+        pass
+    except Exception as e:
+        # The profile is stored; the clinician view translates on demand instead
+        print(f"Translating answers for appointment {appointment_id} failed: {type(e).__name__}: {e}", flush=True)
+    return True
+
+
+def run_worker(db_path=DB_PATH, languages=PROFILE_LANGUAGES, concurrency=4, poll_seconds=5.0, once=False,
+               max_attempts=3, backend=STORAGE_BACKEND):
+    """Enqueues and formats profiles in batches of `concurrency` until stopped (or, with once, until idle).
+
+    db_path is the local SQLite file, which holds the translation cache and, with
+    the sqlite backend, the appointments too.
+    """
+    with connection(db_path) as conn:
+        init_db(conn)
+    repository = open_repository(backend, db_path)
+    repository.init_schema()
+    last_id, last_full_scan = 0, time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="profile") as pool:
+        while True:
+            if time.monotonic() - last_full_scan >= FULL_SCAN_SECONDS:
+                last_id, last_full_scan = 0, time.monotonic()
+            _, last_id = repository.enqueue_profile_jobs(languages, after_id=last_id)
+            jobs = repository.claim_profile_jobs(concurrency, max_attempts=max_attempts)
+            if jobs:
+                started = time.perf_counter()
+                results = list(pool.map(lambda job: format_job(repository, db_path, job, max_attempts), jobs))
+                progress = repository.profile_job_progress()
+                print(f"Formatted {sum(results)}/{len(jobs)} profiles in {time.perf_counter() - started:.1f}s; "
+                      + ", ".join(f"{status}: {count}" for status, count in sorted(progress.items())), flush=True)
+                if all(results) or get_gateway().breaker.state != "open":
+                    continue
+            if once:
+                break
+            # Nothing to do, or the LLM is down: wait rather than spin
+            time.sleep(poll_seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-format clinician profiles for new appointments.")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--languages", nargs="+", default=PROFILE_LANGUAGES)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--poll-seconds", type=float, default=5.0)
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--once", action="store_true", help="exit once no jobs are outstanding")
+    parser.add_argument("--backend", choices=["sqlite", "postgres"], default=STORAGE_BACKEND)
+    args = parser.parse_args()
+    try:
+        run_worker(args.db, args.languages, args.concurrency, args.poll_seconds, args.once, args.max_attempts,
+                   args.backend)
+    except KeyboardInterrupt:
+        pass
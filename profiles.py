@@ -0,0 +1,136 @@
+import time
+
+import pandas as pd
+
+import metrics
+
+##############################################
+# Clinician Profile Formatting
+##############################################
+
+def build_profile_prompt(patient_summary, language):
+    if language == "Français":
+        return f"Formatez le profil du patient suivant de manière soignée et concise:\n{patient_summary}"
+    return f"Format the following patient's profile in a neat and concise way:\n{patient_summary}"
+
+
+def profile_summary(appointment):
+    """The appointment as the one-row table the clinician sees and the profile prompt quotes."""
+    return pd.DataFrame([appointment]).to_string(index=False)
+
+##############################################
+# Profile Store
+##############################################
+
+PROFILE_LANGUAGES = ["English", "Français"]
+
+# A running job older than this is assumed to belong to a worker that died
+STALE_JOB_SECONDS = 300
+
+
+def init_profile_store(conn):
+    """Formatted profiles, one row per (appointment, language, appointment row_version).
+
+    The row doubles as the worker's job: status goes pending -> running -> done,
+    or back to pending on failure until max_attempts is reached ("failed").
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS formatted_profiles (
+                    appointment_id INTEGER,
+                    language TEXT,
+                    row_version INTEGER,
+                    status TEXT DEFAULT 'pending',
+                    profile TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    error TEXT,
+                    updated_at REAL,
+                    PRIMARY KEY (appointment_id, language, row_version)
+                    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_formatted_profiles_status ON formatted_profiles (status, updated_at)")
+    conn.commit()
+
+
+def enqueue_profile_jobs(conn, languages=PROFILE_LANGUAGES, after_id=0):
+    """Adds a pending job for every appointment version and language without one.
+
+    Only appointments with an id above after_id are scanned, so a worker passing
+    back what the previous call returned touches just the new bookings. Returns
+    (jobs added, highest appointment id scanned).
+    """
+    # Bounded above too, so a booking committed mid-scan is left for the next call rather than skipped
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM appointments").fetchone()[0]
+    languages_sql = " UNION ALL ".join("SELECT ? AS language" for _ in languages)
+    c = conn.execute(f'''INSERT OR IGNORE INTO formatted_profiles (appointment_id, language, row_version, updated_at)
+                          SELECT a.id, l.language, a.row_version, ?
+                          FROM appointments a CROSS JOIN ({languages_sql}) l
+                          WHERE a.id > ? AND a.id <= ?''', [time.time()] + list(languages) + [after_id, last_id])
+    conn.commit()
+    return c.rowcount, max(last_id, after_id)
+
+
+def claim_profile_jobs(conn, limit, stale_seconds=STALE_JOB_SECONDS, max_attempts=3):
+    """Marks up to limit pending jobs as running and returns them as (appointment_id, language, row_version).
+
+    Jobs left running by a worker that stopped more than stale_seconds ago are
+    picked up again, so an interrupted run resumes where it left off, unless they
+    have used max_attempts: a job that keeps killing its worker is marked failed.
+    Jobs for superseded appointment versions are skipped.
+    """
+    now = time.time()
+    with metrics.timer("sqlite_lock_wait_seconds", operation="claim_profile_jobs"):
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute('''UPDATE formatted_profiles
+                        SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                            error = COALESCE(error, 'worker stopped while formatting')
+                        WHERE status = 'running' AND updated_at < ?''', (max_attempts, now - stale_seconds))
+        jobs = conn.execute('''SELECT f.appointment_id, f.language, f.row_version
+                               FROM formatted_profiles f
+                               JOIN appointments a ON a.id = f.appointment_id AND a.row_version = f.row_version
+                               WHERE f.status = 'pending'
+                               ORDER BY f.appointment_id DESC
+                               LIMIT ?''', (limit,)).fetchall()
+        conn.executemany('''UPDATE formatted_profiles SET status = 'running', attempts = attempts + 1, updated_at = ?
+                            WHERE appointment_id = ? AND language = ? AND row_version = ?''',
+                         [(now,) + tuple(job) for job in jobs])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return jobs
+
+
+def store_profile(conn, appointment_id, language, row_version, profile):
+    """Saves a formatted profile, whether it came from the worker or was formatted on demand."""
+    conn.execute('''INSERT INTO formatted_profiles (appointment_id, language, row_version, status, profile, updated_at)
+                    VALUES (?, ?, ?, 'done', ?, ?)
+                    ON CONFLICT (appointment_id, language, row_version)
+                    DO UPDATE SET status = 'done', profile = excluded.profile, error = NULL,
+                                  updated_at = excluded.updated_at''',
+                 (appointment_id, language, row_version, profile, time.time()))
+    conn.commit()
+
+
+def fail_profile_job(conn, appointment_id, language, row_version, error, max_attempts=3):
+    """Puts a job back in the queue, or marks it failed once it has used max_attempts."""
+    conn.execute('''UPDATE formatted_profiles
+                    SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                        error = ?, updated_at = ?
+                    WHERE appointment_id = ? AND language = ? AND row_version = ?''',
+                 (max_attempts, str(error), time.time(), appointment_id, language, row_version))
+    conn.commit()
+
+
+def get_stored_profile(conn, appointment_id, language):
+    """Returns the formatted profile for the appointment's current version, or None if it isn't ready."""
+    row = conn.execute('''SELECT f.profile FROM formatted_profiles f
+                           JOIN appointments a ON a.id = f.appointment_id AND a.row_version = f.row_version
+                           WHERE f.status = 'done' AND f.appointment_id = ? AND f.language = ?''',
+                       (appointment_id, language)).fetchone()
+    return row[0] if row else None
+
+
+def profile_job_progress(conn):
+    """Returns {status: jobs} over the current version of every appointment."""
+    return dict(conn.execute('''SELECT f.status, COUNT(*) FROM formatted_profiles f
+                                JOIN appointments a ON a.id = f.appointment_id AND a.row_version = f.row_version
+                                GROUP BY f.status''').fetchall())
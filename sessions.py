@@ -0,0 +1,155 @@
+"""Checkpoints each patient's questionnaire progress outside the Streamlit process.
+
+app.py saves the session keys in PERSISTED_KEYS after every script run, under a
+resume token kept in the page URL (?resume=...). When a patient's next request
+reaches a fresh session, because the server restarted or a load balancer sent it
+to another process, their progress is restored from the token. The snapshot is
+deleted as soon as the appointment is booked. The store is chosen with
+SESSION_STORE:
+
+    sqlite               the patient_sessions table in the appointments database (default)
+    redis://host:6379/0  any Redis-compatible server; needs the redis package
+    off                  keep progress in process memory only
+"""
+import json
+import os
+import secrets
+import time
+
+from slots import ReservationResult
+
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(24 * 3600)))
+
+##############################################
+# Session Snapshots
+##############################################
+
+# Everything a later step reads back; widget values and in-process objects
+# (timers, the speculative triage job) are left out.
+PERSISTED_KEYS = [
+    "language", "current_step", "responses", "confirmed_summary", "priority", "triage_source",
+    "recommended_mode", "clinic", "time_preference", "mode_of_consultation", "phone_number",
+    "needs_translator", "translator_language", "submission_token", "booking_result",
+]
+
+# Saved as JSON lists and rebuilt on restore
+_NAMEDTUPLES = {"booking_result": ReservationResult}
+
+
+def new_resume_token():
+    """An unguessable token; it is all a patient needs to get their answers back."""
+    return secrets.token_urlsafe(24)
+
+
+def encode_session(session_state):
+    """Returns the PERSISTED_KEYS present in session_state as a JSON string."""
+    return json.dumps({key: session_state[key] for key in PERSISTED_KEYS if key in session_state},
+                      ensure_ascii=False, sort_keys=True)
+
+
+def restore_session(session_state, payload):
+    """Copies a snapshot made by encode_session back into session_state."""
+    for key, value in json.loads(payload).items():
+        if key in _NAMEDTUPLES and value is not None:
+            value = _NAMEDTUPLES[key](*value)
+        session_state[key] = value
+
+##############################################
+# Session Stores
+##############################################
+
+class SessionStore:
+    """Snapshots by resume token. Payloads are JSON strings from encode_session."""
+
+    def load(self, token):
+        """Returns the payload saved under token, or None if there is none or it expired."""
+        raise NotImplementedError
+
+    def save(self, token, payload):
+        raise NotImplementedError
+
+    def delete(self, token):
+        raise NotImplementedError
+
+    def purge_expired(self):
+        """Deletes expired snapshots. Returns how many were deleted."""
+        return 0
+
+
+def init_session_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS patient_sessions (
+                    token TEXT PRIMARY KEY,
+                    payload TEXT,
+                    updated_at REAL
+                    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_sessions_updated_at ON patient_sessions (updated_at)")
+    conn.commit()
+
+
+class SQLiteSessionStore(SessionStore):
+    """Snapshots in the patient_sessions table; every process using the same database file shares them.
+
+    connection is a callable returning a connection context manager, e.g. db.connection.
+    """
+
+    def __init__(self, connection, ttl_seconds=SESSION_TTL_SECONDS):
+        self.connection = connection
+        self.ttl_seconds = ttl_seconds
+
+    def load(self, token):
+        with self.connection() as conn:
+            row = conn.execute("SELECT payload FROM patient_sessions WHERE token = ? AND updated_at >= ?",
+                               (token, time.time() - self.ttl_seconds)).fetchone()
+        return row[0] if row else None
+
+    def save(self, token, payload):
+        with self.connection() as conn:
+            conn.execute('''INSERT INTO patient_sessions (token, payload, updated_at) VALUES (?, ?, ?)
+                            ON CONFLICT (token) DO UPDATE SET payload = excluded.payload,
+                                                              updated_at = excluded.updated_at''',
+                         (token, payload, time.time()))
+            conn.commit()
+
+    def delete(self, token):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM patient_sessions WHERE token = ?", (token,))
+            conn.commit()
+
+    def purge_expired(self):
+        with self.connection() as conn:
+            c = conn.execute("DELETE FROM patient_sessions WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+            conn.commit()
+        return c.rowcount
+
+
+class RedisSessionStore(SessionStore):
+    """Snapshots in a Redis-compatible server, which expires them itself, for processes on several hosts."""
+
+    def __init__(self, url, ttl_seconds=SESSION_TTL_SECONDS, prefix="patient_session:"):
+        import redis  # Only needed when this store is configured
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def load(self, token):
+        payload = self.client.get(self.prefix + token)
+        return payload.decode("utf-8") if payload is not None else None
+
+    def save(self, token, payload):
+        self.client.set(self.prefix + token, payload.encode("utf-8"), ex=self.ttl_seconds)
+
+    def delete(self, token):
+        self.client.delete(self.prefix + token)
+
+
+def open_session_store(connection, spec=SESSION_STORE):
+    """Returns the store SESSION_STORE names, or None when sessions stay in memory."""
+    if spec in ("", "off"):
+        return None
+    if spec == "sqlite":
+        return SQLiteSessionStore(connection)
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisSessionStore(spec)
+    raise ValueError(f"Unknown SESSION_STORE: {spec!r}")
@@ -0,0 +1,477 @@
+import argparse
+import heapq
+import os
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+import metrics
+
+##############################################
+# Slot Calendar
+##############################################
+
+CLINIC_LOCATIONS = [
+    "Jefferiss Wing Sexual Health Clinic, W2 1NY",
+    "56 Dean Street, W1D 6AQ",
+    "John Hunter Clinic, SW10 9NH"
+]
+
+SLOT_PRIORITIES = ["Urgent", "Routine No Symptoms", "Routine Symptoms", "Contraception Referral"]
+SLOT_MODE = "Face-to-Face"  # Only one consultation mode
+SLOT_LENGTH_MINUTES = 15
+OPENING_MINUTE = 8 * 60   # 8 AM in minutes
+CLOSING_MINUTE = 19 * 60  # 7 PM in minutes
+SLOT_HORIZON_DAYS = 14    # How far ahead the calendar is materialized
+
+
+def init_lookup_tables(conn):
+    """Creates the clinics and priorities lookup tables, seeded with the known names."""
+    for table in ("clinics", "priorities"):
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                         id INTEGER PRIMARY KEY,
+                         name TEXT NOT NULL UNIQUE
+                         )''')
+    add_lookup_names(conn, "clinics", CLINIC_LOCATIONS)
+    add_lookup_names(conn, "priorities", SLOT_PRIORITIES)
+    conn.commit()
+
+
+def add_lookup_names(conn, table, names):
+    """Gives each name in names an id in the clinics or priorities table, if it doesn't have one. Does not commit."""
+    conn.executemany(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", [(name,) for name in names])
+
+
+def create_slot_table(conn, table="available_slots"):
+    """Creates the slot table: clinic and priority as lookup ids, start time as minutes after midnight."""
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     clinic_id INTEGER REFERENCES clinics (id),
+                     slot_date TEXT,
+                     start_minute INTEGER,
+                     priority_id INTEGER REFERENCES priorities (id),
+                     mode_of_consultation TEXT,
+                     is_booked INTEGER DEFAULT 0
+                     )''')
+
+
+def init_slot_table(conn):
+    """Creates available_slots and its indexes."""
+    create_slot_table(conn)
+    create_slot_indexes(conn)
+    conn.commit()
+
+
+def create_slot_indexes(conn):
+    """Creates the uniqueness index used by the generator and the composite search index. Does not commit."""
+    conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_available_slots_unique
+                    ON available_slots (clinic_id, slot_date, start_minute, priority_id, mode_of_consultation)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_available_slots_lookup
+                    ON available_slots (clinic_id, priority_id, mode_of_consultation, is_booked, slot_date, start_minute)''')
+
+
+def slot_start_minutes():
+    """Returns the start of every slot in a clinic day, in minutes after midnight."""
+    return list(range(OPENING_MINUTE, CLOSING_MINUTE, SLOT_LENGTH_MINUTES))
+
+
+@metrics.timed("db_query_seconds", query="generate_slot_calendar")
+def generate_slot_calendar(conn, clinics, days=SLOT_HORIZON_DAYS, start_date=None):
+    """Materializes slots for the next `days` days, inserting only the ones that are missing.
+
+    Existing rows (and their is_booked flags) are left untouched, so this is safe
+    to run repeatedly. Returns the number of newly inserted slots.
+    """
+    start_date = start_date or date.today()
+    add_lookup_names(conn, "clinics", clinics)
+    add_lookup_names(conn, "priorities", SLOT_PRIORITIES)
+    clinic_ids = lookup_ids(conn, "clinics")
+    priority_ids = lookup_ids(conn, "priorities")
+    minutes = slot_start_minutes()
+    slots = [(clinic_ids[clinic], (start_date + timedelta(days=offset)).isoformat(), minute,
+              priority_ids[priority], SLOT_MODE)
+             for clinic in clinics
+             for offset in range(days)
+             for minute in minutes
+             for priority in SLOT_PRIORITIES]
+    # rowcount, unlike total_changes, leaves out the availability counter triggers' writes
+    c = conn.executemany('''INSERT OR IGNORE INTO available_slots
+                            (clinic_id, slot_date, start_minute, priority_id, mode_of_consultation)
+                            VALUES (?, ?, ?, ?, ?)''', slots)
+    conn.commit()
+    return c.rowcount
+
+
+def lookup_ids(conn, table):
+    """Returns {name: id} for the clinics or priorities table."""
+    return {name: row_id for row_id, name in conn.execute(f"SELECT id, name FROM {table}")}
+
+
+def prune_past_slots(conn, today=None):
+    """Deletes unbooked slots from days that have already passed. Booked slots are kept."""
+    today = today or date.today()
+    c = conn.execute("DELETE FROM available_slots WHERE slot_date < ? AND is_booked = 0",
+                     (today.isoformat(),))
+    conn.commit()
+    return c.rowcount
+
+##############################################
+# Availability Counters
+##############################################
+
+# available_slots columns that place a slot in a counter bucket
+_BUCKET_COLUMNS = "slot_date, clinic_id, start_minute / 60, priority_id"
+
+
+def _in_bucket_sql(prefix=""):
+    """SQL condition for slots that fall in a counter bucket; prefix is "NEW." or "OLD." in a trigger.
+
+    Slots missing a bucket column are left out of the counters: booked rows from
+    the undated pre-calendar grid keep a NULL slot_date after migration.
+    """
+    return " AND ".join(f"{prefix}{column} IS NOT NULL"
+                        for column in ("slot_date", "clinic_id", "start_minute", "priority_id"))
+
+
+def _bump_bucket_sql(row, sign):
+    """SQL adding sign (+1 or -1) to the free or booked count of the bucket row (NEW or OLD) falls in, if any."""
+    return f'''INSERT INTO slot_availability (slot_date, clinic_id, hour, priority_id, free, booked)
+               SELECT {row}.slot_date, {row}.clinic_id, {row}.start_minute / 60, {row}.priority_id,
+                      {sign} * ({row}.is_booked = 0), {sign} * ({row}.is_booked != 0)
+               WHERE {_in_bucket_sql(row + ".")}
+               ON CONFLICT (slot_date, clinic_id, hour, priority_id) DO UPDATE
+               SET free = free + excluded.free, booked = booked + excluded.booked;'''
+
+
+def init_availability_table(conn):
+    """Creates slot_availability, with the triggers that keep it in step with available_slots. Does not commit.
+
+    Holds free and booked slot counts per (date, clinic, hour, priority). Every
+    insert, delete or booking on available_slots updates its bucket in the same
+    transaction, whichever code path made the change.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS slot_availability (
+                     slot_date TEXT,
+                     clinic_id INTEGER,
+                     hour INTEGER,
+                     priority_id INTEGER,
+                     free INTEGER NOT NULL DEFAULT 0,
+                     booked INTEGER NOT NULL DEFAULT 0,
+                     PRIMARY KEY (slot_date, clinic_id, hour, priority_id)
+                     ) WITHOUT ROWID''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_available_slots_insert_counts
+                     AFTER INSERT ON available_slots
+                     BEGIN
+                         {_bump_bucket_sql("NEW", 1)}
+                     END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_available_slots_delete_counts
+                     AFTER DELETE ON available_slots
+                     BEGIN
+                         {_bump_bucket_sql("OLD", -1)}
+                         DELETE FROM slot_availability
+                         WHERE slot_date = OLD.slot_date AND clinic_id = OLD.clinic_id
+                           AND hour = OLD.start_minute / 60 AND priority_id = OLD.priority_id
+                           AND free = 0 AND booked = 0;
+                     END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_available_slots_update_counts
+                     AFTER UPDATE OF is_booked, slot_date, clinic_id, start_minute, priority_id ON available_slots
+                     BEGIN
+                         {_bump_bucket_sql("OLD", -1)}
+                         {_bump_bucket_sql("NEW", 1)}
+                     END''')
+
+
+def rebuild_availability(conn):
+    """Recounts slot_availability from available_slots in one transaction and commits."""
+    conn.execute("DELETE FROM slot_availability")
+    conn.execute(f'''INSERT INTO slot_availability (slot_date, clinic_id, hour, priority_id, free, booked)
+                     SELECT {_BUCKET_COLUMNS}, SUM(is_booked = 0), SUM(is_booked != 0)
+                     FROM available_slots
+                     WHERE {_in_bucket_sql()}
+                     GROUP BY {_BUCKET_COLUMNS}''')
+    conn.commit()
+
+
+def check_availability(conn, repair=False):
+    """Returns how many counter buckets disagree with a full recount of available_slots.
+
+    With repair, rebuilds slot_availability when any do.
+    """
+    drifted = conn.execute(f'''WITH actual AS (
+                                   SELECT {_BUCKET_COLUMNS}, SUM(is_booked = 0), SUM(is_booked != 0)
+                                   FROM available_slots WHERE {_in_bucket_sql()}
+                                   GROUP BY {_BUCKET_COLUMNS}),
+                                 counted AS (
+                                   SELECT slot_date, clinic_id, hour, priority_id, free, booked
+                                   FROM slot_availability WHERE free != 0 OR booked != 0)
+                               SELECT (SELECT COUNT(*) FROM (SELECT * FROM actual EXCEPT SELECT * FROM counted))
+                                    + (SELECT COUNT(*) FROM (SELECT * FROM counted EXCEPT SELECT * FROM actual))
+                            ''').fetchone()[0]
+    if drifted and repair:
+        rebuild_availability(conn)
+    return drifted
+
+
+@metrics.timed("db_query_seconds", query="availability_summary")
+def availability_summary(conn, first_day, days=1, clinic=None):
+    """Returns (slot_date, clinic, hour, priority, free, booked) counter rows, reading only their buckets."""
+    last_day = first_day + timedelta(days=days)
+    return conn.execute('''SELECT a.slot_date, c.name, a.hour, p.name, a.free, a.booked
+                           FROM slot_availability AS a
+                           JOIN clinics AS c ON c.id = a.clinic_id
+                           JOIN priorities AS p ON p.id = a.priority_id
+                           WHERE a.slot_date >= ? AND a.slot_date < ? AND (? IS NULL OR c.name = ?)
+                           ORDER BY a.slot_date, c.name, a.hour, p.id''',
+                        (first_day.isoformat(), last_day.isoformat(), clinic, clinic)).fetchall()
+
+##############################################
+# Slot Search
+##############################################
+
+# Hour ranges (start inclusive, end exclusive) for each time-of-day preference
+TIME_WINDOWS = {
+    "Morning": (8, 11),
+    "Day": (11, 17),
+    "Evening": (17, 19),
+}
+DEFAULT_WINDOW = (8, 19)
+
+# Formats available_slots.start_minute (aliased s) back to 'HH:MM' for display
+SLOT_TIME_SQL = "printf('%02d:%02d', s.start_minute / 60, s.start_minute % 60)"
+
+
+def time_window(time_preference):
+    """Maps a time preference ("Morning", "Day", "Evening") to an (start_hour, end_hour) range."""
+    return TIME_WINDOWS.get(time_preference, DEFAULT_WINDOW)
+
+
+@metrics.timed("db_query_seconds", query="find_available_slots")
+def find_available_slots(conn, clinic, priority, mode, start_hour, end_hour,
+                         days=SLOT_HORIZON_DAYS, now=None):
+    """Returns (id, clinic, slot_date, time) rows for free slots in the hour window over the next `days` days.
+
+    Dates are ISO strings and start times minutes after midnight, so the whole
+    window is one range scan over the composite lookup index. time is returned
+    as 'HH:MM'. Slots earlier than `now` on the current day are skipped.
+    """
+    now = now or datetime.now()
+    first_day = now.date()
+    last_day = first_day + timedelta(days=days)
+    c = conn.cursor()
+    c.execute(f'''SELECT s.id, c.name, s.slot_date, {SLOT_TIME_SQL} FROM clinics AS c
+                  JOIN available_slots AS s ON s.clinic_id = c.id
+                  WHERE c.name = ?
+                    AND s.priority_id = (SELECT id FROM priorities WHERE name = ?)
+                    AND s.mode_of_consultation = ?
+                    AND s.is_booked = 0
+                    AND s.slot_date >= ? AND s.slot_date < ?
+                    AND s.start_minute >= ? AND s.start_minute < ?
+                    AND (s.slot_date > ? OR s.start_minute >= ?)
+                  ORDER BY s.slot_date, s.start_minute''',
+              (clinic, priority, mode,
+               first_day.isoformat(), last_day.isoformat(),
+               start_hour * 60, end_hour * 60,
+               first_day.isoformat(), now.hour * 60 + now.minute))
+    return c.fetchall()
+
+##############################################
+# Capacity Pooling
+##############################################
+
+# Each clinic time has one slot per priority, i.e. one partition of that time's
+# clinician capacity each. Ordered from most to least pressing.
+PRIORITY_ORDER = ["Urgent", "Contraception Referral", "Routine Symptoms", "Routine No Symptoms"]
+
+# borrows maps a patient's priority to the partitions they may book, most
+# preferred first. Reserved partitions are held back for their own priority
+# until the slot starts within reserve_cutoff_hours; after that anyone may book
+# them, so urgent capacity nobody needed is not wasted.
+PoolingPolicy = namedtuple("PoolingPolicy", ["borrows", "reserved", "reserve_cutoff_hours"])
+
+# One partition per priority, no sharing: the behaviour before pooling
+STRICT_POLICY = PoolingPolicy({priority: [priority] for priority in SLOT_PRIORITIES}, (), 0)
+
+# A patient may use free capacity of their own priority or any less pressing one
+POOLED_POLICY = PoolingPolicy({priority: PRIORITY_ORDER[rank:] for rank, priority in enumerate(PRIORITY_ORDER)},
+                              ("Urgent",), float(os.getenv("URGENT_RESERVE_CUTOFF_HOURS", "4")))
+
+DEFAULT_POLICY = POOLED_POLICY if os.getenv("SLOT_POOLING", "1") != "0" else STRICT_POLICY
+
+
+def bookable_partitions(policy, priority, now):
+    """Returns [(partition priority, starts before)] a patient of priority may book.
+
+    starts before is None, or the datetime a reserved partition opens up until.
+    """
+    partitions = [(partition, None) for partition in policy.borrows.get(priority, [priority])]
+    release_until = now + timedelta(hours=policy.reserve_cutoff_hours)
+    partitions += [(partition, release_until) for partition in policy.reserved
+                   if partition not in policy.borrows.get(priority, [priority])]
+    return partitions
+
+
+def _partition_slots(conn, clinic, partition, mode, start_hour, end_hour, first_day, last_day, after, before):
+    """Iterates (slot_date, start_minute, id, clinic, time) for one partition's free slots in start order.
+
+    One range scan over the composite lookup index; rows are fetched lazily.
+    """
+    before = before or datetime.combine(last_day, datetime.min.time())
+    return conn.execute(f'''SELECT s.slot_date, s.start_minute, s.id, c.name, {SLOT_TIME_SQL} FROM clinics AS c
+                            JOIN available_slots AS s ON s.clinic_id = c.id
+                            WHERE c.name = ?
+                              AND s.priority_id = (SELECT id FROM priorities WHERE name = ?)
+                              AND s.mode_of_consultation = ?
+                              AND s.is_booked = 0
+                              AND s.slot_date >= ? AND s.slot_date < ?
+                              AND s.start_minute >= ? AND s.start_minute < ?
+                              AND (s.slot_date, s.start_minute) >= (?, ?)
+                              AND (s.slot_date, s.start_minute) < (?, ?)
+                            ORDER BY s.slot_date, s.start_minute''',
+                        (clinic, partition, mode,
+                         first_day.isoformat(), last_day.isoformat(),
+                         start_hour * 60, end_hour * 60,
+                         after.date().isoformat(), after.hour * 60 + after.minute,
+                         before.date().isoformat(), before.hour * 60 + before.minute))
+
+
+def _ranked(rank, rows):
+    # Ties on start time go to the lower rank, i.e. the more preferred partition
+    for slot_date, minute, slot_id, name, slot_time in rows:
+        yield slot_date, minute, rank, slot_id, name, slot_time
+
+
+@metrics.timed("db_query_seconds", query="find_pooled_slots")
+def find_pooled_slots(conn, clinic, priority, mode, start_hour, end_hour,
+                      days=SLOT_HORIZON_DAYS, now=None, policy=None, limit=None, after=None):
+    """Like find_available_slots, but over every partition the policy lets priority book.
+
+    Each partition is an ordered index range scan; a heap merges them so the
+    earliest slots come first without sorting or reading the rest. At most one
+    slot is returned per time, from the most preferred partition free then.
+    after (default now) is the earliest start to consider; the reserve cutoff
+    always counts from now.
+    """
+    now = now or datetime.now()
+    policy = policy or DEFAULT_POLICY
+    first_day = now.date()
+    last_day = first_day + timedelta(days=days)
+    after = max(after or now, now)
+    scans = [_ranked(rank, _partition_slots(conn, clinic, partition, mode, start_hour, end_hour,
+                                            first_day, last_day, after, before))
+             for rank, (partition, before) in enumerate(bookable_partitions(policy, priority, now))]
+    found = []
+    last_start = None
+    for slot_date, minute, _, slot_id, name, slot_time in heapq.merge(*scans):
+        if (slot_date, minute) == last_start:
+            continue
+        last_start = (slot_date, minute)
+        found.append((slot_id, name, slot_date, slot_time))
+        if limit is not None and len(found) >= limit:
+            break
+    return found
+
+
+def next_pooled_slot(conn, slot_id, priority, now=None, policy=None):
+    """Returns the earliest free slot at or after slot_id's time, same clinic and mode, that priority may book."""
+    taken = conn.execute('''SELECT c.name, s.slot_date, s.start_minute, s.mode_of_consultation
+                            FROM available_slots AS s JOIN clinics AS c ON c.id = s.clinic_id
+                            WHERE s.id = ?''', (slot_id,)).fetchone()
+    if taken is None:
+        return None
+    clinic, slot_date, start_minute, mode = taken
+    after = datetime.fromisoformat(slot_date) + timedelta(minutes=start_minute)
+    found = find_pooled_slots(conn, clinic, priority, mode, 0, 24, now=now, policy=policy, limit=1, after=after)
+    return found[0] if found else None
+
+# Slots from other clinics or times offered alongside the patient's own choice
+ALTERNATIVE_SLOTS = 5
+
+
+@metrics.timed("db_query_seconds", query="find_alternative_slots")
+def find_alternative_slots(conn, clinic, priority, mode, start_hour, end_hour, limit=ALTERNATIVE_SLOTS,
+                           days=SLOT_HORIZON_DAYS, now=None, policy=None):
+    """Returns up to limit (id, clinic, slot_date, time) free slots outside the chosen clinic and hours, best first.
+
+    Every clinic and every partition the policy lets priority book is searched
+    in one grouped query, keeping one slot per clinic and time. Slots rank by
+    day, then by being in the preferred hours, then at the preferred clinic,
+    then by start time and clinic name. Slots find_pooled_slots offers for the
+    same choice are left out.
+    """
+    now = now or datetime.now()
+    policy = policy or DEFAULT_POLICY
+    first_day = now.date()
+    last_day = first_day + timedelta(days=days)
+    partitions = bookable_partitions(policy, priority, now)
+    partition_sql, partition_params, rank_sql, rank_params = [], [], [], []
+    for rank, (partition, before) in enumerate(partitions):
+        if before:
+            partition_sql.append("(p.name = ? AND (s.slot_date, s.start_minute) < (?, ?))")
+            partition_params += [partition, before.date().isoformat(), before.hour * 60 + before.minute]
+        else:
+            partition_sql.append("p.name = ?")
+            partition_params.append(partition)
+        rank_sql.append("WHEN ? THEN ?")
+        rank_params += [partition, rank]
+    in_window = "s.start_minute >= ? AND s.start_minute < ?"
+    window = [start_hour * 60, end_hour * 60]
+    c = conn.execute(f'''SELECT s.id, c.name, s.slot_date, {SLOT_TIME_SQL},
+                             MIN(CASE p.name {" ".join(rank_sql)} END) AS partition_rank
+                         FROM available_slots AS s
+                         JOIN clinics AS c ON c.id = s.clinic_id
+                         JOIN priorities AS p ON p.id = s.priority_id
+                         WHERE ({" OR ".join(partition_sql)})
+                           AND s.mode_of_consultation = ?
+                           AND s.is_booked = 0
+                           AND s.slot_date >= ? AND s.slot_date < ?
+                           AND (s.slot_date, s.start_minute) >= (?, ?)
+                           AND NOT (c.name = ? AND {in_window})
+                         GROUP BY s.clinic_id, s.slot_date, s.start_minute
+                         ORDER BY s.slot_date, ({in_window}) DESC, c.name = ? DESC, s.start_minute, c.name
+                         LIMIT ?''',
+                     rank_params + partition_params
+                     + [mode, first_day.isoformat(), last_day.isoformat(),
+                        first_day.isoformat(), now.hour * 60 + now.minute, clinic] + window
+                     + window + [clinic, limit])
+    # SQLite takes the bare columns from the row with the lowest partition rank
+    return [row[:4] for row in c.fetchall()]
+
+##############################################
+# Slot Reservation
+##############################################
+
+# reserved is True when the slot was claimed; on conflict, alternative is the
+# next free (id, clinic, slot_date, time) slot the patient may book at the same
+# clinic (see next_pooled_slot), or None.
+ReservationResult = namedtuple("ReservationResult", ["reserved", "slot_id", "alternative"])
+
+
+def claim_slot(conn, slot_id):
+    """Marks slot_id as booked only if it is still free. Does not commit.
+
+    Returns True if this call claimed the slot. The conditional UPDATE is atomic,
+    so of two concurrent callers exactly one sees rowcount == 1.
+    """
+    c = conn.execute("UPDATE available_slots SET is_booked = 1 WHERE id = ? AND is_booked = 0", (slot_id,))
+    return c.rowcount == 1
+
+
+if __name__ == "__main__":
+    # Scheduled refresh, e.g. from cron: python slots.py --days 28
+    from db import DB_PATH, connect, init_db
+
+    parser = argparse.ArgumentParser(description="Extend the rolling slot calendar.")
+    parser.add_argument("--days", type=int, default=SLOT_HORIZON_DAYS)
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--check", action="store_true",
+                        help="also recount the availability counters and rebuild them if they have drifted")
+    args = parser.parse_args()
+    conn = connect(args.db)
+    init_db(conn)
+    inserted = generate_slot_calendar(conn, CLINIC_LOCATIONS, args.days)
+    pruned = prune_past_slots(conn)
+    print(f"Inserted {inserted} slots, pruned {pruned} past unbooked slots.")
+    if args.check:
+        drifted = check_availability(conn, repair=True)
+        print(f"Rebuilt availability counters: {drifted} buckets had drifted." if drifted
+              else "Availability counters match the slot table.")
+    conn.close()
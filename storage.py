@@ -0,0 +1,615 @@
+"""Storage backends for appointments, slots and clinician profiles.
+
+app.py, app_gp.py and profile_worker.py read and write these through the
+Repository get_repository() returns, chosen with STORAGE_BACKEND:
+
+    sqlite    the appointments database file (APPOINTMENTS_DB) through db.py's pool (default)
+    postgres  the PostgreSQL database at POSTGRES_DSN through a psycopg pool, so several
+              app hosts can book against one database; needs the psycopg and psycopg_pool packages
+
+Both pass storage_conformance.py. The triage and translation caches and the
+SQLite session store stay in each host's local SQLite file.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import appointments
+import metrics
+import profiles
+import slots
+from db import DB_PATH, POOL_SIZE, connection, get_pool, init_db
+from profiles import PROFILE_LANGUAGES, STALE_JOB_SECONDS
+from slots import (ALTERNATIVE_SLOTS, DEFAULT_POLICY, SLOT_HORIZON_DAYS, SLOT_MODE, SLOT_PRIORITIES,
+                   ReservationResult, bookable_partitions, slot_start_minutes)
+
+try:
+    import psycopg
+    from psycopg_pool import ConnectionPool as PostgresPool
+except ImportError:  # Only needed for STORAGE_BACKEND=postgres
+    psycopg = None
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+POSTGRES_DSN = os.getenv("POSTGRES_DSN", "postgresql://localhost/appointments")
+POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE", str(POOL_SIZE)))
+
+##############################################
+# Repository Interface
+##############################################
+
+class Repository:
+    """Appointments, slots and profiles in one database.
+
+    Each method behaves as the function of the same name in slots.py,
+    appointments.py or profiles.py, without the connection argument; those
+    docstrings are the contract storage_conformance.py checks.
+    """
+
+    def init_schema(self):
+        """Creates the tables, or migrates them to the current version."""
+        raise NotImplementedError
+
+    # Slots
+    def generate_slot_calendar(self, clinics, days=SLOT_HORIZON_DAYS, start_date=None):
+        raise NotImplementedError
+
+    def prune_past_slots(self, today=None):
+        raise NotImplementedError
+
+    def find_pooled_slots(self, clinic, priority, mode, start_hour, end_hour,
+                          days=SLOT_HORIZON_DAYS, now=None, policy=None, limit=None, after=None):
+        raise NotImplementedError
+
+    def find_alternative_slots(self, clinic, priority, mode, start_hour, end_hour, limit=ALTERNATIVE_SLOTS,
+                               days=SLOT_HORIZON_DAYS, now=None, policy=None):
+        raise NotImplementedError
+
+    def availability_summary(self, first_day, days=1, clinic=None):
+        raise NotImplementedError
+
+    # Appointments
+    def book_appointment(self, submission_token, appointment, slot_id):
+        raise NotImplementedError
+
+    def find_booking(self, submission_token):
+        raise NotImplementedError
+
+    def list_appointments(self, page_size=25, before_id=None, priority=None, clinic=None,
+                          booked_from=None, booked_to=None):
+        raise NotImplementedError
+
+    def get_appointment(self, appointment_id):
+        raise NotImplementedError
+
+    def triage_source_counts(self):
+        raise NotImplementedError
+
+    # Profiles
+    def enqueue_profile_jobs(self, languages=PROFILE_LANGUAGES, after_id=0):
+        """Returns (jobs added, highest appointment id scanned); see profiles.enqueue_profile_jobs."""
+        raise NotImplementedError
+
+    def claim_profile_jobs(self, limit, stale_seconds=STALE_JOB_SECONDS, max_attempts=3):
+        raise NotImplementedError
+
+    def store_profile(self, appointment_id, language, row_version, profile):
+        raise NotImplementedError
+
+    def fail_profile_job(self, appointment_id, language, row_version, error, max_attempts=3):
+        raise NotImplementedError
+
+    def get_stored_profile(self, appointment_id, language):
+        raise NotImplementedError
+
+    def profile_job_progress(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+##############################################
+# SQLite Repository
+##############################################
+
+def _on_connection(func):
+    """A repository method running func(conn, ...) on a connection from the repository's pool."""
+    def method(self, *args, **kwargs):
+        with self.connection() as conn:
+            return func(conn, *args, **kwargs)
+    method.__name__ = func.__name__
+    method.__doc__ = func.__doc__
+    return method
+
+
+class SQLiteRepository(Repository):
+    """The tables in one SQLite file, through db.py's connection pool."""
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+
+    def connection(self):
+        return connection(self.path)
+
+    def close(self):
+        get_pool(self.path).close()
+
+    init_schema = _on_connection(init_db)
+
+    generate_slot_calendar = _on_connection(slots.generate_slot_calendar)
+    prune_past_slots = _on_connection(slots.prune_past_slots)
+    find_pooled_slots = _on_connection(slots.find_pooled_slots)
+    find_alternative_slots = _on_connection(slots.find_alternative_slots)
+    availability_summary = _on_connection(slots.availability_summary)
+
+    book_appointment = _on_connection(appointments.book_appointment)
+    find_booking = _on_connection(appointments.find_booking)
+    list_appointments = _on_connection(appointments.list_appointments)
+    get_appointment = _on_connection(appointments.get_appointment)
+    triage_source_counts = _on_connection(appointments.triage_source_counts)
+
+    enqueue_profile_jobs = _on_connection(profiles.enqueue_profile_jobs)
+    claim_profile_jobs = _on_connection(profiles.claim_profile_jobs)
+    store_profile = _on_connection(profiles.store_profile)
+    fail_profile_job = _on_connection(profiles.fail_profile_job)
+    get_stored_profile = _on_connection(profiles.get_stored_profile)
+    profile_job_progress = _on_connection(profiles.profile_job_progress)
+
+##############################################
+# PostgreSQL Repository
+##############################################
+
+# Column types follow the SQLite schema (ISO date strings, 0/1 flags, minutes
+# after midnight), so both backends hand the apps identical rows.
+POSTGRES_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS clinics (
+       id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+       name TEXT NOT NULL UNIQUE
+       )''',
+    '''CREATE TABLE IF NOT EXISTS priorities (
+       id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+       name TEXT NOT NULL UNIQUE
+       )''',
+    '''CREATE TABLE IF NOT EXISTS appointments (
+       id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+       name TEXT,
+       priority_id INTEGER REFERENCES priorities (id),
+       clinic_id INTEGER REFERENCES clinics (id),
+       time_preference TEXT,
+       mode_of_consultation TEXT,
+       phone_number TEXT,
+       answers TEXT,
+       date_of_birth TEXT,
+       has_symptoms INTEGER,
+       emergency_contraception INTEGER,
+       needs_translator INTEGER,
+       translator_language TEXT,
+       submission_token TEXT,
+       slot_id BIGINT,
+       triage_source TEXT,
+       created_at TEXT,
+       row_version INTEGER DEFAULT 1,
+       age INTEGER GENERATED ALWAYS AS (
+           CASE WHEN answers::jsonb ->> 'age' ~ '^[0-9]+$' THEN (answers::jsonb ->> 'age')::integer END) STORED,
+       gender TEXT GENERATED ALWAYS AS (answers::jsonb ->> 'gender') STORED
+       )''',
+    # Any edit to an appointment bumps its version, so profiles formatted from the old row are ignored
+    '''CREATE OR REPLACE FUNCTION bump_row_version() RETURNS trigger LANGUAGE plpgsql AS $$
+       BEGIN
+           IF NEW.row_version IS NOT DISTINCT FROM OLD.row_version THEN
+               NEW.row_version := OLD.row_version + 1;
+           END IF;
+           RETURN NEW;
+       END $$''',
+    '''CREATE OR REPLACE TRIGGER trg_appointments_row_version
+       BEFORE UPDATE ON appointments
+       FOR EACH ROW EXECUTE FUNCTION bump_row_version()''',
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_submission_token ON appointments (submission_token)",
+    "CREATE INDEX IF NOT EXISTS idx_appointments_priority ON appointments (priority_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_appointments_clinic ON appointments (clinic_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_appointments_created_at ON appointments (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_appointments_age ON appointments (age)",
+    '''CREATE TABLE IF NOT EXISTS available_slots (
+       id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+       clinic_id INTEGER REFERENCES clinics (id),
+       slot_date TEXT,
+       start_minute INTEGER,
+       priority_id INTEGER REFERENCES priorities (id),
+       mode_of_consultation TEXT,
+       is_booked INTEGER DEFAULT 0
+       )''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS idx_available_slots_unique
+       ON available_slots (clinic_id, slot_date, start_minute, priority_id, mode_of_consultation)''',
+    '''CREATE INDEX IF NOT EXISTS idx_available_slots_lookup
+       ON available_slots (clinic_id, priority_id, mode_of_consultation, is_booked, slot_date, start_minute)''',
+    # Capacity is counted from the slots of the requested days rather than kept in trigger-maintained counters
+    "CREATE INDEX IF NOT EXISTS idx_available_slots_date ON available_slots (slot_date, clinic_id)",
+    '''CREATE TABLE IF NOT EXISTS formatted_profiles (
+       appointment_id BIGINT,
+       language TEXT,
+       row_version INTEGER,
+       status TEXT DEFAULT 'pending',
+       profile TEXT,
+       attempts INTEGER DEFAULT 0,
+       error TEXT,
+       updated_at DOUBLE PRECISION,
+       PRIMARY KEY (appointment_id, language, row_version)
+       )''',
+    "CREATE INDEX IF NOT EXISTS idx_formatted_profiles_status ON formatted_profiles (status, updated_at)",
+]
+
+# Serializes init_schema across hosts; CREATE ... IF NOT EXISTS alone can race in PostgreSQL
+SCHEMA_LOCK_ID = 0x5A77
+
+# Formats available_slots.start_minute (aliased s) back to 'HH:MM', as slots.SLOT_TIME_SQL does
+POSTGRES_SLOT_TIME_SQL = "lpad((s.start_minute / 60)::text, 2, '0') || ':' || lpad(mod(s.start_minute, 60)::text, 2, '0')"
+
+
+class PostgresRepository(Repository):
+    """The tables in a PostgreSQL database, through a pool of autocommit connections.
+
+    Multi-statement writes run in explicit transactions. Slot and profile job
+    claims lock rows with FOR UPDATE SKIP LOCKED, so concurrent bookings and
+    workers on any host never wait on one another's rows.
+    """
+
+    def __init__(self, dsn=POSTGRES_DSN, pool_size=POSTGRES_POOL_SIZE):
+        if psycopg is None:
+            raise ImportError('STORAGE_BACKEND=postgres needs: pip install "psycopg[binary]" psycopg_pool')
+        self.pool = PostgresPool(dsn, min_size=1, max_size=pool_size, kwargs={"autocommit": True},
+                                 name="appointments", open=True)
+
+    @contextmanager
+    def connection(self):
+        """Checks a connection out for the duration of the block; blocks while all are in use."""
+        with metrics.timer("db_pool_wait_seconds"):
+            conn = self.pool.getconn()
+        try:
+            yield conn
+        finally:
+            self.pool.putconn(conn)
+
+    def close(self):
+        self.pool.close()
+
+    def init_schema(self):
+        with self.connection() as conn, conn.transaction():
+            conn.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+            for statement in POSTGRES_SCHEMA:
+                conn.execute(statement)
+            self._add_lookup_names(conn, "clinics", slots.CLINIC_LOCATIONS)
+            self._add_lookup_names(conn, "priorities", SLOT_PRIORITIES)
+
+    @staticmethod
+    def _add_lookup_names(conn, table, names):
+        conn.execute(f'''INSERT INTO {table} (name) SELECT name FROM unnest(%s::text[]) WITH ORDINALITY AS n (name, i)
+                         ORDER BY i ON CONFLICT (name) DO NOTHING''', (list(names),))
+
+    # Slots
+
+    @metrics.timed("db_query_seconds", query="generate_slot_calendar")
+    def generate_slot_calendar(self, clinics, days=SLOT_HORIZON_DAYS, start_date=None):
+        start_date = start_date or date.today()
+        with self.connection() as conn, conn.transaction():
+            self._add_lookup_names(conn, "clinics", clinics)
+            self._add_lookup_names(conn, "priorities", SLOT_PRIORITIES)
+            c = conn.execute('''INSERT INTO available_slots
+                                (clinic_id, slot_date, start_minute, priority_id, mode_of_consultation)
+                                SELECT c.id, to_char(%s::date + d, 'YYYY-MM-DD'), m, p.id, %s
+                                FROM clinics AS c, generate_series(0, %s - 1) AS d,
+                                     unnest(%s::integer[]) AS m, priorities AS p
+                                WHERE c.name = ANY (%s) AND p.name = ANY (%s)
+                                ORDER BY c.id, d, m, p.id
+                                ON CONFLICT DO NOTHING''',
+                             (start_date, SLOT_MODE, days, slot_start_minutes(), list(clinics), SLOT_PRIORITIES))
+        return c.rowcount
+
+    def prune_past_slots(self, today=None):
+        today = today or date.today()
+        with self.connection() as conn:
+            c = conn.execute("DELETE FROM available_slots WHERE slot_date < %s AND is_booked = 0",
+                             (today.isoformat(),))
+        return c.rowcount
+
+    @metrics.timed("db_query_seconds", query="find_pooled_slots")
+    def find_pooled_slots(self, clinic, priority, mode, start_hour, end_hour,
+                          days=SLOT_HORIZON_DAYS, now=None, policy=None, limit=None, after=None):
+        with self.connection() as conn:
+            return self._find_pooled_slots(conn, clinic, priority, mode, start_hour, end_hour,
+                                           days, now, policy, limit, after)
+
+    @staticmethod
+    def _find_pooled_slots(conn, clinic, priority, mode, start_hour, end_hour, days, now, policy, limit, after):
+        # One index range scan per partition; DISTINCT ON keeps the most preferred partition free at each time
+        now = now or datetime.now()
+        policy = policy or DEFAULT_POLICY
+        first_day = now.date()
+        last_day = first_day + timedelta(days=days)
+        after = max(after or now, now)
+        scans, params = [], []
+        for rank, (partition, before) in enumerate(bookable_partitions(policy, priority, now)):
+            before = before or datetime.combine(last_day, datetime.min.time())
+            scans.append(f'''SELECT s.slot_date, s.start_minute, {rank} AS partition_rank, s.id, c.name,
+                                    {POSTGRES_SLOT_TIME_SQL} AS slot_time
+                             FROM clinics AS c
+                             JOIN available_slots AS s ON s.clinic_id = c.id
+                             WHERE c.name = %s
+                               AND s.priority_id = (SELECT id FROM priorities WHERE name = %s)
+                               AND s.mode_of_consultation = %s
+                               AND s.is_booked = 0
+                               AND s.slot_date >= %s AND s.slot_date < %s
+                               AND s.start_minute >= %s AND s.start_minute < %s
+                               AND (s.slot_date, s.start_minute) >= (%s, %s)
+                               AND (s.slot_date, s.start_minute) < (%s, %s)''')
+            params += [clinic, partition, mode,
+                       first_day.isoformat(), last_day.isoformat(),
+                       start_hour * 60, end_hour * 60,
+                       after.date().isoformat(), after.hour * 60 + after.minute,
+                       before.date().isoformat(), before.hour * 60 + before.minute]
+        return conn.execute(f'''SELECT DISTINCT ON (slot_date, start_minute) id, name, slot_date, slot_time
+                                FROM ({" UNION ALL ".join(scans)}) AS free
+                                ORDER BY slot_date, start_minute, partition_rank
+                                LIMIT %s''', params + [limit]).fetchall()
+
+    def _next_pooled_slot(self, conn, slot_id, priority):
+        taken = conn.execute('''SELECT c.name, s.slot_date, s.start_minute, s.mode_of_consultation
+                                FROM available_slots AS s JOIN clinics AS c ON c.id = s.clinic_id
+                                WHERE s.id = %s''', (slot_id,)).fetchone()
+        if taken is None:
+            return None
+        clinic, slot_date, start_minute, mode = taken
+        after = datetime.fromisoformat(slot_date) + timedelta(minutes=start_minute)
+        found = self._find_pooled_slots(conn, clinic, priority, mode, 0, 24, SLOT_HORIZON_DAYS, None, None, 1, after)
+        return found[0] if found else None
+
+    @metrics.timed("db_query_seconds", query="find_alternative_slots")
+    def find_alternative_slots(self, clinic, priority, mode, start_hour, end_hour, limit=ALTERNATIVE_SLOTS,
+                               days=SLOT_HORIZON_DAYS, now=None, policy=None):
+        now = now or datetime.now()
+        policy = policy or DEFAULT_POLICY
+        first_day = now.date()
+        last_day = first_day + timedelta(days=days)
+        partition_sql, partition_params, rank_sql, rank_params = [], [], [], []
+        for rank, (partition, before) in enumerate(bookable_partitions(policy, priority, now)):
+            if before:
+                partition_sql.append("(p.name = %s AND (s.slot_date, s.start_minute) < (%s, %s))")
+                partition_params += [partition, before.date().isoformat(), before.hour * 60 + before.minute]
+            else:
+                partition_sql.append("p.name = %s")
+                partition_params.append(partition)
+            rank_sql.append("WHEN %s THEN %s")
+            rank_params += [partition, rank]
+        window = [start_hour * 60, end_hour * 60]
+        with self.connection() as conn:
+            return conn.execute(f'''SELECT id, name, slot_date, slot_time FROM (
+                                        SELECT DISTINCT ON (s.clinic_id, s.slot_date, s.start_minute)
+                                               s.id, c.name, s.slot_date, s.start_minute,
+                                               {POSTGRES_SLOT_TIME_SQL} AS slot_time
+                                        FROM available_slots AS s
+                                        JOIN clinics AS c ON c.id = s.clinic_id
+                                        JOIN priorities AS p ON p.id = s.priority_id
+                                        WHERE ({" OR ".join(partition_sql)})
+                                          AND s.mode_of_consultation = %s
+                                          AND s.is_booked = 0
+                                          AND s.slot_date >= %s AND s.slot_date < %s
+                                          AND (s.slot_date, s.start_minute) >= (%s, %s)
+                                          AND NOT (c.name = %s AND s.start_minute >= %s AND s.start_minute < %s)
+                                        ORDER BY s.clinic_id, s.slot_date, s.start_minute,
+                                                 CASE p.name {" ".join(rank_sql)} END
+                                    ) AS free
+                                    ORDER BY slot_date, (start_minute >= %s AND start_minute < %s) DESC,
+                                             name = %s DESC, start_minute, name
+                                    LIMIT %s''',
+                                partition_params
+                                + [mode, first_day.isoformat(), last_day.isoformat(),
+                                   first_day.isoformat(), now.hour * 60 + now.minute, clinic] + window
+                                + rank_params + window + [clinic, limit]).fetchall()
+
+    @metrics.timed("db_query_seconds", query="availability_summary")
+    def availability_summary(self, first_day, days=1, clinic=None):
+        last_day = first_day + timedelta(days=days)
+        with self.connection() as conn:
+            return conn.execute('''SELECT s.slot_date, c.name, s.start_minute / 60 AS hour, p.name,
+                                          COUNT(*) FILTER (WHERE s.is_booked = 0),
+                                          COUNT(*) FILTER (WHERE s.is_booked != 0)
+                                   FROM available_slots AS s
+                                   JOIN clinics AS c ON c.id = s.clinic_id
+                                   JOIN priorities AS p ON p.id = s.priority_id
+                                   WHERE s.slot_date >= %s AND s.slot_date < %s AND (%s::text IS NULL OR c.name = %s)
+                                   GROUP BY s.slot_date, c.name, hour, p.id, p.name
+                                   ORDER BY s.slot_date, c.name, hour, p.id''',
+                                (first_day.isoformat(), last_day.isoformat(), clinic, clinic)).fetchall()
+
+    # Appointments
+
+    @staticmethod
+    def _find_booking(conn, submission_token):
+        row = conn.execute("SELECT slot_id FROM appointments WHERE submission_token = %s",
+                           (submission_token,)).fetchone()
+        return row[0] if row else None
+
+    def find_booking(self, submission_token):
+        with self.connection() as conn:
+            return self._find_booking(conn, submission_token)
+
+    @metrics.timed("db_query_seconds", query="book_appointment")
+    def book_appointment(self, submission_token, appointment, slot_id):
+        with self.connection() as conn:
+            booked_slot_id = self._find_booking(conn, submission_token)
+            if booked_slot_id is not None:
+                metrics.increment("bookings_total", result="duplicate")
+                return ReservationResult(True, booked_slot_id, None)
+
+            result = "reserved"
+            with conn.transaction() as transaction:
+                # A slot another booking holds right now counts as taken, so this patient is
+                # offered the next one at once instead of queueing behind that transaction
+                if conn.execute("SELECT id FROM available_slots WHERE id = %s AND is_booked = 0 "
+                                "FOR UPDATE SKIP LOCKED", (slot_id,)).fetchone() is None:
+                    result = "conflict"
+                    raise psycopg.Rollback(transaction)
+                conn.execute("UPDATE available_slots SET is_booked = 1 WHERE id = %s", (slot_id,))
+                columns = appointments.APPOINTMENT_COLUMNS + ["submission_token", "slot_id", "created_at"]
+                values = [appointment.get(column) for column in appointments.APPOINTMENT_COLUMNS] + [
+                    submission_token, slot_id, datetime.now().isoformat(sep=" ", timespec="seconds")]
+                inserted = conn.execute(f'''INSERT INTO appointments ({", ".join(columns)}, priority_id, clinic_id)
+                                            VALUES ({", ".join(["%s"] * len(columns))},
+                                                    (SELECT id FROM priorities WHERE name = %s),
+                                                    (SELECT id FROM clinics WHERE name = %s))
+                                            ON CONFLICT (submission_token) DO NOTHING
+                                            RETURNING id''',
+                                        values + [appointment.get("priority"), appointment.get("clinic")]).fetchone()
+                if inserted is None:
+                    # The same submission won a race on another connection; keep its booking
+                    result = "duplicate"
+                    raise psycopg.Rollback(transaction)
+
+            metrics.increment("bookings_total", result=result)
+            if result == "conflict":
+                return ReservationResult(False, slot_id,
+                                         self._next_pooled_slot(conn, slot_id, appointment.get("priority")))
+            if result == "duplicate":
+                return ReservationResult(True, self._find_booking(conn, submission_token), None)
+            return ReservationResult(True, slot_id, None)
+
+    @metrics.timed("db_query_seconds", query="list_appointments")
+    def list_appointments(self, page_size=25, before_id=None, priority=None, clinic=None,
+                          booked_from=None, booked_to=None):
+        conditions = []
+        params = []
+        if before_id is not None:
+            conditions.append("a.id < %s")
+            params.append(before_id)
+        if priority:
+            conditions.append("a.priority_id = (SELECT id FROM priorities WHERE name = %s)")
+            params.append(priority)
+        if clinic:
+            conditions.append("a.clinic_id = (SELECT id FROM clinics WHERE name = %s)")
+            params.append(clinic)
+        if booked_from:
+            conditions.append("a.created_at >= %s")
+            params.append(booked_from.isoformat())
+        if booked_to:
+            conditions.append("a.created_at < %s")
+            params.append((booked_to + timedelta(days=1)).isoformat())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.connection() as conn:
+            return conn.execute(f'''SELECT {", ".join(appointments.APPOINTMENT_LIST_COLUMNS)}
+                                    FROM {appointments.APPOINTMENT_JOIN_SQL}
+                                    {where}
+                                    ORDER BY a.id DESC
+                                    LIMIT %s''', params + [page_size]).fetchall()
+
+    @metrics.timed("db_query_seconds", query="get_appointment")
+    def get_appointment(self, appointment_id):
+        with self.connection() as conn:
+            c = conn.execute(f'''SELECT a.*, p.name AS priority, c.name AS clinic
+                                 FROM {appointments.APPOINTMENT_JOIN_SQL}
+                                 WHERE a.id = %s''', (appointment_id,))
+            row = c.fetchone()
+            if row is None:
+                return None
+            appointment = dict(zip([column.name for column in c.description], row))
+        del appointment["priority_id"], appointment["clinic_id"]
+        return appointment
+
+    def triage_source_counts(self):
+        with self.connection() as conn:
+            return dict(conn.execute('''SELECT COALESCE(triage_source, 'unknown'), COUNT(*)
+                                        FROM appointments GROUP BY 1''').fetchall())
+
+    # Profiles
+
+    def enqueue_profile_jobs(self, languages=PROFILE_LANGUAGES, after_id=0):
+        with self.connection() as conn:
+            last_id = conn.execute("SELECT COALESCE(max(id), 0) FROM appointments").fetchone()[0]
+            c = conn.execute('''INSERT INTO formatted_profiles (appointment_id, language, row_version, updated_at)
+                                SELECT a.id, l.language, a.row_version, extract(epoch FROM now())
+                                FROM appointments AS a CROSS JOIN unnest(%s::text[]) AS l (language)
+                                WHERE a.id > %s AND a.id <= %s
+                                ON CONFLICT DO NOTHING''', (list(languages), after_id, last_id))
+        return c.rowcount, max(last_id, after_id)
+
+    def claim_profile_jobs(self, limit, stale_seconds=STALE_JOB_SECONDS, max_attempts=3):
+        # SKIP LOCKED lets workers on several hosts claim disjoint batches without waiting on each other
+        with self.connection() as conn, conn.transaction():
+            conn.execute('''UPDATE formatted_profiles
+                            SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                                error = COALESCE(error, 'worker stopped while formatting')
+                            WHERE status = 'running' AND updated_at < extract(epoch FROM now()) - %s''',
+                         (max_attempts, stale_seconds))
+            jobs = conn.execute('''WITH claimed AS (
+                                       SELECT f.appointment_id, f.language, f.row_version
+                                       FROM formatted_profiles AS f
+                                       JOIN appointments AS a ON a.id = f.appointment_id
+                                                             AND a.row_version = f.row_version
+                                       WHERE f.status = 'pending'
+                                       ORDER BY f.appointment_id DESC
+                                       LIMIT %s
+                                       FOR UPDATE OF f SKIP LOCKED)
+                                   UPDATE formatted_profiles AS f
+                                   SET status = 'running', attempts = f.attempts + 1,
+                                       updated_at = extract(epoch FROM now())
+                                   FROM claimed
+                                   WHERE f.appointment_id = claimed.appointment_id AND f.language = claimed.language
+                                     AND f.row_version = claimed.row_version
+                                   RETURNING f.appointment_id, f.language, f.row_version''', (limit,)).fetchall()
+        return sorted(jobs, key=lambda job: job[0], reverse=True)
+
+    def store_profile(self, appointment_id, language, row_version, profile):
+        with self.connection() as conn:
+            conn.execute('''INSERT INTO formatted_profiles (appointment_id, language, row_version, status, profile,
+                                                            updated_at)
+                            VALUES (%s, %s, %s, 'done', %s, extract(epoch FROM now()))
+                            ON CONFLICT (appointment_id, language, row_version)
+                            DO UPDATE SET status = 'done', profile = excluded.profile, error = NULL,
+                                          updated_at = excluded.updated_at''',
+                         (appointment_id, language, row_version, profile))
+
+    def fail_profile_job(self, appointment_id, language, row_version, error, max_attempts=3):
+        with self.connection() as conn:
+            conn.execute('''UPDATE formatted_profiles
+                            SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                                error = %s, updated_at = extract(epoch FROM now())
+                            WHERE appointment_id = %s AND language = %s AND row_version = %s''',
+                         (max_attempts, str(error), appointment_id, language, row_version))
+
+    def get_stored_profile(self, appointment_id, language):
+        with self.connection() as conn:
+            row = conn.execute('''SELECT f.profile FROM formatted_profiles AS f
+                                  JOIN appointments AS a ON a.id = f.appointment_id AND a.row_version = f.row_version
+                                  WHERE f.status = 'done' AND f.appointment_id = %s AND f.language = %s''',
+                               (appointment_id, language)).fetchone()
+        return row[0] if row else None
+
+    def profile_job_progress(self):
+        with self.connection() as conn:
+            return dict(conn.execute('''SELECT f.status, COUNT(*) FROM formatted_profiles AS f
+                                        JOIN appointments AS a ON a.id = f.appointment_id
+                                                              AND a.row_version = f.row_version
+                                        GROUP BY f.status''').fetchall())
+
+##############################################
+# Backend Selection
+##############################################
+
+def open_repository(backend=STORAGE_BACKEND, path=DB_PATH, dsn=POSTGRES_DSN):
+    """Returns a new repository for backend ("sqlite" or "postgres")."""
+    if backend == "sqlite":
+        return SQLiteRepository(path)
+    if backend == "postgres":
+        return PostgresRepository(dsn)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend!r}")
+
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+def get_repository():
+    """Returns the process-wide repository, configured from the environment on first use."""
+    global _repository
+    with _repository_lock:
+        if _repository is None:
+            _repository = open_repository()
+        return _repository
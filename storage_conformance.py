@@ -0,0 +1,339 @@
+"""Checks a storage backend against the behaviour the apps rely on.
+
+Every check runs against a fresh, empty store: a temporary SQLite file, or a
+throwaway schema in the given PostgreSQL database that is dropped afterwards,
+so any database you may create schemas in will do.
+
+Usage:
+    python storage_conformance.py                                   # SQLite
+    python storage_conformance.py --backend postgres --dsn postgresql://localhost/postgres
+
+Exits with status 1 if any check fails.
+"""
+import argparse
+import json
+import os
+import secrets
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time as clock, timedelta
+
+from slots import CLINIC_LOCATIONS, SLOT_MODE, SLOT_PRIORITIES, STRICT_POLICY, POOLED_POLICY, slot_start_minutes
+from storage import POSTGRES_DSN, PostgresRepository, SQLiteRepository
+
+CLINIC = CLINIC_LOCATIONS[0]
+DAYS = 3
+SLOTS_PER_DAY = len(slot_start_minutes()) * len(SLOT_PRIORITIES)
+# Tomorrow at opening time, so no check depends on the time of day it runs at
+NOW = datetime.combine(date.today() + timedelta(days=1), clock(8))
+
+CHECKS = []
+
+
+def check(func):
+    """Registers a conformance check, called with a fresh repository that has its schema."""
+    CHECKS.append(func)
+    return func
+
+
+def expect(actual, expected, what):
+    if actual != expected:
+        raise AssertionError(f"{what}: expected {expected!r}, got {actual!r}")
+
+
+def with_calendar(repository):
+    repository.generate_slot_calendar(CLINIC_LOCATIONS, DAYS, start_date=date.today())
+
+
+def appointment(priority="Routine Symptoms", clinic=CLINIC, **answers):
+    return {"name": "Test Patient", "priority": priority, "clinic": clinic, "time_preference": "Morning",
+            "mode_of_consultation": SLOT_MODE, "phone_number": "07700900000",
+            "answers": json.dumps({"age": 30, "gender": "Female", **answers}), "date_of_birth": "1995-01-01",
+            "has_symptoms": 1, "emergency_contraception": 0, "needs_translator": 0,
+            "translator_language": None, "triage_source": "llm"}
+
+
+def book(repository, slot_id, priority="Routine Symptoms", token=None):
+    return repository.book_appointment(token or secrets.token_hex(8), appointment(priority), slot_id)
+
+##############################################
+# Checks
+##############################################
+
+@check
+def schema_init_is_idempotent(repository):
+    repository.init_schema()
+    expect(repository.list_appointments(), [], "appointments after a second init_schema")
+
+
+@check
+def calendar_inserts_only_missing_slots(repository):
+    expect(repository.generate_slot_calendar(CLINIC_LOCATIONS, DAYS, start_date=date.today()),
+           len(CLINIC_LOCATIONS) * DAYS * SLOTS_PER_DAY, "slots inserted into an empty calendar")
+    expect(repository.generate_slot_calendar(CLINIC_LOCATIONS, DAYS, start_date=date.today()), 0,
+           "slots inserted again")
+    expect(repository.generate_slot_calendar(CLINIC_LOCATIONS, DAYS + 1, start_date=date.today()),
+           len(CLINIC_LOCATIONS) * SLOTS_PER_DAY, "slots inserted for one more day")
+
+
+@check
+def pruning_keeps_booked_slots(repository):
+    yesterday = date.today() - timedelta(days=1)
+    repository.generate_slot_calendar([CLINIC], 1, start_date=yesterday)
+    repository.generate_slot_calendar([CLINIC], 1, start_date=date.today())
+    summary = repository.availability_summary(yesterday)
+    expect(sum(row[4] for row in summary), SLOTS_PER_DAY, "free slots yesterday")
+    # Book one of yesterday's slots through a search anchored then
+    then = datetime.combine(yesterday, clock(8))
+    slot = repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 9, days=1, now=then, limit=1)[0]
+    expect(book(repository, slot[0], "Urgent").reserved, True, "booking yesterday's slot")
+    expect(repository.prune_past_slots(), SLOTS_PER_DAY - 1, "unbooked past slots pruned")
+    summary = repository.availability_summary(yesterday)
+    expect([(row[4], row[5]) for row in summary], [(0, 1)], "yesterday's counts after pruning")
+    expect(sum(row[4] for row in repository.availability_summary(date.today())), SLOTS_PER_DAY,
+           "today's free slots after pruning")
+
+
+@check
+def pooled_search_is_ordered_and_one_per_time(repository):
+    with_calendar(repository)
+    found = repository.find_pooled_slots(CLINIC, "Routine No Symptoms", SLOT_MODE, 8, 11, now=NOW)
+    times = [(slot[2], slot[3]) for slot in found]
+    expect(times, sorted(set(times)), "slot times, earliest first without repeats")
+    expect(found[0][1:], (CLINIC, NOW.date().isoformat(), "08:00"), "earliest slot")
+    expect(len(found), (DAYS - 1) * 12, "slots 08:00-11:00 from tomorrow to the calendar's end")
+    expect(len(repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=5)), 5,
+           "slots with limit=5")
+    later = repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=1,
+                                         after=NOW + timedelta(minutes=20))
+    expect(later[0][3], "08:30", "first slot at or after 08:20")
+
+
+@check
+def pooled_search_honours_the_urgent_reserve(repository):
+    with_calendar(repository)
+    urgent_ids = {slot[0] for slot in repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW,
+                                                                   policy=STRICT_POLICY)}
+    policy = POOLED_POLICY._replace(reserve_cutoff_hours=2)
+
+    def first_from(hour):
+        return repository.find_pooled_slots(CLINIC, "Routine No Symptoms", SLOT_MODE, hour, 19, now=NOW,
+                                            policy=policy, limit=1)[0]
+
+    own = first_from(8)
+    expect((own[3], own[0] in urgent_ids), ("08:00", False), "routine patients' own 08:00 slot first")
+    book(repository, own[0], "Routine No Symptoms")
+    borrowed = first_from(8)
+    expect((borrowed[3], borrowed[0] in urgent_ids), ("08:00", True), "urgent 08:00 slot, inside the cutoff, next")
+    book(repository, first_from(10)[0], "Routine No Symptoms")
+    expect(first_from(10)[3], "10:15", "urgent 10:00 slot, at the cutoff, held back")
+
+
+@check
+def alternatives_skip_the_patients_own_choice(repository):
+    with_calendar(repository)
+    found = repository.find_alternative_slots(CLINIC, "Routine Symptoms", SLOT_MODE, 8, 11, limit=5, now=NOW)
+    expect(len(found), 5, "alternatives with limit=5")
+    for slot_id, clinic, slot_date, slot_time in found:
+        expect(clinic == CLINIC and "08:00" <= slot_time < "11:00", False, f"alternative {slot_id} outside the choice")
+    expect([slot[2] for slot in found], sorted(slot[2] for slot in found), "alternatives ordered by day")
+    expect(all(slot[3] < "11:00" for slot in found), True, "same-day alternatives in the preferred hours first")
+    times = [(slot[1], slot[2], slot[3]) for slot in found]
+    expect(len(times), len(set(times)), "one alternative per clinic and time")
+
+
+@check
+def booking_claims_a_slot_once(repository):
+    with_calendar(repository)
+    slot = repository.find_pooled_slots(CLINIC, "Routine Symptoms", SLOT_MODE, 8, 19, now=NOW, limit=1)[0]
+    first = book(repository, slot[0], token="first")
+    expect(tuple(first), (True, slot[0], None), "first booking")
+    expect(tuple(book(repository, slot[0], token="first")), (True, slot[0], None), "repeated submission")
+    conflict = book(repository, slot[0], token="second")
+    expect((conflict.reserved, conflict.slot_id), (False, slot[0]), "booking a taken slot")
+    expect(conflict.alternative is not None and conflict.alternative[0] != slot[0], True,
+           "a different free slot offered on conflict")
+    expect(repository.find_booking("first"), slot[0], "find_booking")
+    expect(repository.find_booking("missing"), None, "find_booking for an unknown token")
+    remaining = repository.find_pooled_slots(CLINIC, "Routine Symptoms", SLOT_MODE, 8, 19, now=NOW, limit=1)
+    expect(remaining[0][0] != slot[0], True, "a booked slot is no longer offered")
+
+
+@check
+def concurrent_bookings_of_one_slot_have_one_winner(repository):
+    with_calendar(repository)
+    slot = repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=1)[0]
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: book(repository, slot[0], "Urgent", f"patient-{i}"), range(16)))
+    expect(sum(result.reserved for result in results), 1, "bookings that won the slot")
+    expect(len(repository.list_appointments(page_size=100)), 1, "appointments saved")
+
+
+@check
+def concurrent_bookings_of_different_slots_all_succeed(repository):
+    with_calendar(repository)
+    found = repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=16, policy=STRICT_POLICY)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda slot: book(repository, slot[0], "Urgent"), found))
+    expect(all(result.reserved for result in results), True, "every booking of a distinct slot")
+    day = repository.availability_summary(NOW.date(), clinic=CLINIC)
+    expect(sum(row[5] for row in day), 16, "booked slots counted for the day")
+    expect(sum(row[4] for row in day), SLOTS_PER_DAY - 16, "free slots counted for the day")
+
+
+@check
+def appointments_read_back_with_names(repository):
+    with_calendar(repository)
+    found = repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=3, policy=STRICT_POLICY)
+    for slot, priority in zip(found, ["Urgent", "Routine Symptoms", "Urgent"]):
+        book(repository, slot[0], priority)
+    rows = repository.list_appointments()
+    expect([row[2] for row in rows], ["Urgent", "Routine Symptoms", "Urgent"], "priorities, newest first")
+    expect([row[0] for row in rows], sorted((row[0] for row in rows), reverse=True), "ids, newest first")
+    expect(len(repository.list_appointments(priority="Urgent")), 2, "Urgent appointments")
+    expect(repository.list_appointments(clinic=CLINIC_LOCATIONS[1]), [], "appointments at another clinic")
+    expect(repository.list_appointments(page_size=1, before_id=rows[0][0])[0][0], rows[1][0], "second page")
+    expect(len(repository.list_appointments(booked_from=date.today(), booked_to=date.today())), 3,
+           "appointments booked today")
+    saved = repository.get_appointment(rows[0][0])
+    expect((saved["priority"], saved["clinic"], saved["age"], saved["gender"], saved["row_version"]),
+           ("Urgent", CLINIC, 30, "Female", 1), "saved appointment")
+    expect("priority_id" in saved, False, "lookup ids replaced by names")
+    expect(repository.get_appointment(-1), None, "unknown appointment")
+    expect(repository.triage_source_counts(), {"llm": 3}, "triage sources")
+
+
+@check
+def profile_jobs_move_through_their_states(repository):
+    with_calendar(repository)
+    for slot in repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=3):
+        book(repository, slot[0], "Urgent")
+    added, last_id = repository.enqueue_profile_jobs(["English", "Français"])
+    expect(added, 6, "jobs enqueued")
+    expect(repository.enqueue_profile_jobs(["English", "Français"])[0], 0, "jobs enqueued again")
+    expect(repository.enqueue_profile_jobs(["English", "Français"], after_id=last_id), (0, last_id),
+           "jobs enqueued after the last scanned appointment")
+    jobs = repository.claim_profile_jobs(4)
+    expect(len(jobs), 4, "jobs claimed")
+    expect([job[0] for job in jobs], sorted((job[0] for job in jobs), reverse=True), "newest appointments first")
+    expect(repository.profile_job_progress(), {"running": 4, "pending": 2}, "progress after claiming")
+
+    appointment_id, language, row_version = jobs[0]
+    expect(repository.get_stored_profile(appointment_id, language), None, "profile before it is stored")
+    repository.store_profile(appointment_id, language, row_version, "Formatted")
+    expect(repository.get_stored_profile(appointment_id, language), "Formatted", "stored profile")
+
+    failing = jobs[1]
+    repository.fail_profile_job(*failing, "timeout", max_attempts=2)
+    expect(repository.profile_job_progress(), {"done": 1, "running": 2, "pending": 3}, "progress after a failure")
+    # Claims newest first, so the failed job comes round again with the other pending ones
+    reclaimed = repository.claim_profile_jobs(10)
+    expect(tuple(failing) in map(tuple, reclaimed), True, "failed job claimed again")
+    repository.fail_profile_job(*failing, "timeout", max_attempts=2)
+    expect(repository.profile_job_progress().get("failed"), 1, "job failed after max_attempts")
+
+
+@check
+def profile_jobs_are_enqueued_incrementally(repository):
+    with_calendar(repository)
+    slots = repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=3)
+    for slot in slots[:2]:
+        book(repository, slot[0], "Urgent")
+    added, last_id = repository.enqueue_profile_jobs(["English"])
+    expect(added, 2, "jobs enqueued")
+    book(repository, slots[2][0], "Urgent")
+    new_id = repository.list_appointments()[0][0]  # newest first
+    expect(repository.enqueue_profile_jobs(["English"], after_id=last_id), (1, new_id), "jobs for the new booking")
+
+
+@check
+def stale_profile_jobs_are_reclaimed(repository):
+    with_calendar(repository)
+    slot = repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=1)[0]
+    book(repository, slot[0], "Urgent")
+    repository.enqueue_profile_jobs(["English"])
+    expect(len(repository.claim_profile_jobs(1)), 1, "jobs claimed")
+    expect(repository.claim_profile_jobs(1), [], "jobs claimed while the first is running")
+    time.sleep(0.05)
+    expect(len(repository.claim_profile_jobs(1, stale_seconds=0.01, max_attempts=2)), 1, "stale job claimed again")
+    time.sleep(0.05)
+    expect(repository.claim_profile_jobs(1, stale_seconds=0.01, max_attempts=2), [],
+           "stale job claimed after max_attempts")
+    expect(repository.profile_job_progress(), {"failed": 1}, "progress after the job kept stalling")
+
+
+@check
+def concurrent_profile_claims_are_disjoint(repository):
+    with_calendar(repository)
+    for slot in repository.find_pooled_slots(CLINIC, "Urgent", SLOT_MODE, 8, 19, now=NOW, limit=10):
+        book(repository, slot[0], "Urgent")
+    repository.enqueue_profile_jobs(["English", "Français"])
+    with ThreadPoolExecutor(4) as pool:
+        batches = list(pool.map(lambda _: repository.claim_profile_jobs(3), range(8)))
+    claimed = [tuple(job) for batch in batches for job in batch]
+    expect(len(claimed), len(set(claimed)), "jobs claimed by more than one worker")
+    expect(len(claimed), 20, "jobs claimed in total")
+
+##############################################
+# Runner
+##############################################
+
+def sqlite_repositories():
+    """Yields a repository on a fresh temporary SQLite file for each check."""
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(len(CHECKS)):
+            repository = SQLiteRepository(os.path.join(directory, f"check_{index}.db"))
+            yield repository
+            repository.close()
+
+
+def postgres_repositories(dsn):
+    """Yields a repository on a fresh PostgreSQL schema for each check, dropping the schema afterwards."""
+    import psycopg
+    from psycopg.conninfo import make_conninfo
+
+    with psycopg.connect(dsn, autocommit=True) as admin:
+        for _ in CHECKS:
+            schema = f"conformance_{secrets.token_hex(4)}"
+            admin.execute(f"CREATE SCHEMA {schema}")
+            repository = PostgresRepository(make_conninfo(dsn, options=f"-c search_path={schema}"), pool_size=8)
+            try:
+                yield repository
+            finally:
+                repository.close()
+                admin.execute(f"DROP SCHEMA {schema} CASCADE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--dsn", default=POSTGRES_DSN, help="PostgreSQL database to create scratch schemas in")
+    parser.add_argument("-k", dest="pattern", help="only run checks whose name contains this")
+    args = parser.parse_args()
+
+    repositories = postgres_repositories(args.dsn) if args.backend == "postgres" else sqlite_repositories()
+    passed = failures = 0
+    for func, repository in zip(CHECKS, repositories):
+        if args.pattern and args.pattern not in func.__name__:
+            continue
+        started = time.perf_counter()
+        try:
+            repository.init_schema()
+            func(repository)
+        except Exception as e:
+            failures += 1
+            print(f"FAIL  {func.__name__}: {e}")
+            if not isinstance(e, AssertionError):
+                traceback.print_exc()
+        else:
+            passed += 1
+            print(f"ok    {func.__name__} ({(time.perf_counter() - started) * 1000:.0f} ms)")
+    print(f"{args.backend}: {passed} passed, {failures} failed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+from i18n import DOMAIN_SOURCES, available_languages, check_catalogs
+
+
+def test_catalogs_have_every_key():
+    assert check_catalogs() == []
+
+
+def test_every_domain_has_translations():
+    for domain in DOMAIN_SOURCES:
+        assert len(available_languages(domain)) > 1, domain
@@ -0,0 +1,164 @@
+"""Translation of patients' free-text answers into the clinician's language.
+
+All of an appointment's untranslated fields go to the LLM in one request, and
+every translation is cached under a hash of its text and target language, so
+the same text is translated at most once per language whoever reads it.
+"""
+import hashlib
+import json
+import threading
+import time
+
+import metrics
+
+##############################################
+# Translation Prompt & Parsing
+##############################################
+
+# Questionnaire answers typed in by the patient; everything else is a choice or a number
+FREE_TEXT_FIELDS = ["symptoms", "symptoms_duration", "medical_history"]
+
+
+def free_text_answers(appointment):
+    """Returns {field: text} for the non-empty free-text answers of an appointment row."""
+    answers = json.loads(appointment.get("answers") or "{}")
+    return {field: answers[field] for field in FREE_TEXT_FIELDS
+            if isinstance(answers.get(field), str) and answers[field].strip()}
+
+
+def build_translation_prompt(texts, language):
+    """One prompt for all of texts ({field: text}), asking for a JSON object with the same keys."""
+    return (f"Translate the values of this JSON object into {language}. Keep medical terms precise, "
+            f"leave text already in {language} unchanged, and reply with only a JSON object "
+            f"with the same keys:\n{json.dumps(texts, ensure_ascii=False)}")
+
+
+def parse_translations(response, fields):
+    """Returns {field: translation} for the fields the response translated; the rest are left out."""
+    start, end = response.find("{"), response.rfind("}")
+    try:
+        translated = json.loads(response[start:end + 1]) if start != -1 else {}
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(translated, dict):
+        return {}
+    return {field: translated[field].strip() for field in fields
+            if isinstance(translated.get(field), str) and translated[field].strip()}
+
+##############################################
+# Translation Cache
+##############################################
+
+def translation_key(text, language):
+    """Content hash of text (whitespace-collapsed) and the target language."""
+    payload = json.dumps([language, " ".join(text.split())], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def init_translation_cache_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS translation_cache (
+                    key TEXT PRIMARY KEY,
+                    language TEXT,
+                    translation TEXT,
+                    created_at REAL,
+                    last_used REAL,
+                    hits INTEGER DEFAULT 0
+                    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_translation_cache_last_used ON translation_cache (last_used)")
+    conn.commit()
+
+
+class TranslationCache:
+    """Translations in a SQLite table with least-recently-used eviction; entries never expire.
+
+    Lookups are counted per process; each entry also counts its own hits, so
+    stats() can report the LLM translations saved by every process.
+    """
+
+    def __init__(self, max_entries=50_000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, conn, keys):
+        """Returns {key: translation} for the keys that are cached."""
+        if not keys:
+            return {}
+        placeholders = ", ".join("?" * len(keys))
+        found = dict(conn.execute(f"SELECT key, translation FROM translation_cache WHERE key IN ({placeholders})",
+                                  list(keys)).fetchall())
+        if found:
+            conn.execute(f'''UPDATE translation_cache SET last_used = ?, hits = hits + 1
+                             WHERE key IN ({", ".join("?" * len(found))})''', [time.time()] + list(found))
+            conn.commit()
+        misses = len(set(keys)) - len(found)
+        with self._lock:
+            self.hits += len(found)
+            self.misses += misses
+        metrics.increment("cache_lookups_total", len(found), cache="translation", result="hit")
+        metrics.increment("cache_lookups_total", misses, cache="translation", result="miss")
+        return found
+
+    def put_many(self, conn, language, translations):
+        """Stores {key: translation}, evicting the least recently used entries beyond max_entries."""
+        now = time.time()
+        conn.executemany('''INSERT OR REPLACE INTO translation_cache (key, language, translation, created_at, last_used)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         [(key, language, translation, now, now) for key, translation in translations.items()])
+        conn.execute('''DELETE FROM translation_cache WHERE key IN (
+                            SELECT key FROM translation_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                     (self.max_entries,))
+        conn.commit()
+
+    def stats(self, conn):
+        """Process hit/miss counters plus the size of the cache and the translations it has saved."""
+        entries, stored_bytes, translations_saved = conn.execute(
+            '''SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(translation AS BLOB))), 0), COALESCE(SUM(hits), 0)
+               FROM translation_cache''').fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": stored_bytes,
+                "translations_saved": translations_saved,
+            }
+
+
+# Shared by every session in the process so the counters cover all clinicians
+translation_cache = TranslationCache()
+
+##############################################
+# Translation Pipeline
+##############################################
+
+def translate_answers(appointment, language, complete, cache_connection):
+    """Returns {field: text} with the appointment's free-text answers translated into language.
+
+    Cached translations are reused; the rest are sent to complete(messages) in a
+    single request. A field the response leaves out keeps the patient's text and
+    is not cached. LLMUnavailableError from complete propagates to the caller.
+    cache_connection is a callable returning a connection context manager.
+    """
+    texts = free_text_answers(appointment)
+    keys = {field: translation_key(text, language) for field, text in texts.items()}
+    with cache_connection() as conn:
+        cached = translation_cache.get_many(conn, list(set(keys.values())))
+
+    # Fields with the same text need translating once
+    pending = {}
+    for field, key in keys.items():
+        if key not in cached and key not in (keys[other] for other in pending):
+            pending[field] = texts[field]
+    if pending:
+        response = complete([{"role": "user", "content": build_translation_prompt(pending, language)}])
+        translated = parse_translations(response, pending)
+        new_entries = {keys[field]: translation for field, translation in translated.items()}
+        if new_entries:
+            with cache_connection() as conn:
+                translation_cache.put_many(conn, language, new_entries)
+        cached.update(new_entries)
+    return {field: cached.get(key, texts[field]) for field, key in keys.items()}
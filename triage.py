@@ -0,0 +1,453 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+import metrics
+from llm import GEMINI_MODEL, LLMUnavailableError, get_gateway
+
+##############################################
+# Triage Prompt & Parsing
+##############################################
+
+SYSTEM_ROLE = "You are a sexual health triage assistant. Classify patients based on their symptoms and needs."
+
+# Codes the classifier answers with, and the priority each stands for
+PRIORITY_CODES = {
+    "URGENT": "Urgent",
+    "ROUTINE_SYMPTOMS": "Routine Symptoms",
+    "ROUTINE_NO_SYMPTOMS": "Routine No Symptoms",
+    "CONTRACEPTION_REFERRAL": "Contraception Referral",
+}
+
+# Matched as substrings of free-text answers from backends that ignore the schema
+PRIORITY_TERMS = ["urgent", "routine symptoms", "routine no symptoms", "contraception referral"]
+
+PRIORITY_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "triage_priority",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "priority": {"type": "string", "enum": list(PRIORITY_CODES)},
+                "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+            },
+            # Strict mode requires every property to be listed
+            "required": ["priority", "confidence"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# {"priority": "ROUTINE_NO_SYMPTOMS", "confidence": 0.95} plus headroom
+STRUCTURED_MAX_TOKENS = 32
+
+# Set to 0 for backends without JSON schema support; also switched off for the
+# process the first time the backend rejects the schema.
+_structured_output = os.getenv("TRIAGE_STRUCTURED_OUTPUT", "1") != "0"
+
+# Answers that can change the triage outcome; name and date of birth are
+# deliberately left out (age is kept) so they never split the cache.
+TRIAGE_FIELDS = [
+    "age", "symptoms", "symptoms_duration", "last_period",
+    "smoking", "drugs", "alcohol", "medical_history",
+]
+
+
+def build_patient_summary(responses, has_symptoms):
+    """Builds the English patient summary the classifier sees from the questionnaire responses."""
+    summary_items = [
+        f"Name: {responses.get('name')}",
+        f"Date of Birth: {responses.get('date_of_birth')}",
+        f"Age: {responses.get('age')}",
+        f"Has Symptoms: {responses.get('has_symptoms')}"
+    ]
+
+    if has_symptoms:
+        summary_items.extend([
+            f"Symptoms: {responses.get('symptoms')}",
+            f"Symptoms Duration: {responses.get('symptoms_duration')}",
+            f"Last Period: {responses.get('last_period')}",
+            f"Smoking: {responses.get('smoking')}",
+            f"Recreational Drugs: {responses.get('drugs')}",
+            f"Alcohol: {responses.get('alcohol')}"
+        ])
+
+    summary_items.extend([
+        f"Medical History: {responses.get('medical_history')}",
+        f"Needs Emergency Contraception: {responses.get('emergency_contraception')}"
+    ])
+
+    return "\n".join(summary_items)
+
+
+def build_priority_prompt(patient_summary):
+    return (
+        f"Patient's information summary:\n{patient_summary}\n\n"
+        f"Based on this information, classify the patient into exactly one of these priority categories:\n"
+        f"URGENT - for patients with severe symptoms requiring immediate attention\n"
+        f"ROUTINE_SYMPTOMS - for patients with mild symptoms that are not urgent\n"
+        f"ROUTINE_NO_SYMPTOMS - for patients seeking screening with no symptoms\n"
+        f"CONTRACEPTION_REFERRAL - for patients primarily needing emergency contraception\n\n"
+        f'Answer with only this JSON: {{"priority": "<CATEGORY>", "confidence": <0 to 1>}}'
+    )
+
+
+def _rejects_schema(error):
+    """True if a BadRequestError is the backend refusing structured output rather than this request."""
+    message = str(error).lower()
+    return "response_format" in message or "json_schema" in message
+
+
+def generate_openai_response(prompt, messages):
+    """Appends prompt to messages, calls the LLM gateway, appends and returns the response.
+
+    The classifier call behind both app.py and batch_triage.py. The answer is
+    constrained to PRIORITY_RESPONSE_FORMAT. If the backend refuses the request,
+    this call asks for free text instead; later calls do too only when the refusal
+    was about the schema itself. Raises LLMUnavailableError if the gateway times
+    out, exhausts its retries or has its circuit breaker open.
+    """
+    global _structured_output
+    messages.append({"role": "user", "content": prompt})
+    response = None
+    if _structured_output:
+        try:
+            response = get_gateway().complete(messages, max_tokens=STRUCTURED_MAX_TOKENS, temperature=0,
+                                              response_format=PRIORITY_RESPONSE_FORMAT)
+        except LLMUnavailableError as e:
+            if not isinstance(e.__cause__, openai.BadRequestError):
+                raise
+            # Other refusals (e.g. a safety filter on one patient's answers) say nothing about the backend
+            if _rejects_schema(e.__cause__):
+                _structured_output = False
+    if response is None:
+        response = get_gateway().complete(messages, max_tokens=150, temperature=0.5)
+    messages.append({"role": "assistant", "content": response})
+    return response
+
+
+def parse_structured_priority(classification_response):
+    """Returns (priority, confidence) from a JSON answer matching PRIORITY_RESPONSE_FORMAT.
+
+    Raises ValueError for anything else, including an unknown code or a
+    confidence outside 0-1. confidence is None when the answer leaves it out.
+    """
+    answer = json.loads(classification_response)
+    if not isinstance(answer, dict) or set(answer) - {"priority", "confidence"}:
+        raise ValueError(f"Unexpected triage answer: {classification_response!r}")
+    if answer.get("priority") not in PRIORITY_CODES:
+        raise ValueError(f"Unknown priority code: {answer.get('priority')!r}")
+    confidence = answer.get("confidence")
+    if confidence is not None and (isinstance(confidence, bool) or not isinstance(confidence, (int, float))
+                                   or not 0 <= confidence <= 1):
+        raise ValueError(f"Invalid confidence: {confidence!r}")
+    return PRIORITY_CODES[answer["priority"]], confidence
+
+
+def parse_priority(classification_response):
+    """Returns the first priority category named in a free-text response, or None.
+
+    The legacy parser, for answers that aren't valid structured output.
+    """
+    response_text = classification_response.lower().replace("_", " ")
+    for term in PRIORITY_TERMS:
+        if term in response_text:
+            return term.title()
+    return None
+
+
+def fallback_priority(has_symptoms, needs_contraception):
+    """Priority used when the classifier's answer can't be parsed."""
+    if needs_contraception:
+        return "Contraception Referral"
+    elif has_symptoms:
+        return "Routine Symptoms"
+    else:
+        return "Routine No Symptoms"
+
+##############################################
+# Fast-Path Rules
+##############################################
+
+# Rules are tried in registration order before the LLM. Each takes
+# (responses, has_symptoms, needs_contraception) and returns a priority,
+# or None to pass the case on.
+TRIAGE_RULES = []
+
+
+def triage_rule(func):
+    """Decorator that registers func as a fast-path triage rule."""
+    TRIAGE_RULES.append(func)
+    return func
+
+
+@triage_rule
+def screening_only(responses, has_symptoms, needs_contraception):
+    if not has_symptoms and not needs_contraception:
+        return "Routine No Symptoms"
+    return None
+
+
+@triage_rule
+def emergency_contraception_only(responses, has_symptoms, needs_contraception):
+    if needs_contraception and not has_symptoms:
+        return "Contraception Referral"
+    return None
+
+
+def apply_rules(responses, has_symptoms, needs_contraception, rules=None):
+    """Returns (priority, rule name) from the first rule that decides the case, or (None, None)."""
+    for rule in TRIAGE_RULES if rules is None else rules:
+        priority = rule(responses, has_symptoms, needs_contraception)
+        if priority:
+            return priority, rule.__name__
+    return None, None
+
+##############################################
+# Triage Cache
+##############################################
+
+def _normalize(value):
+    return " ".join(str(value).lower().split()) if value is not None else None
+
+
+def _classifier_version():
+    """Hash of everything besides the answers that shapes the classifier's reply."""
+    payload = json.dumps([GEMINI_MODEL, SYSTEM_ROLE, build_priority_prompt("{summary}"), PRIORITY_RESPONSE_FORMAT],
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+# Part of every cache key, so changing the model, prompt or schema starts from an empty cache
+CLASSIFIER_VERSION = _classifier_version()
+
+
+def triage_key(responses, has_symptoms, needs_contraception):
+    """Content hash of the answers that affect triage, plus CLASSIFIER_VERSION.
+
+    Free text is lower-cased and whitespace-collapsed. The symptom and emergency
+    contraception answers are passed in as booleans, since the stored answers are
+    in the patient's display language.
+    """
+    fields = {field: _normalize(responses.get(field)) for field in TRIAGE_FIELDS}
+    fields["classifier"] = CLASSIFIER_VERSION
+    fields["has_symptoms"] = bool(has_symptoms)
+    fields["needs_contraception"] = bool(needs_contraception)
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def init_triage_cache_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS triage_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT,
+                    created_at REAL,
+                    last_used REAL,
+                    hits INTEGER DEFAULT 0,
+                    llm_seconds REAL DEFAULT 0
+                    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_triage_cache_last_used ON triage_cache (last_used)")
+    conn.commit()
+
+
+class TriageCache:
+    """Classifier responses in a SQLite table, with a TTL and least-recently-used eviction.
+
+    Lookups are counted per process. Each entry also records its own hit count
+    and how long the LLM call that produced it took, so stats() can report from
+    any process how many calls and how much LLM time the cache has saved.
+    """
+
+    def __init__(self, ttl_seconds=7 * 24 * 3600, max_entries=10_000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, conn, key, record=True):
+        """Returns the cached response for key, or None if it is missing or expired.
+
+        With record=False the lookup is left out of the hit and miss counts; the
+        caller passes it to record_lookup once it knows the result is used.
+        """
+        now = time.time()
+        row = conn.execute("SELECT response, created_at FROM triage_cache WHERE key = ?", (key,)).fetchone()
+        if row and now - row[1] < self.ttl_seconds:
+            conn.execute("UPDATE triage_cache SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            conn.commit()
+            if record:
+                self.record_lookup(True)
+            return row[0]
+        if row:
+            conn.execute("DELETE FROM triage_cache WHERE key = ?", (key,))
+            conn.commit()
+        if record:
+            self.record_lookup(False)
+        return None
+
+    def record_lookup(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.increment("cache_lookups_total", cache="triage", result="hit" if hit else "miss")
+
+    def put(self, conn, key, response, llm_seconds=0.0):
+        """Stores response under key, evicting the least recently used entries beyond max_entries.
+
+        llm_seconds is how long the call that produced response took.
+        """
+        now = time.time()
+        conn.execute('''INSERT OR REPLACE INTO triage_cache (key, response, created_at, last_used, llm_seconds)
+                        VALUES (?, ?, ?, ?, ?)''', (key, response, now, now, llm_seconds))
+        conn.execute('''DELETE FROM triage_cache WHERE key IN (
+                            SELECT key FROM triage_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                     (self.max_entries,))
+        conn.commit()
+
+    def stats(self, conn):
+        """Process hit/miss counters plus the calls and LLM seconds saved by all cached entries."""
+        entries, calls_saved, seconds_saved = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(hits), 0), COALESCE(SUM(hits * llm_seconds), 0) FROM triage_cache"
+        ).fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "llm_calls_saved": calls_saved,
+                "llm_seconds_saved": seconds_saved,
+            }
+
+
+# Shared by every session in the process so the counters cover all patients
+triage_cache = TriageCache()
+
+##############################################
+# Triage Pipeline
+##############################################
+
+# source is "rule:<name>", "cache" or "llm", with "+legacy" appended when the
+# classifier text was not structured output but named a category, "+fallback"
+# when it could not be parsed at all, or "unavailable+fallback" when the LLM
+# gateway gave up; response is the raw classifier text, or None without one;
+# confidence is the classifier's own, when its structured answer gave one.
+TriageDecision = namedtuple("TriageDecision", ["priority", "source", "response", "confidence"],
+                            defaults=(None,))
+
+triage_path_counts = Counter()
+_path_lock = threading.Lock()
+
+
+def _record_path(source):
+    with _path_lock:
+        triage_path_counts[source] += 1
+
+
+def record_decision(decision, cache_used=True):
+    """Counts a decision made with record=False in the triage path and cache lookup stats, once it is used."""
+    _record_path(decision.source)
+    if cache_used and not decision.source.startswith("rule:"):
+        triage_cache.record_lookup(decision.source.startswith("cache"))
+
+
+def classify_patient(responses, has_symptoms, needs_contraception, complete, cache_connection=None, record=True):
+    """Decides a patient's priority: fast-path rules first, then the cache, then the LLM.
+
+    complete(prompt, messages) performs the LLM call and returns its text, like
+    generate_openai_response. cache_connection, if given, is a callable returning
+    a connection context manager (e.g. db.connection) for the triage cache.
+    With record=False the decision is left out of the triage path and cache
+    lookup stats until it is passed to record_decision.
+    """
+    priority, rule_name = apply_rules(responses, has_symptoms, needs_contraception)
+    if priority:
+        decision = TriageDecision(priority, f"rule:{rule_name}", None)
+        if record:
+            _record_path(decision.source)
+        return decision
+
+    source = "cache"
+    classification_response = None
+    cache_key = triage_key(responses, has_symptoms, needs_contraception)
+    if cache_connection:
+        with cache_connection() as conn:
+            classification_response = triage_cache.get(conn, cache_key, record=record)
+    if classification_response is None:
+        source = "llm"
+        messages = [{"role": "system", "content": SYSTEM_ROLE}]
+        prompt = build_priority_prompt(build_patient_summary(responses, has_symptoms))
+        started = time.perf_counter()
+        try:
+            classification_response = complete(prompt, messages)
+        except LLMUnavailableError:
+            # Timed out, out of retries or breaker open: don't wait, use the fallback priority
+            decision = TriageDecision(fallback_priority(has_symptoms, needs_contraception), "unavailable+fallback", None)
+            if record:
+                _record_path(decision.source)
+            return decision
+        llm_seconds = time.perf_counter() - started
+
+    confidence = None
+    try:
+        priority, confidence = parse_structured_priority(classification_response)
+    except Exception:
+        try:
+            priority = parse_priority(classification_response)
+        except Exception:
+            priority = None
+        if priority:
+            source += "+legacy"
+    if not priority:
+        priority = fallback_priority(has_symptoms, needs_contraception)
+        source += "+fallback"
+    elif source.startswith("llm") and cache_connection:
+        # Only answers that parsed are cached; an unparseable one would pin the fallback for the whole TTL
+        with cache_connection() as conn:
+            triage_cache.put(conn, cache_key, classification_response, llm_seconds)
+    decision = TriageDecision(priority, source, classification_response, confidence)
+    if record:
+        _record_path(decision.source)
+    return decision
+
+
+# Background pool for speculative triage, started before the patient confirms their summary
+_triage_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="triage")
+
+
+def _classify_speculatively(*args):
+    with metrics.labelled(speculative="1"):
+        return classify_patient(*args, record=False)
+
+
+def submit_triage(responses, has_symptoms, needs_contraception, complete, cache_connection=None):
+    """Starts classify_patient on the background pool and returns its Future.
+
+    complete must not touch Streamlit, since it runs outside the script thread.
+    responses is copied, so later edits don't leak into the running job. The
+    job's metrics carry speculative="1", and its decision only counts in the
+    triage stats once the caller hands it to record_decision.
+    """
+    return _triage_executor.submit(_classify_speculatively, dict(responses), has_symptoms, needs_contraception,
+                                   complete, cache_connection)
+
+
+def triage_path_stats():
+    """Returns this process's {source: count} and the share of cases decided without an LLM call."""
+    with _path_lock:
+        counts = dict(triage_path_counts)
+    total = sum(counts.values())
+    llm_calls = sum(count for source, count in counts.items() if source.startswith("llm"))
+    return {"counts": counts, "llm_avoided_share": (total - llm_calls) / total if total else 0.0}